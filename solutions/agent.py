@@ -1,16 +1,31 @@
-from llm import llm
+import asyncio
+import contextlib
+
+import aio
+from llm import llm, embeddings
 from graph import graph
+from config import get_setting
+from semantic_cache import SemanticCache, depends_on_history
+from memory import SUMMARY_PROMPT, HistoryWriter, WindowedChatMessageHistory
+from resources import get_registry
+from router import Router
+from singleflight import SingleFlight, normalize_key
+from pool import scoped
+from prompt_budget import PromptBudget
+from streaming import final_answer_tokens
+from tracing import Tracer
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.prompts import PromptTemplate
 from langchain.schema import StrOutputParser
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.runnables import RunnableLambda
 from langchain.tools import Tool
-from langchain_neo4j import Neo4jChatMessageHistory
 from langchain.agents import AgentExecutor, create_react_agent
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain import hub
 from utils import get_session_id
 
-from tools.vector import get_movie_plot
+from tools.vector import get_movie_plot, aget_movie_plot
 from tools.cypher import cypher_qa
 
 chat_prompt = ChatPromptTemplate.from_messages(
@@ -22,26 +37,84 @@ chat_prompt = ChatPromptTemplate.from_messages(
 
 movie_chat = chat_prompt | llm | StrOutputParser()
 
+# Questions routed straight to General Chat skip the agent prompt, so
+# they are answered with its off-topic guard, see route_response
+OFF_TOPIC_GUARD = "Do not answer any questions that do not relate to movies, actors or directors."
+
+guarded_chat_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", f"You are a movie expert providing information about movies.\n{OFF_TOPIC_GUARD}"),
+        ("human", "{input}"),
+    ]
+)
+
+guarded_chat = guarded_chat_prompt | llm | StrOutputParser()
+
 tools = [
     Tool.from_function(
         name="General Chat",
         description="For general movie chat not covered by other tools",
         func=movie_chat.invoke,
+        coroutine=movie_chat.ainvoke,
     ), 
     Tool.from_function(
         name="Movie Plot Search",  
         description="For when you need to find information about movies based on a plot",
         func=get_movie_plot, 
+        coroutine=aget_movie_plot,
     ),
     Tool.from_function(
         name="Movie information",
         description="Provide information about movies questions using Cypher",
-        func = cypher_qa
+        func = cypher_qa,
+        coroutine=cypher_qa.ainvoke,
     )
 ]
 
+# Count the Neo4j connections each tool acquires, see pool.py
+for tool in tools:
+    tool.func = scoped(tool.name, tool.func)
+    tool.coroutine = scoped(tool.name, tool.coroutine)
+
+# Identical questions asked at the same moment share one run, of each
+# tool and of the whole agent, see singleflight.py
+def create_flights():
+    return SingleFlight() if get_setting("SINGLE_FLIGHT", False) else None
+
+tool_flights = get_registry().register("tool_flights", create_flights).get("tool_flights")
+answer_flights = get_registry().register("answer_flights", create_flights).get("answer_flights")
+
+if tool_flights is not None:
+    for tool in tools:
+        tool.func = tool_flights.wrap(tool.name, tool.func)
+        tool.coroutine = tool_flights.wrap(tool.name, tool.coroutine)
+
+# Older turns are folded into a rolling summary stored on the session
+summarize_chain = SUMMARY_PROMPT | llm | StrOutputParser()
+
+# Buffer history writes and flush them off the critical path of the response
+def create_history_writer():
+    return HistoryWriter(
+        graph._driver,
+        graph._database,
+        interval=get_setting("HISTORY_FLUSH_INTERVAL", 0),
+        durable=get_setting("HISTORY_DURABLE", False),
+    )
+
+history_writer = get_registry().register(
+    "history_writer",
+    create_history_writer,
+    teardown=lambda writer: writer.close(),
+).get("history_writer")
+
 def get_memory(session_id):
-    return Neo4jChatMessageHistory(session_id=session_id, graph=graph)
+    return WindowedChatMessageHistory(
+        session_id=session_id,
+        graph=graph,
+        window=get_setting("MEMORY_WINDOW", 3),
+        summarizer=summarize_chain if get_setting("MEMORY_SUMMARY", False) else None,
+        writer=history_writer,
+    )
 
 agent_prompt = PromptTemplate.from_template("""
 You are a movie expert providing information about movies.
@@ -82,12 +155,37 @@ New input: {input}
 {agent_scratchpad}
 """)
 
-agent = create_react_agent(llm, tools, agent_prompt)
-agent_executor = AgentExecutor(
-    agent=agent,
-    tools=tools,
-    verbose=True
+# Tag the agent's own LLM so its tokens can be told apart from the LLM calls
+# made inside the tools when streaming events
+AGENT_LLM_TAG = "agent_llm"
+
+# Token budgets for each section of the agent prompt
+def create_prompt_budget():
+    return PromptBudget(
+        tools=get_setting("PROMPT_BUDGET_TOOLS", 500),
+        chat_history=get_setting("PROMPT_BUDGET_CHAT_HISTORY", 1500),
+        scratchpad=get_setting("PROMPT_BUDGET_SCRATCHPAD", 3000),
+        observation=get_setting("PROMPT_BUDGET_OBSERVATION", 1000),
+        model=get_setting("OPENAI_MODEL", "gpt-4"),
+    )
+
+registry = get_registry()
+prompt_budget = registry.register("prompt_budget", create_prompt_budget).get("prompt_budget")
+
+def create_agent_executor():
+    agent = create_react_agent(
+        llm.with_config(tags=[AGENT_LLM_TAG]),
+        tools,
+        agent_prompt,
+        tools_renderer=prompt_budget.render_tools,
     )
+    return AgentExecutor(
+        agent=RunnableLambda(prompt_budget.trim).with_config(run_name="PromptBudget") | agent,
+        tools=tools,
+        verbose=True
+        )
+
+agent_executor = registry.register("agent_executor", create_agent_executor).get("agent_executor")
 
 chat_agent = RunnableWithMessageHistory(
     agent_executor,
@@ -96,14 +194,334 @@ chat_agent = RunnableWithMessageHistory(
     history_messages_key="chat_history",
 )
 
-def generate_response(user_input):
+# Answers to previously asked questions, matched on embedding similarity
+def create_semantic_cache():
+    if not get_setting("SEMANTIC_CACHE", False):
+        return None
+
+    return SemanticCache(
+        embeddings,
+        threshold=get_setting("SEMANTIC_CACHE_THRESHOLD", 0.95),
+        maxsize=get_setting("SEMANTIC_CACHE_SIZE", 1000),
+        ttl=get_setting("SEMANTIC_CACHE_TTL", 3600),
+    )
+
+semantic_cache = registry.register("semantic_cache", create_semantic_cache).get("semantic_cache")
+
+# Send obvious questions straight to a tool, skipping the ReAct loop
+def create_router():
+    if not get_setting("ROUTER", False):
+        return None
+
+    return Router(
+        embeddings,
+        threshold=get_setting("ROUTER_THRESHOLD", 0.82),
+        margin=get_setting("ROUTER_MARGIN", 0.03),
+    )
+
+router = registry.register("router", create_router).get("router")
+
+# Spans of the LLM, tool, embedding and Neo4j calls of recent turns
+def create_tracer():
+    if not get_setting("TRACING", False):
+        return None
+
+    return Tracer(
+        maxlen=get_setting("TRACE_BUFFER_SIZE", 20),
+        path=get_setting("TRACE_PATH", None),
+        max_bytes=get_setting("TRACE_MAX_BYTES", 10_000_000),
+        model=get_setting("OPENAI_MODEL", "gpt-4"),
+    )
+
+tracer = registry.register("tracer", create_tracer).get("tracer")
+
+def trace_turn(user_input, session_id):
     """
-    Create a handler that calls the Conversational agent
-    and returns a response to be rendered in the UI
+    Trace a turn, if tracing is enabled
+    """
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.trace(user_input, session_id)
+
+# How to turn the output of each tool into an answer for the UI
+ROUTES = {
+    "General Chat": lambda output: output,
+    "Movie Plot Search": lambda output: output["answer"],
+    "Movie information": lambda output: output["result"],
+}
+routes = {tool.name: (tool.func, tool.coroutine) for tool in tools}
+routes["General Chat"] = (guarded_chat.invoke, guarded_chat.ainvoke)
+
+def save_response(session_id, user_input, answer):
+    # Keep the conversation history complete for later follow-ups
+    get_memory(session_id).add_messages([
+        HumanMessage(content=user_input),
+        AIMessage(content=answer),
+    ])
+
+async def asave_response(session_id, user_input, answer):
+    # The write may block on Neo4j, so it runs in the executor
+    await get_memory(session_id).aadd_messages([
+        HumanMessage(content=user_input),
+        AIMessage(content=answer),
+    ])
+
+def lookup_cached_response(user_input, session_id):
+    """
+    Check the semantic cache for an answer to the question.
+    Returns the scope and vector to store the answer under, and
+    the cached answer if there is one.
+
+    Follow-ups and questions about the user depend on the conversation
+    history, so they are never served from, or added to, the cache.
+    """
+    scope = semantic_cache.scope(user_input) if semantic_cache is not None else None
+    if scope is None:
+        return None, None, None
+
+    vector = semantic_cache.embed(user_input)
+    answer = semantic_cache.lookup(vector, scope)
+    if answer is not None:
+        save_response(session_id, user_input, answer)
+
+    return scope, vector, answer
+
+async def alookup_cached_response(user_input, session_id):
+    scope = semantic_cache.scope(user_input) if semantic_cache is not None else None
+    if scope is None:
+        return None, None, None
+
+    vector = await semantic_cache.aembed(user_input)
+    answer = semantic_cache.lookup(vector, scope)
+    if answer is not None:
+        await asave_response(session_id, user_input, answer)
+
+    return scope, vector, answer
+
+def route_response(user_input, session_id):
+    """
+    Answer the question with a single tool call if the router is
+    confident, otherwise return None so the agent handles it
+    """
+    if router is None or depends_on_history(user_input):
+        return None
+
+    tool = router.route(user_input)
+    if tool is None:
+        return None
+
+    func, _ = routes[tool]
+    answer = ROUTES[tool](func(user_input))
+    save_response(session_id, user_input, answer)
+
+    return answer
+
+async def aroute_response(user_input, session_id):
+    if router is None or depends_on_history(user_input):
+        return None
+
+    tool = await router.aroute(user_input)
+    if tool is None:
+        return None
+
+    _, coroutine = routes[tool]
+    answer = ROUTES[tool](await coroutine(user_input))
+    await asave_response(session_id, user_input, answer)
+
+    return answer
+
+def answer_key(user_input):
+    """
+    The key identical in-flight questions share an answer under, or None
+    if the answer may depend on the conversation history.  The leader
+    answers with its own session's history, so questions about the user
+    or the conversation are never shared.
     """
+    if answer_flights is None or depends_on_history(user_input):
+        return None
+    return normalize_key(user_input)
 
+def run_agent(user_input, session_id):
     response = chat_agent.invoke(
         {"input": user_input},
-        {"configurable": {"session_id": get_session_id()}},)
+        {"configurable": {"session_id": session_id}},)
+    return response['output']
 
+async def arun_agent(user_input, session_id):
+    response = await chat_agent.ainvoke(
+        {"input": user_input},
+        {"configurable": {"session_id": session_id}},)
     return response['output']
+
+def share_answer(user_input, session_id):
+    """
+    Run the agent, or wait for the answer to the same question asked
+    by another session.  A shared answer is added to this session's
+    history, as the agent only saves the turns it runs.
+    """
+    key = answer_key(user_input)
+    if key is None:
+        return run_agent(user_input, session_id)
+
+    answer, shared = answer_flights.do(key, run_agent, user_input, session_id)
+    if shared:
+        save_response(session_id, user_input, answer)
+    return answer
+
+async def ashare_answer(user_input, session_id):
+    key = answer_key(user_input)
+    if key is None:
+        return await arun_agent(user_input, session_id)
+
+    answer, shared = await answer_flights.ado(key, arun_agent, user_input, session_id)
+    if shared:
+        await asave_response(session_id, user_input, answer)
+    return answer
+
+def generate_response(user_input, session_id=None):
+    """
+    Create a handler that calls the Conversational agent
+    and returns a response to be rendered in the UI
+    """
+
+    session_id = session_id or get_session_id()
+    with trace_turn(user_input, session_id):
+        scope, vector, answer = lookup_cached_response(user_input, session_id)
+        if answer is not None:
+            return answer
+
+        answer = route_response(user_input, session_id)
+        if answer is None:
+            answer = share_answer(user_input, session_id)
+
+    if scope is not None:
+        semantic_cache.store(vector, answer, scope)
+
+    return answer
+
+async def agenerate_response(user_input, session_id):
+    """
+    Async variant of generate_response.  The agent's LLM calls and the
+    tools await async clients, so no thread is held while waiting on
+    OpenAI or Neo4j.  Run it on the process loop with aio.run().
+    """
+
+    with trace_turn(user_input, session_id):
+        scope, vector, answer = await alookup_cached_response(user_input, session_id)
+        if answer is not None:
+            return answer
+
+        answer = await aroute_response(user_input, session_id)
+        if answer is None:
+            answer = await ashare_answer(user_input, session_id)
+
+    if scope is not None:
+        semantic_cache.store(vector, answer, scope)
+
+    return answer
+
+async def astream_response(user_input, session_id):
+    """
+    Run the Conversational agent using the async event stream and
+    yield the tokens of the Final Answer as they arrive from the LLM
+    """
+
+    events = chat_agent.astream_events(
+        {"input": user_input},
+        {"configurable": {"session_id": session_id}},
+        version="v2")
+
+    # Stop the agent, not only the parser, when the stream is closed
+    async with contextlib.aclosing(events), contextlib.aclosing(final_answer_tokens(events, AGENT_LLM_TAG)) as tokens:
+        async for token in tokens:
+            yield token
+
+def stream_response(user_input, session_id=None):
+    """
+    Create a handler that streams the Conversational agent's
+    Final Answer to the UI, token by token
+    """
+
+    session_id = session_id or get_session_id()
+
+    # The trace is set in this thread, and aio copies it to the loop
+    with trace_turn(user_input, session_id):
+        scope, vector, answer = lookup_cached_response(user_input, session_id)
+        if answer is None:
+            answer = route_response(user_input, session_id)
+            if answer is not None and scope is not None:
+                semantic_cache.store(vector, answer, scope)
+
+        if answer is not None:
+            yield answer
+            return
+
+        # Wait for the same question being streamed to another session
+        key = answer_key(user_input)
+        if key is not None:
+            flight, leader = answer_flights.begin(key)
+            if not leader:
+                answer = flight.result()
+                save_response(session_id, user_input, answer)
+                yield answer
+                return
+
+        streamed = []
+        try:
+            for token in aio.iterate(astream_response(user_input, session_id)):
+                streamed.append(token)
+                yield token
+        except BaseException as error:
+            if key is not None:
+                answer_flights.end(key, flight, error=error)
+            raise
+
+        if key is not None:
+            answer_flights.end(key, flight, "".join(streamed))
+
+    if scope is not None:
+        semantic_cache.store(vector, "".join(streamed), scope)
+
+async def astream_answer(user_input, session_id):
+    """
+    Async variant of stream_response, for callers already running on
+    the process loop, eg. the agent service
+    """
+
+    with trace_turn(user_input, session_id):
+        scope, vector, answer = await alookup_cached_response(user_input, session_id)
+        if answer is None:
+            answer = await aroute_response(user_input, session_id)
+            if answer is not None and scope is not None:
+                semantic_cache.store(vector, answer, scope)
+
+        if answer is not None:
+            yield answer
+            return
+
+        # Wait for the same question being streamed to another session
+        key = answer_key(user_input)
+        if key is not None:
+            flight, leader = answer_flights.begin(key)
+            if not leader:
+                answer = await asyncio.shield(asyncio.wrap_future(flight))
+                await asave_response(session_id, user_input, answer)
+                yield answer
+                return
+
+        streamed = []
+        try:
+            async with contextlib.aclosing(astream_response(user_input, session_id)) as tokens:
+                async for token in tokens:
+                    streamed.append(token)
+                    yield token
+        except BaseException as error:
+            if key is not None:
+                answer_flights.end(key, flight, error=error)
+            raise
+
+        if key is not None:
+            answer_flights.end(key, flight, "".join(streamed))
+
+    if scope is not None:
+        semantic_cache.store(vector, "".join(streamed), scope)
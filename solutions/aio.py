@@ -0,0 +1,54 @@
+import asyncio
+import threading
+
+_loop = None
+_lock = threading.Lock()
+
+def get_loop():
+    """
+    Return the process-wide event loop, running on a daemon thread.
+
+    Async clients such as the async Neo4j driver are bound to the loop
+    they are first used on, so every coroutine in the app runs here.
+    """
+    global _loop
+
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="event-loop", daemon=True).start()
+
+    return _loop
+
+def use_loop(loop):
+    """
+    Make a loop that is already running, eg. the ASGI server's, the
+    process loop, or give it up with None.  Coroutines are then awaited
+    on it directly, and run() must only be called from other threads.
+    """
+    global _loop
+
+    with _lock:
+        if loop is not None and _loop is not None and _loop is not loop:
+            raise RuntimeError("The process already has an event loop")
+        _loop = loop
+
+def run(coroutine):
+    """
+    Run a coroutine on the process loop and wait for its result
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+def iterate(generator):
+    """
+    Iterate over an async generator from synchronous code,
+    eg. to pass a stream of tokens to st.write_stream
+    """
+    try:
+        while True:
+            try:
+                yield run(generator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        run(generator.aclose())
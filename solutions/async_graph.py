@@ -0,0 +1,51 @@
+import asyncio
+import functools
+
+from neo4j import AsyncGraphDatabase, Query
+
+from tracing import span
+
+class AsyncGraph:
+    """
+    A minimal async counterpart to Neo4jGraph, backed by the async driver,
+    for use on the process event loop in aio.py.
+
+    The driver is created on the first query, on that loop, so processes
+    that never take the async path never open its pool.  on_connect is
+    called with the driver when it is created.
+    """
+
+    def __init__(self, url, username, password, database="neo4j", timeout=None, driver_config=None,
+                 on_connect=None):
+        self._connect = functools.partial(
+            AsyncGraphDatabase.driver, url, auth=(username, password), **(driver_config or {})
+        )
+        self._on_connect = on_connect
+        self._driver = None
+        self._database = database
+        self.timeout = timeout
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            self._driver = self._connect()
+            if self._on_connect is not None:
+                self._on_connect(self._driver)
+        return self._driver
+
+    @property
+    def connected(self):
+        return self._driver is not None
+
+    async def query(self, query, params={}):
+        with span("neo4j", "query", cypher=query):
+            records, _, _ = await self.driver.execute_query(
+                Query(text=query, timeout=self.timeout),
+                parameters_=params,
+                database_=self._database,
+            )
+        return [record.data() for record in records]
+
+    async def close(self):
+        if self._driver is not None:
+            await self._driver.close()
@@ -0,0 +1,316 @@
+"""
+Deterministic stand-ins for OpenAI and Neo4j, used by the offline
+benchmarks.  None of them touch the network.
+"""
+import re
+import time
+from collections import Counter
+from typing import Any
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.vectorstores import InMemoryVectorStore
+from langchain_neo4j.graphs.graph_store import GraphStore
+from pydantic import Field
+
+MOVIES = [
+    {"title": "Matrix, The", "year": 1999, "genres": ["Action", "Sci-Fi"],
+     "plot": "A hacker discovers that reality is a simulation run by machines.",
+     "directors": ["Lana Wachowski", "Lilly Wachowski"],
+     "actors": [("Keanu Reeves", "Neo"), ("Laurence Fishburne", "Morpheus"), ("Carrie-Anne Moss", "Trinity")]},
+    {"title": "Toy Story", "year": 1995, "genres": ["Animation", "Comedy"],
+     "plot": "A cowboy doll is jealous when a new space ranger toy arrives.",
+     "directors": ["John Lasseter"],
+     "actors": [("Tom Hanks", "Woody"), ("Tim Allen", "Buzz Lightyear")]},
+    {"title": "Apollo 13", "year": 1995, "genres": ["Drama"],
+     "plot": "Astronauts fight to return to earth after an explosion on their spacecraft.",
+     "directors": ["Ron Howard"],
+     "actors": [("Tom Hanks", "Jim Lovell"), ("Kevin Bacon", "Jack Swigert"), ("Bill Paxton", "Fred Haise")]},
+    {"title": "Heat", "year": 1995, "genres": ["Crime", "Thriller"],
+     "plot": "A detective hunts a crew of professional thieves planning one last heist.",
+     "directors": ["Michael Mann"],
+     "actors": [("Al Pacino", "Vincent Hanna"), ("Robert De Niro", "Neil McCauley")]},
+    {"title": "Casino", "year": 1995, "genres": ["Crime", "Drama"],
+     "plot": "A casino boss in Las Vegas is undone by greed and his friend's violence.",
+     "directors": ["Martin Scorsese"],
+     "actors": [("Robert De Niro", "Sam Rothstein"), ("Sharon Stone", "Ginger"), ("Joe Pesci", "Nicky Santoro")]},
+    {"title": "Independence Day", "year": 1996, "genres": ["Action", "Sci-Fi"],
+     "plot": "Aliens land on earth and humanity fights back on the fourth of July.",
+     "directors": ["Roland Emmerich"],
+     "actors": [("Will Smith", "Steven Hiller"), ("Jeff Goldblum", "David Levinson")]},
+    {"title": "Jaws", "year": 1975, "genres": ["Thriller"],
+     "plot": "A great white shark terrorises a beach town.",
+     "directors": ["Steven Spielberg"],
+     "actors": [("Roy Scheider", "Martin Brody"), ("Richard Dreyfuss", "Matt Hooper")]},
+    {"title": "Rocky", "year": 1976, "genres": ["Drama"],
+     "plot": "A small-time boxer gets a shot at the heavyweight title.",
+     "directors": ["John G. Avildsen"],
+     "actors": [("Sylvester Stallone", "Rocky Balboa"), ("Talia Shire", "Adrian")]},
+]
+
+PEOPLE = sorted({name for movie in MOVIES for name in movie["directors"] + [actor for actor, _ in movie["actors"]]})
+
+def prompt_text(messages):
+    return "\n".join(str(message.content) for message in messages)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    A chat model that answers each of the app's prompts with a scripted
+    response, recognising the prompt from its wording.  `latency` adds a
+    fixed delay to every call to stand in for the network.
+    """
+
+    latency: float = 0.0
+    calls: Any = Field(default_factory=Counter)
+
+    @property
+    def _llm_type(self):
+        return "scripted"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        kind, text = self.respond(prompt_text(messages))
+        self.calls[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+    def respond(self, prompt):
+        if "TOOLS:\n------" in prompt:
+            return self.agent(prompt)
+        if "translating user questions into Cypher" in prompt:
+            return "cypher", self.cypher(prompt.rsplit("Question:", 1)[-1].strip())
+        if "Helpful Answer:" in prompt:
+            context = prompt.rsplit("Information:", 1)[-1].split("Question:", 1)[0].strip()
+            return "cypher_answer", f"From the database: {context[:200]}"
+        if "Use the given context to answer the question" in prompt:
+            return "plot_answer", "You might enjoy these movies, based on their plots."
+        if "Progressively summarize" in prompt:
+            return "summary", "The user asked about several movies."
+        return "chat", "I am a movie expert, ask me anything about movies."
+
+    def agent(self, prompt):
+        question = prompt.split("New input:", 1)[-1].split("\n", 1)[0].strip()
+        observations = prompt.split("New input:", 1)[-1].split("Observation:")
+
+        if len(observations) > 1:
+            return "agent_answer", (
+                "Thought: Do I need to use a tool? No\n"
+                f"Final Answer: {observations[-1].split('Thought:')[0].strip()[:300]}"
+            )
+
+        lower = question.lower()
+        if re.search(r"\b(about|plot|where|recommend)\b", lower):
+            tool = "Movie Plot Search"
+        elif re.search(r"\b(hi|hello|thanks|what can you)\b", lower):
+            tool = "General Chat"
+        else:
+            tool = "Movie information"
+
+        return "agent_tool", (
+            "Thought: Do I need to use a tool? Yes\n"
+            f"Action: {tool}\n"
+            f"Action Input: {question}"
+        )
+
+    def cypher(self, question):
+        lower = question.lower()
+        names = re.findall(r'"([^"]+)"', question)
+        first = names[0] if names else question
+
+        if "degrees" in lower and len(names) >= 2:
+            return (
+                f'MATCH path = shortestPath((p1:Person {{name: "{names[0]}"}})'
+                f'-[:ACTED_IN|DIRECTED*]-(p2:Person {{name: "{names[1]}"}}))\n'
+                "RETURN length(path) AS degrees"
+            )
+        if "direct" in lower:
+            return f'MATCH (p:Person)-[r:DIRECTED]->(m:Movie {{title: "{first}"}})\nRETURN p.name'
+        if "role" in lower and len(names) >= 2:
+            return (
+                f'MATCH (p:Person {{name: "{names[0]}"}})-[r:ACTED_IN]->(m:Movie {{title: "{names[1]}"}})\n'
+                "RETURN r.role"
+            )
+        if "acted" in lower or "starred" in lower or "cast" in lower:
+            return f'MATCH (p:Person)-[r:ACTED_IN]->(m:Movie {{title: "{first}"}})\nRETURN p.name, r.role'
+        return f'MATCH (m:Movie {{title: "{first}"}})\nRETURN m.title, m.year'
+
+
+class FakeRecord:
+    def __init__(self, row):
+        self._row = row
+
+    def data(self):
+        return dict(self._row)
+
+    def __getitem__(self, key):
+        return self._row[key]
+
+
+class FakeSummary:
+    def __init__(self, plan=None):
+        self.plan = plan
+
+
+class FakeResult:
+    def __init__(self, rows, plan=None):
+        self._rows = rows
+        self._plan = plan
+
+    def __iter__(self):
+        return (FakeRecord(row) for row in self._rows)
+
+    def consume(self):
+        return FakeSummary(self._plan)
+
+
+class FakeSession:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def run(self, query, parameters=None, **kwargs):
+        text = getattr(query, "text", query)
+        if text.startswith("EXPLAIN"):
+            return FakeResult([], plan={
+                "operatorType": "ProduceResults@neo4j",
+                "args": {"EstimatedRows": 10.0},
+                "children": [{"operatorType": "NodeIndexSeek@neo4j", "args": {"EstimatedRows": 1.0}}],
+            })
+        return FakeResult(self.graph.execute(text, parameters or {}))
+
+    def execute_write(self, work, *args, **kwargs):
+        return work(self, *args, **kwargs)
+
+    def execute_read(self, work, *args, **kwargs):
+        return work(self, *args, **kwargs)
+
+
+class FakeDriver:
+    def __init__(self, graph):
+        self.graph = graph
+
+    def session(self, **kwargs):
+        self.graph.calls["session"] += 1
+        return FakeSession(self.graph)
+
+    def execute_query(self, query, parameters=None, **kwargs):
+        return [FakeRecord(row) for row in self.graph.execute(getattr(query, "text", query), parameters or {})], None, []
+
+    def verify_connectivity(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeGraph(GraphStore):
+    """
+    An in-memory movie graph behind the Neo4jGraph interface.
+
+    It does not interpret Cypher: each statement is recognised by the
+    relationships it mentions and answered from MOVIES, which is enough
+    for the statements the ScriptedChatModel writes.
+    """
+
+    def __init__(self, movies=MOVIES):
+        self.movies = {movie["title"]: movie for movie in movies}
+        self.calls = Counter()
+        self._driver = FakeDriver(self)
+        self._database = "neo4j"
+        self.timeout = None
+        self.schema = (
+            "Node properties:\nMovie {title: STRING, year: INTEGER, plot: STRING}\n"
+            "Person {name: STRING}\nGenre {name: STRING}\n"
+            "The relationships:\n(:Person)-[:ACTED_IN {role: STRING}]->(:Movie)\n"
+            "(:Person)-[:DIRECTED]->(:Movie)\n(:Movie)-[:IN_GENRE]->(:Genre)"
+        )
+        self.structured_schema = {
+            "node_props": {
+                "Movie": [{"property": "title", "type": "STRING"}, {"property": "year", "type": "INTEGER"}],
+                "Person": [{"property": "name", "type": "STRING"}],
+            },
+            "rel_props": {"ACTED_IN": [{"property": "role", "type": "STRING"}]},
+            "relationships": [
+                {"start": "Person", "type": "ACTED_IN", "end": "Movie"},
+                {"start": "Person", "type": "DIRECTED", "end": "Movie"},
+            ],
+            "metadata": {},
+        }
+
+    @property
+    def get_schema(self):
+        return self.schema
+
+    @property
+    def get_structured_schema(self):
+        return self.structured_schema
+
+    def refresh_schema(self):
+        pass
+
+    def add_graph_documents(self, graph_documents, include_source=False):
+        pass
+
+    def query(self, query, params={}):
+        return self.execute(query, params)
+
+    def execute(self, cypher, params):
+        self.calls["query"] += 1
+
+        # Titles and names of the EntityIndex
+        if "UNION ALL" in cypher and "AS value" in cypher:
+            return [{"value": value} for value in list(self.movies) + PEOPLE]
+
+        literals = [value for value in params.values() if isinstance(value, str)]
+        literals += re.findall(r'"([^"]+)"', cypher)
+        movie = next((self.movies[value] for value in literals if value in self.movies), None)
+        people = [value for value in literals if value in PEOPLE]
+
+        if "shortestPath" in cypher:
+            return [{"degrees": 2 if len(people) == 2 else None}]
+        if movie is None:
+            return []
+        if "DIRECTED" in cypher:
+            return [{"p.name": name} for name in movie["directors"]]
+        if "ACTED_IN" in cypher:
+            return [
+                {"p.name": name, "r.role": role} for name, role in movie["actors"]
+                if not people or name in people
+            ]
+        return [{"m.title": movie["title"], "m.year": movie["year"]}]
+
+
+def create_embeddings(size=256):
+    """
+    Embeddings seeded from a hash of the text, so equal texts get equal vectors
+    """
+    return DeterministicFakeEmbedding(size=size)
+
+
+def create_vector_store(embeddings, movies=MOVIES):
+    """
+    An in-memory vector store of plots behind the VectorStore interface
+    that Neo4jVector implements
+    """
+    store = InMemoryVectorStore(embeddings)
+    store.add_documents([
+        Document(
+            page_content=movie["plot"],
+            metadata={
+                "title": movie["title"],
+                "directors": movie["directors"],
+                "actors": [[name, role] for name, role in movie["actors"]],
+            },
+        )
+        for movie in movies
+    ])
+    return store
@@ -0,0 +1,354 @@
+"""
+Benchmark each stage of the agent pipeline offline.
+
+Replays a corpus of questions through agent.generate_response with the
+stand-ins in benchmarks/fakes.py in place of OpenAI and Neo4j, and reports
+the calls, wall time and memory allocated per question for each stage.
+Stages nest - Cypher generation includes its LLM call - so their times
+are inclusive.  Times are measured in one pass and allocations, with
+tracemalloc, in a second, as tracing slows everything down.
+
+The results are compared with benchmarks/baseline.json, and the script
+exits with status 1 if any stage has regressed, or 2 if the baseline was
+measured with other options.  Stage times are compared relative to the
+total, so the baseline holds on other hardware.  Run from the repository root, no secrets
+or network needed:
+
+    python solutions/benchmarks/pipeline.py --runs 5
+    python solutions/benchmarks/pipeline.py --save-baseline
+"""
+import argparse
+import contextlib
+import functools
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import streamlit.config
+import streamlit.logger
+
+# Streamlit warns about running outside `streamlit run` on every cache
+# access.  Parse its config first, as that resets the log level.
+streamlit.config.get_config_options()
+streamlit.logger.set_log_level("error")
+
+from benchmarks.fakes import FakeGraph, ScriptedChatModel, create_embeddings, create_vector_store
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+QUESTIONS = [
+    "Hi, what can you help me with?",
+    "Who acted in the matrix?",
+    "Who directed Toy Story?",
+    "What role did Tom Hanks play in Apollo 13?",
+    "How many degrees of separation are there between Tom Hanks and Kevin Bacon?",
+    "When was Casino released?",
+    "What is a good movie about aliens landing on earth?",
+    "Recommend a movie about a boxer",
+    "Who starred in Heat?",
+    "Who directed Jaws?",
+]
+
+# Optional stages measured whatever secrets.toml says.  The OpenAI
+# scheduler and embedding cache wrap the clients the fakes replace.
+SETTINGS = {
+    "ENTITY_RESOLVER": True,
+    "CYPHER_GUARD": True,
+    "MEMORY_SUMMARY": True,
+    "TRACING": True,
+}
+
+class Profiler:
+    """
+    Records the calls, wall time and, while tracemalloc is tracing, the
+    memory allocated by each stage
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "bytes": 0})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        tracing = tracemalloc.is_tracing()
+        allocated = tracemalloc.get_traced_memory()[0] if tracing else 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages[name]
+            stage["calls"] += 1
+            stage["seconds"] += time.perf_counter() - start
+            if tracing:
+                stage["bytes"] += max(tracemalloc.get_traced_memory()[0] - allocated, 0)
+
+    def wrap(self, owner, attribute, name):
+        original = getattr(owner, attribute)
+
+        @functools.wraps(original)
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                return original(*args, **kwargs)
+
+        setattr(owner, attribute, wrapped)
+
+    def reset(self):
+        self.stages.clear()
+
+
+def use_settings(settings):
+    """
+    Override settings, before the modules that read them are imported
+    """
+    import config
+
+    get_setting = config.get_setting
+
+    def get_benchmark_setting(key, default=None):
+        return settings[key] if key in settings else get_setting(key, default)
+
+    config.get_setting = get_benchmark_setting
+
+
+def setup(profiler, args):
+    """
+    Put the fakes in the resource registry and instrument each stage,
+    before the agent module builds anything
+    """
+    use_settings(SETTINGS)
+
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_core.vectorstores import InMemoryVectorStore
+
+    from prompt_budget import PromptBudget
+    from resources import get_registry
+    from tools.cypher_chain import MovieCypherQAChain
+    from tools.cypher_guard import CypherGuard
+    from tools.entity_index import EntityIndex
+
+    llm = ScriptedChatModel(latency=args.latency)
+    embeddings = create_embeddings()
+    graph = FakeGraph()
+
+    registry = get_registry()
+    registry.provide("llm", llm)
+    registry.provide("embeddings", embeddings)
+    registry.provide("graph", graph)
+    registry.provide("async_graph", None)
+    registry.provide("neo4jvector", create_vector_store(embeddings))
+
+    if args.router:
+        from router import Router
+        registry.provide("router", Router(embeddings))
+
+    if args.semantic_cache:
+        from semantic_cache import SemanticCache
+        registry.provide("semantic_cache", SemanticCache(embeddings))
+
+    profiler.wrap(ScriptedChatModel, "_generate", "llm")
+    profiler.wrap(DeterministicFakeEmbedding, "embed_query", "embedding")
+    profiler.wrap(DeterministicFakeEmbedding, "embed_documents", "embedding")
+    profiler.wrap(InMemoryVectorStore, "similarity_search", "retrieval")
+    profiler.wrap(EntityIndex, "canonicalize", "entity resolution")
+    profiler.wrap(MovieCypherQAChain, "generate_cypher", "cypher generation")
+    profiler.wrap(CypherGuard, "check", "cypher guard")
+    profiler.wrap(MovieCypherQAChain, "run_cypher", "cypher execution")
+    profiler.wrap(MovieCypherQAChain, "answer", "answer synthesis")
+    profiler.wrap(PromptBudget, "trim", "prompt budget")
+
+    import agent
+
+    profiler.wrap(agent, "lookup_cached_response", "semantic cache")
+    profiler.wrap(agent, "route_response", "routing")
+
+    return agent, llm, graph
+
+
+def reset_caches(agent):
+    """
+    Start each pass cold, so repeated questions only hit the caches
+    within a pass
+    """
+    from tools import cypher
+
+    cypher.cypher_cache.clear()
+    cypher.plan_cache._shapes.clear()
+    if cypher.cypher_guard is not None:
+        cypher.cypher_guard.verdicts.clear()
+    if agent.semantic_cache is not None:
+        agent.semantic_cache.clear()
+
+
+def replay(agent, profiler, runs, label):
+    reset_caches(agent)
+
+    # The agent and chains are verbose, keep their output out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for run in range(runs):
+            for i, question in enumerate(QUESTIONS):
+                with profiler.stage("total"):
+                    agent.generate_response(question, session_id=f"benchmark-{label}-{run}-{i}")
+
+        agent.history_writer.flush()
+
+
+def options(args):
+    """
+    The options a result was measured with.  Results are only comparable
+    with a baseline measured with the same ones, as the caches warm up
+    over the runs.
+    """
+    return {
+        "runs": args.runs,
+        "latency": args.latency,
+        "router": args.router,
+        "semantic_cache": args.semantic_cache,
+    }
+
+
+def measure(agent, profiler, llm, graph, runs):
+    """
+    Time one pass over the corpus and trace the allocations of another
+    """
+    replay(agent, profiler, 1, "warmup")
+
+    profiler.reset()
+    llm.calls.clear()
+    graph.calls.clear()
+
+    # A garbage collection is charged to whichever stage triggers it, which
+    # moves with every change in allocations, so leave it out of the timings
+    gc.collect()
+    gc.disable()
+    try:
+        replay(agent, profiler, runs, "timing")
+    finally:
+        gc.enable()
+    timings = {name: dict(stage) for name, stage in profiler.stages.items()}
+    llm_calls, graph_calls = Counter(llm.calls), Counter(graph.calls)
+
+    profiler.reset()
+    tracemalloc.start()
+    replay(agent, profiler, runs, "allocations")
+    tracemalloc.stop()
+
+    questions = runs * len(QUESTIONS)
+    return {
+        "questions": questions,
+        "stages": {
+            name: {
+                "calls": stage["calls"] / questions,
+                "ms": stage["seconds"] * 1000 / questions,
+                "kb": profiler.stages[name]["bytes"] / 1024 / questions,
+            }
+            for name, stage in sorted(timings.items())
+        },
+        "llm_calls": {kind: count / questions for kind, count in sorted(llm_calls.items())},
+        "graph_calls": {kind: count / questions for kind, count in sorted(graph_calls.items())},
+    }
+
+
+def compare(result, baseline, tolerance, min_ms):
+    """
+    Return the stages that make more calls, or take or allocate more than
+    the tolerance above the baseline.
+
+    Times are compared as shares of the total time per question, so a
+    baseline measured on other hardware still applies, and a stage must
+    also be min_ms slower, as sub-millisecond stages are noisy.  Use
+    --save-baseline to measure the total on this machine.
+    """
+    regressions = []
+    total, total_before = result["stages"]["total"]["ms"], baseline["stages"]["total"]["ms"]
+    speed = total / total_before if total_before else 1.0
+
+    for name, stage in result["stages"].items():
+        before = baseline["stages"].get(name)
+        if before is None:
+            regressions.append(f"{name}: not in the baseline, save a new one")
+            continue
+        if stage["calls"] > before["calls"] + 1e-9:
+            regressions.append(f"{name}: {stage['calls']:.2f} calls per question, was {before['calls']:.2f}")
+        if name != "total" and stage["ms"] > before["ms"] * speed * (1 + tolerance) + min_ms:
+            regressions.append(
+                f"{name}: {stage['ms'] / total:.1%} of the time per question, was {before['ms'] / total_before:.1%}"
+            )
+        if stage["kb"] > before["kb"] * (1 + tolerance) + 1:
+            regressions.append(f"{name}: {stage['kb']:.1f} KB per question, was {before['kb']:.1f}")
+
+    for kind, calls in result["llm_calls"].items():
+        if calls > baseline["llm_calls"].get(kind, 0) + 1e-9:
+            regressions.append(f"llm {kind}: {calls:.2f} calls per question, was {baseline['llm_calls'].get(kind, 0):.2f}")
+
+    return regressions
+
+
+def report(result, baseline):
+    print(f"{result['questions']} questions\n")
+    print(f"{'stage':<20}{'calls':>8}{'ms':>10}{'KB':>10}{'baseline ms':>14}{'change':>9}")
+
+    for name, stage in result["stages"].items():
+        before = (baseline or {}).get("stages", {}).get(name)
+        change = f"{(stage['ms'] / before['ms'] - 1) * 100:+.0f}%" if before and before["ms"] else ""
+        print(
+            f"{name:<20}{stage['calls']:>8.2f}{stage['ms']:>10.2f}{stage['kb']:>10.1f}"
+            f"{before['ms'] if before else float('nan'):>14.2f}{change:>9}"
+        )
+
+    print("\nLLM calls per question: " + ", ".join(f"{kind} {calls:.2f}" for kind, calls in result["llm_calls"].items()))
+    print("Graph calls per question: " + ", ".join(f"{kind} {calls:.2f}" for kind, calls in result["graph_calls"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every LLM call")
+    parser.add_argument("--router", action="store_true", help="route obvious questions straight to a tool")
+    parser.add_argument("--semantic-cache", action="store_true", help="serve repeated questions from the cache")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown, 0.5 is 50%%")
+    parser.add_argument("--min-ms", type=float, default=0.5, help="slowdown per question always allowed")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    profiler = Profiler()
+    agent, llm, graph = setup(profiler, args)
+    result = measure(agent, profiler, llm, graph, args.runs)
+    result["options"] = options(args)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    report(result, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nSaved the baseline to {args.baseline}")
+        return
+
+    if baseline is not None:
+        if baseline.get("options") != result["options"]:
+            print(
+                f"\nThe baseline was measured with {baseline.get('options')}, not {result['options']}. "
+                "Run with the same options, or save a baseline for these."
+            )
+            sys.exit(2)
+
+        regressions = compare(result, baseline, args.tolerance, args.min_ms)
+        if regressions:
+            print("\nRegressions against the baseline:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
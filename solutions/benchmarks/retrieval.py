@@ -0,0 +1,73 @@
+"""
+Compare the live and materialized moviePlots retrieval queries.
+
+Run from the repository root, with .streamlit/secrets.toml in place:
+
+    python solutions/benchmarks/retrieval.py --runs 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph import graph
+from llm import embeddings
+from tools.movie_metadata import materialized_retrieval_query, refresh_movie_metadata
+from tools.vector import VECTOR_SEARCH_QUERY, create_vector
+
+QUESTIONS = [
+    "Aliens land on earth",
+    "A toy cowboy is jealous of a new space ranger toy",
+    "A boxer gets a shot at the heavyweight title",
+    "A hacker discovers reality is a simulation",
+    "A shark terrorises a beach town",
+]
+
+def measure(query, vectors, k, runs):
+    timings = []
+    context = []
+
+    for _ in range(runs):
+        for vector in vectors:
+            start = time.perf_counter()
+            results = graph.query(query, {"index": "moviePlots", "k": k, "embedding": vector})
+            timings.append((time.perf_counter() - start) * 1000)
+            context.append(sum(len(str(result["metadata"])) for result in results))
+
+    timings.sort()
+    return {
+        "median_ms": statistics.median(timings),
+        "p95_ms": timings[int(len(timings) * 0.95) - 1],
+        # Roughly four characters to a token
+        "context_tokens": statistics.mean(context) / 4,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--max-actors", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"Refreshed metadata for {refresh_movie_metadata(graph)} movies")
+
+    vectors = embeddings.embed_documents(QUESTIONS)
+    queries = {
+        "live": VECTOR_SEARCH_QUERY + create_vector().retrieval_query,
+        "materialized": VECTOR_SEARCH_QUERY + materialized_retrieval_query(args.max_actors),
+    }
+
+    # Warm up the page cache and query plans before measuring
+    for query in queries.values():
+        measure(query, vectors, args.k, 1)
+
+    print(f"{'mode':<14}{'median ms':>12}{'p95 ms':>12}{'context tokens':>16}")
+    for mode, query in queries.items():
+        result = measure(query, vectors, args.k, args.runs)
+        print(f"{mode:<14}{result['median_ms']:>12.2f}{result['p95_ms']:>12.2f}{result['context_tokens']:>16.0f}")
+
+if __name__ == "__main__":
+    main()
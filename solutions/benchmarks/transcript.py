@@ -0,0 +1,103 @@
+"""
+Measure how long a rerun of the chat takes as the conversation grows.
+
+Runs a page that draws a transcript of N messages with Streamlit's
+AppTest, either in full, as bot.py used to, or with write_transcript,
+which draws only the last window of messages.  Reports the median and
+p95 rerun time and the number of messages drawn for each length.  Run
+from the repository root, no secrets or network needed:
+
+    python solutions/benchmarks/transcript.py --runs 10
+    python solutions/benchmarks/transcript.py --lengths 10 100 1000 --window 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+SOLUTIONS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SOLUTIONS)
+
+import streamlit.config
+import streamlit.logger
+from streamlit.testing.v1 import AppTest
+
+# Read the config before the first AppTest, so bare mode is quiet
+streamlit.config.get_config_options()
+streamlit.logger.set_log_level("error")
+
+def transcript_page(solutions, length, renderer, window, page_size):
+    """
+    The page under test, run by AppTest as a script of its own
+    """
+    import sys
+
+    import streamlit as st
+
+    sys.path.insert(0, solutions)
+    from utils import write_message, write_transcript
+
+    if "messages" not in st.session_state:
+        answer = (
+            "Jaws was directed by **Steven Spielberg** in 1975.  It stars Roy Scheider, "
+            "Robert Shaw and Richard Dreyfuss.\n\n- Thriller\n- Adventure\n- Horror"
+        )
+        st.session_state.messages = [
+            {"role": "user", "content": f"Question {i // 2}: who directed Jaws?"} if i % 2 == 0
+            else {"role": "assistant", "content": answer}
+            for i in range(length)
+        ]
+
+    if renderer == "full":
+        for message in st.session_state.messages:
+            write_message(message['role'], message['content'], save=False)
+    else:
+        write_transcript(st.session_state.messages, window=window, page_size=page_size)
+
+
+def measure(length, renderer, window, page_size, runs):
+    app = AppTest.from_function(
+        transcript_page,
+        args=(SOLUTIONS, length, renderer, window, page_size),
+        default_timeout=60,
+    )
+    app.run()
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        app.run()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    if app.exception:
+        raise RuntimeError(app.exception[0].message)
+
+    timings.sort()
+    return {
+        "median": statistics.median(timings),
+        "p95": timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+        "drawn": len(app.chat_message),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[10, 50, 100, 250, 500, 1000])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--window", type=int, default=20)
+    parser.add_argument("--page-size", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'messages':>8}  {'renderer':<10} {'drawn':>6} {'median ms':>10} {'p95 ms':>8}")
+    for length in args.lengths:
+        for renderer in ("full", "windowed"):
+            result = measure(length, renderer, args.window, args.page_size, args.runs)
+            print(
+                f"{length:>8}  {renderer:<10} {result['drawn']:>6} "
+                f"{result['median']:>10.1f} {result['p95']:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,26 @@
 import streamlit as st
-from utils import write_message
-# tag::import_agent[]
-from agent import generate_response
-# end::import_agent[]
+from utils import write_message, write_trace, write_transcript, get_session_id
+import aio
+from config import get_setting
+from resources import get_registry
+
+# Hand turns to the agent service if there is one, see service.py,
+# rather than building the agent in this process
+AGENT_SERVICE_URL = get_setting("AGENT_SERVICE_URL", None)
+
+if AGENT_SERVICE_URL:
+    from client import AgentClient
+
+    agent_client = get_registry().register(
+        "agent_client",
+        lambda: AgentClient(AGENT_SERVICE_URL, timeout=get_setting("AGENT_SERVICE_TIMEOUT", 120)),
+    ).get("agent_client")
+else:
+    agent_client = None
+
+    # tag::import_agent[]
+    from agent import generate_response, agenerate_response, stream_response
+    # end::import_agent[]
 
 # tag::setup[]
 # Page Config
@@ -27,19 +45,39 @@ def handle_submit(message):
     context using data from Neo4j.
     """
 
+    # Ask the agent service
+    if agent_client is not None:
+        if get_setting("STREAM_RESPONSES", False):
+            write_message('assistant', agent_client.stream(message, get_session_id()))
+        else:
+            with st.spinner('Thinking...'):
+                write_message('assistant', agent_client.generate(message, get_session_id()))
+        return
+
+    # Stream the Final Answer as it is generated
+    if get_setting("STREAM_RESPONSES", False):
+        write_message('assistant', stream_response(message))
+        return
+
     # Handle the response
     with st.spinner('Thinking...'):
         # Call the agent
-        response = generate_response(message)
+        if get_setting("ASYNC_AGENT", False):
+            response = aio.run(agenerate_response(message, get_session_id()))
+        else:
+            response = generate_response(message)
         write_message('assistant', response)
         
 # end::submit[]
 
 
 # tag::chat[]
-# Display messages in Session State
-for message in st.session_state.messages:
-    write_message(message['role'], message['content'], save=False)
+# Display messages in Session State, the most recent in full
+write_transcript(
+    st.session_state.messages,
+    window=get_setting("TRANSCRIPT_WINDOW", 20),
+    page_size=get_setting("TRANSCRIPT_PAGE_SIZE", 20),
+)
 
 # Handle any user input
 if prompt := st.chat_input("What is up?"):
@@ -49,3 +87,17 @@ if prompt := st.chat_input("What is up?"):
     # Generate a response
     handle_submit(prompt)
 # end::chat[]
+
+# Show where the time of the last turn went, unless the turns are
+# answered by the agent service
+if get_setting("TRACE_PANEL", False) and agent_client is None:
+    from agent import tracer
+    from graph import pool_monitor
+
+    write_trace(tracer.last(get_session_id()) if tracer is not None else None)
+
+    # And how long each tool waited for a Neo4j connection
+    pool = pool_monitor.stats()
+    st.sidebar.subheader("Connection pool")
+    st.sidebar.dataframe(pool["pools"], hide_index=True)
+    st.sidebar.dataframe([{"scope": name, **stats} for name, stats in pool["scopes"].items()], hide_index=True)
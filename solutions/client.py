@@ -0,0 +1,68 @@
+import json
+
+import requests
+
+class AgentServiceError(Exception):
+    pass
+
+
+def error_message(response):
+    """
+    The error the service sent, or the body of a response that is not
+    one of its JSON errors, eg. from a proxy in front of it
+    """
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    if isinstance(body, dict) and "error" in body:
+        return body["error"]
+    return response.text or f"HTTP {response.status_code}"
+
+
+class AgentClient:
+    """
+    Talks to the agent service in service.py, so the Streamlit app can
+    answer questions without building the agent itself
+    """
+
+    def __init__(self, url, timeout=120):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def generate(self, user_input, session_id):
+        response = self.session.post(
+            f"{self.url}/generate",
+            json={"input": user_input, "session_id": session_id},
+            timeout=self.timeout,
+        )
+        if not response.ok:
+            raise AgentServiceError(error_message(response))
+        return response.json()["output"]
+
+    def stream(self, user_input, session_id):
+        """
+        Yield the tokens of the answer as the service sends them
+        """
+        with self.session.post(
+            f"{self.url}/stream",
+            json={"input": user_input, "session_id": session_id},
+            timeout=self.timeout,
+            stream=True,
+        ) as response:
+            if not response.ok:
+                raise AgentServiceError(error_message(response))
+
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if event == "token":
+                        yield data["token"]
+                    elif event == "error":
+                        raise AgentServiceError(data["error"])
+                    elif event == "done":
+                        return
@@ -0,0 +1,11 @@
+import streamlit as st
+
+def get_setting(key, default=None):
+    """
+    Read an optional setting from secrets.toml, falling back to
+    the default when the key or the secrets file is missing
+    """
+    try:
+        return st.secrets.get(key, default)
+    except FileNotFoundError:
+        return default
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with a persistent SQLite cache.
+
+    Vectors are stored as float32 blobs keyed by the model name and a hash
+    of the text, so they survive restarts and are shared by every session
+    in the process.  Only texts that are not in the cache are sent to the
+    underlying model.
+    """
+
+    def __init__(self, embeddings, path, model=None):
+        self.embeddings = embeddings
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _load(self, keys):
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch,
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def _save(self, items):
+        """
+        Store the vectors, returning them rounded to float32 so fresh
+        and cached results are identical
+        """
+        items = [(key, np.asarray(vector, dtype=np.float32)) for key, vector in items]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for key, vector in items],
+            )
+        return [(key, vector.tolist()) for key, vector in items]
+
+    def _lookup(self, texts):
+        """
+        Return the cache keys for the texts, the cached vectors, and
+        the (key, text) pairs that still need to be embedded
+        """
+        keys = [self.key(text) for text in texts]
+        vectors = self._load(list(set(keys)))
+
+        missing = list({key: text for key, text in zip(keys, texts) if key not in vectors}.items())
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        return keys, vectors, missing
+
+    def embed_documents(self, texts):
+        keys, vectors, missing = self._lookup(texts)
+
+        if missing:
+            computed = self.embeddings.embed_documents([text for _, text in missing])
+            vectors.update(self._save([(key, vector) for (key, _), vector in zip(missing, computed)]))
+
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text):
+        keys, vectors, missing = self._lookup([text])
+
+        if missing:
+            vectors.update(self._save([(keys[0], self.embeddings.embed_query(text))]))
+
+        return vectors[keys[0]]
+
+    # SQLite blocks, so the async methods read and write it in a thread
+    # rather than on the event loop
+
+    async def aembed_documents(self, texts):
+        keys, vectors, missing = await asyncio.to_thread(self._lookup, texts)
+
+        if missing:
+            computed = await self.embeddings.aembed_documents([text for _, text in missing])
+            vectors.update(await asyncio.to_thread(
+                self._save, [(key, vector) for (key, _), vector in zip(missing, computed)]
+            ))
+
+        return [vectors[key] for key in keys]
+
+    async def aembed_query(self, text):
+        keys, vectors, missing = await asyncio.to_thread(self._lookup, [text])
+
+        if missing:
+            vector = await self.embeddings.aembed_query(text)
+            vectors.update(await asyncio.to_thread(self._save, [(keys[0], vector)]))
+
+        return vectors[keys[0]]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        with self._lock:
+            size = self._conn.execute("SELECT count(*) FROM embeddings").fetchone()[0]
+        return {
+            "size": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,12 +1,90 @@
 import streamlit as st
+from config import get_setting
+from pool import PoolMonitor, awarm_up, driver_config, warm_up
+from resources import get_registry
+from schema_snapshot import load_schema
+
+# Both drivers share these pool settings
+def create_driver_config():
+    return driver_config(
+        max_pool_size=get_setting("NEO4J_MAX_CONNECTION_POOL_SIZE", 100),
+        acquisition_timeout=get_setting("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", 60.0),
+        max_lifetime=get_setting("NEO4J_MAX_CONNECTION_LIFETIME", 3600.0),
+    )
 
 # tag::graph[]
 from langchain_neo4j import Neo4jGraph
 
-graph = Neo4jGraph(
-    url=st.secrets["NEO4J_URI"],
-    username=st.secrets["NEO4J_USERNAME"],
-    password=st.secrets["NEO4J_PASSWORD"],
-    database=st.secrets["NEO4J_DATABASE"],
+def create_graph():
+    return Neo4jGraph(
+        url=st.secrets["NEO4J_URI"],
+        username=st.secrets["NEO4J_USERNAME"],
+        password=st.secrets["NEO4J_PASSWORD"],
+        database=st.secrets["NEO4J_DATABASE"],
+        refresh_schema=False,
+        driver_config=create_driver_config(),
+    )
+#end::graph[]
+
+# Connections acquired, and the time waited for them, by each tool
+registry = get_registry()
+pool_monitor = registry.register("pool_monitor", PoolMonitor).get("pool_monitor")
+
+def create_graph_with_schema():
+    graph = create_graph()
+    pool_monitor.instrument(graph._driver)
+    warm_up(graph._driver, graph._database, get_setting("NEO4J_POOL_WARMUP", 0))
+
+    # Load the schema from a local snapshot unless the database schema has changed
+    load_schema(graph, get_setting("SCHEMA_SNAPSHOT_PATH", ".cache/schema.json"))
+
+    return graph
+
+# Share a single driver, and its connection pool, across every session
+registry.register(
+    "graph",
+    create_graph_with_schema,
+    health_check=lambda graph: graph._driver.verify_connectivity(),
+    teardown=lambda graph: graph._driver.close(),
 )
-#end::graph[]
\ No newline at end of file
+
+graph = registry.get("graph")
+
+# The async driver used by the async request path, see aio.py.  It only
+# connects, and warms up its pool, once that path first queries Neo4j.
+import asyncio
+import aio
+from async_graph import AsyncGraph
+
+warming_up = set()
+
+def connect_async_driver(driver):
+    pool_monitor.instrument(driver)
+    # Called on the process loop, so the warm up runs alongside the query
+    task = asyncio.ensure_future(
+        awarm_up(driver, st.secrets["NEO4J_DATABASE"], get_setting("NEO4J_POOL_WARMUP", 0))
+    )
+    warming_up.add(task)
+    task.add_done_callback(warming_up.discard)
+
+def create_async_graph():
+    return AsyncGraph(
+        url=st.secrets["NEO4J_URI"],
+        username=st.secrets["NEO4J_USERNAME"],
+        password=st.secrets["NEO4J_PASSWORD"],
+        database=st.secrets["NEO4J_DATABASE"],
+        driver_config=create_driver_config(),
+        on_connect=connect_async_driver,
+    )
+
+def close_async_graph(async_graph):
+    if async_graph.connected:
+        aio.run(async_graph.close())
+
+registry.register(
+    "async_graph",
+    create_async_graph,
+    teardown=close_async_graph,
+)
+
+async_graph = registry.get("async_graph")
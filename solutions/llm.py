@@ -1,20 +1,93 @@
+import os
+
 import streamlit as st
+from config import get_setting
+from resources import get_registry
+
+# Every OpenAI request, from any chain, tool or background job, is
+# admitted by one scheduler that models the account's rate limits.  Each
+# process calling OpenAI, eg. each worker of the agent service, gets an
+# equal share of them.
+def openai_processes():
+    default = get_setting("AGENT_WORKERS", os.cpu_count() or 1) if get_setting("AGENT_SERVICE_URL") else 1
+    return max(int(get_setting("OPENAI_PROCESSES", default)), 1)
+
+def create_scheduler():
+    if not get_setting("OPENAI_SCHEDULER", False):
+        return None
+
+    from scheduler import OpenAIScheduler
+
+    return OpenAIScheduler(
+        requests_per_minute=get_setting("OPENAI_RPM", 500),
+        tokens_per_minute=get_setting("OPENAI_TPM", 30000),
+        max_in_flight=get_setting("OPENAI_MAX_IN_FLIGHT", 16),
+        share=1 / openai_processes(),
+    )
+
+registry = get_registry()
+openai_scheduler = registry.register("openai_scheduler", create_scheduler).get("openai_scheduler")
+
+def http_clients():
+    """
+    The HTTP clients that send OpenAI requests through the scheduler
+    """
+    if openai_scheduler is None:
+        return {}
+
+    from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+    from scheduler import AsyncSchedulingTransport, SchedulingTransport
+
+    return {
+        "http_client": DefaultHttpxClient(transport=SchedulingTransport(openai_scheduler)),
+        "http_async_client": DefaultAsyncHttpxClient(transport=AsyncSchedulingTransport(openai_scheduler)),
+    }
 
 # tag::llm[]
 # Create the LLM
 from langchain_openai import ChatOpenAI
 
-llm = ChatOpenAI(
-    openai_api_key=st.secrets["OPENAI_API_KEY"],
-    model=st.secrets["OPENAI_MODEL"],
-)
+def create_llm():
+    return ChatOpenAI(
+        openai_api_key=st.secrets["OPENAI_API_KEY"],
+        model=st.secrets["OPENAI_MODEL"],
+        **http_clients(),
+    )
 # end::llm[]
 
 # tag::embedding[]
 # Create the Embedding model
 from langchain_openai import OpenAIEmbeddings
 
-embeddings = OpenAIEmbeddings(
-    openai_api_key=st.secrets["OPENAI_API_KEY"]
-)
+def create_embeddings():
+    return OpenAIEmbeddings(
+        openai_api_key=st.secrets["OPENAI_API_KEY"],
+        **http_clients(),
+    )
 # end::embedding[]
+
+def create_cached_embeddings():
+    embeddings = create_embeddings()
+
+    # Cache embeddings on disk so repeated queries skip the API call
+    path = get_setting("EMBEDDING_CACHE_PATH", None)
+    if path:
+        from embedding_cache import CachedEmbeddings
+
+        embeddings = CachedEmbeddings(embeddings, path=path)
+
+    # Record each call in the trace of the turn, see tracing.py
+    from tracing import TracedEmbeddings
+
+    return TracedEmbeddings(embeddings)
+
+# Share one instance of each across every session
+registry.register("llm", create_llm)
+registry.register(
+    "embeddings",
+    create_cached_embeddings,
+    teardown=lambda embeddings: getattr(embeddings, "close", lambda: None)(),
+)
+
+llm = registry.get("llm")
+embeddings = registry.get("embeddings")
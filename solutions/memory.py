@@ -0,0 +1,401 @@
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import SystemMessage, get_buffer_string, messages_from_dict
+from langchain_core.prompts import PromptTemplate
+from langchain_neo4j import Neo4jChatMessageHistory
+
+from pool import pool_scope
+from scheduler import BACKGROUND, lane
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = PromptTemplate.from_template("""
+Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary.
+Keep the movies, actors and directors that were discussed.
+Keep the summary under 150 words.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:
+""")
+
+# Summaries are written in the background, one at a time
+summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+summarizing = set()
+summarizing_lock = threading.Lock()
+
+# Sessions written before messageCount was kept have their messages
+# counted once, on their next write
+WRITE_MESSAGES_QUERY = """
+MERGE (s:`{node_label}` {{id: $session_id}})
+WITH s
+OPTIONAL MATCH (s)-[lm:LAST_MESSAGE]->(last_message)
+WITH s, lm, last_message, CASE
+    WHEN s.messageCount IS NOT NULL THEN s.messageCount
+    WHEN last_message IS NULL THEN 0
+    ELSE COUNT {{ (last_message)<-[:NEXT*0..]-() }}
+END AS count
+DELETE lm
+WITH s, last_message, count
+UNWIND range(0, size($messages) - 1) AS i
+CREATE (new:Message {{type: $messages[i].type, content: $messages[i].content, id: $messages[i].id}})
+WITH s, last_message, count, i, new ORDER BY i
+WITH s, last_message, count, collect(new) AS messages
+WITH s, last_message, count, messages, messages[0] AS first, messages[-1] AS latest
+FOREACH (previous IN CASE WHEN last_message IS NULL THEN [] ELSE [last_message] END |
+    CREATE (previous)-[:NEXT]->(first))
+FOREACH (i IN range(0, size(messages) - 2) |
+    FOREACH (a IN [messages[i]] | FOREACH (b IN [messages[i + 1]] | CREATE (a)-[:NEXT]->(b))))
+CREATE (s)-[:LAST_MESSAGE]->(latest)
+SET s.messageCount = count + size(messages)
+"""
+
+def write_messages(tx, node_label, session_id, messages):
+    """
+    Append messages to the end of a session's linked list of messages
+    with a single UNWIND statement
+    """
+    if not messages:
+        return
+
+    tx.run(
+        WRITE_MESSAGES_QUERY.format(node_label=node_label),
+        session_id=session_id,
+        messages=[{"type": message.type, "content": message.content, "id": message.id} for message in messages],
+    ).consume()
+
+
+class HistoryWriter:
+    """
+    Write-behind store for chat messages.
+
+    Messages are buffered in memory and the buffers of every session are
+    flushed to Neo4j together, in one transaction, either on a timer or
+    as soon as a turn completes when interval is 0.  With durable=True
+    each turn is written before add_messages returns instead.
+
+    Each message is given an id, written with it, so a reader can drop
+    the pending messages it has already read from Neo4j.
+    """
+
+    def __init__(self, driver, database, interval=1.0, durable=False, retry_delay=1.0, max_retry_delay=30.0):
+        self._driver = driver
+        self._database = database
+        self.interval = interval
+        self.durable = durable
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._buffers = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+
+        self.flushes = 0
+        self.written = 0
+        self.failures = 0
+
+        self._thread = None
+        if not durable:
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def add(self, history, messages):
+        messages = [
+            message if message.id else message.model_copy(update={"id": str(uuid.uuid4())})
+            for message in messages
+        ]
+
+        if self.durable:
+            batch = {history._session_id: (history, list(messages))}
+            self._write(batch)
+            self._committed(batch)
+            return
+
+        with self._lock:
+            _, buffered = self._buffers.get(history._session_id, (None, []))
+            self._buffers[history._session_id] = (history, buffered + list(messages))
+
+        if not self.interval:
+            self._wake.set()
+
+    def pending(self, session_id):
+        """
+        Messages not yet committed, including any being written right now
+        """
+        with self._lock:
+            return (
+                list(self._flushing.get(session_id, (None, []))[1])
+                + list(self._buffers.get(session_id, (None, []))[1])
+            )
+
+    def flush(self):
+        """
+        Write everything buffered.  Returns False if the write failed and
+        the messages were put back to be retried.
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            batch, self._buffers = self._buffers, {}
+            self._flushing = batch
+
+        if not batch:
+            return True
+
+        try:
+            self._write(batch)
+        except Exception:
+            logger.exception("Failed to write chat history, will retry")
+
+            # Put the messages back in front of anything added since, in
+            # the same step as they stop being in flight, so pending()
+            # never sees them twice
+            with self._lock:
+                for session_id, (history, messages) in batch.items():
+                    _, newer = self._buffers.get(session_id, (None, []))
+                    self._buffers[session_id] = (history, messages + newer)
+                self._flushing = {}
+                self.failures += 1
+            return False
+
+        self._committed(batch)
+        return True
+
+    def _committed(self, batch):
+        # A reader may still see the batch in Neo4j and as pending until
+        # here, and drops the copies by id
+        with self._lock:
+            if self._flushing is batch:
+                self._flushing = {}
+            self.flushes += 1
+            self.written += sum(len(messages) for _, messages in batch.values())
+
+        for history, _ in batch.values():
+            history.summarize_in_background()
+
+    def _write(self, batch):
+        def write_all(tx):
+            for session_id, (history, messages) in batch.items():
+                write_messages(tx, history._node_label, session_id, messages)
+
+        with pool_scope("history"), self._driver.session(database=self._database) as session:
+            session.execute_write(write_all)
+
+    def _run(self):
+        failures = 0
+        while not self._stopped:
+            timeout = self.interval or None
+            # Retry a failed write after a backoff, rather than waiting for
+            # the next turn when flushing on every turn
+            if failures:
+                timeout = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+            self._wake.wait(timeout)
+            self._wake.clear()
+            failures = 0 if self.flush() else failures + 1
+
+    def close(self):
+        """
+        Stop the background thread and write anything still buffered
+        """
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            buffered = sum(len(messages) for _, messages in self._buffers.values())
+        return {"buffered": buffered, "flushes": self.flushes, "written": self.written, "failures": self.failures}
+
+
+class SharedDriverChatMessageHistory(Neo4jChatMessageHistory):
+    """
+    Chat history that borrows the driver of the shared Neo4jGraph.
+
+    Neo4jChatMessageHistory closes its driver when it is garbage collected,
+    which would shut down the shared connection pool after every turn.
+    The driver is owned, and closed, by the resource registry instead.
+    """
+
+    def __del__(self):
+        pass
+
+
+class WindowedChatMessageHistory(SharedDriverChatMessageHistory):
+    """
+    Chat history that only reads the last `window` turns from Neo4j, plus
+    a rolling summary of everything older stored on the session node.
+
+    The summary is updated incrementally in the background once turns fall
+    out of the window, so the Neo4j read and the size of {chat_history}
+    stay constant however long the conversation runs.  Until the summary
+    catches up, up to summary_batch - 1 older messages are read with the
+    window, so none are left out of both.
+    """
+
+    def __init__(self, session_id, graph, window=3, summarizer=None, summary_batch=2, writer=None,
+                 node_label="Session"):
+        # The parent constructor merges the session node, so it is not
+        # called: the node is merged on the first write instead, rather
+        # than with an extra round trip every time the history is created
+        if not session_id:
+            raise ValueError("Please ensure that the session_id parameter is provided")
+
+        self._driver = graph._driver
+        self._database = graph._database
+        self._session_id = session_id
+        self._node_label = node_label
+        self._window = window
+        self._summarizer = summarizer
+        self._summary_batch = summary_batch
+        self._writer = writer
+
+        # The window, and the messages that may have left it but not yet
+        # been folded into the summary
+        self._fetch = window * 2 + (summary_batch - 1 if summarizer is not None else 0)
+
+    @property
+    def messages(self):
+        query = (
+            f"MATCH (s:`{self._node_label}` {{id: $session_id}}) "
+            "OPTIONAL MATCH (s)-[:LAST_MESSAGE]->(last_message) "
+            "OPTIONAL MATCH p=(last_message)<-[:NEXT*0.."
+            f"{max(self._fetch - 1, 0)}]-() "
+            "WITH s, p ORDER BY length(p) DESC LIMIT 1 "
+            "RETURN s.summary AS summary, s.messageCount AS count, "
+            "coalesce(s.summarizedCount, 0) AS summarized, "
+            "[node IN reverse(coalesce(nodes(p), [])) | "
+            "{data: {content: node.content, id: node.id}, type: node.type}] AS messages"
+        )
+        with pool_scope("history"):
+            records, _, _ = self._driver.execute_query(
+                query, {"session_id": self._session_id}, database_=self._database
+            )
+
+        messages = messages_from_dict(records[0]["messages"]) if records else []
+
+        # Include messages still waiting to be written, less any that were
+        # committed after all while this was reading
+        pending = []
+        if self._writer is not None:
+            read = {message.id for message in messages if message.id}
+            pending = [message for message in self._writer.pending(self._session_id) if message.id not in read]
+            messages = messages + pending
+
+        # Keep the window, and any older messages the summary does not
+        # cover yet.  A window of 0 keeps only those.
+        keep = self._window * 2
+        if self._summarizer is not None and records and records[0]["count"] is not None:
+            keep = max(keep, records[0]["count"] - records[0]["summarized"] + len(pending))
+        messages = messages[max(len(messages) - keep, 0):]
+
+        if records and records[0]["summary"]:
+            messages.insert(0, SystemMessage(
+                content=f"Summary of the earlier conversation: {records[0]['summary']}"
+            ))
+
+        return messages
+
+    def add_message(self, message):
+        self.add_messages([message])
+
+    def add_messages(self, messages):
+        """
+        Append the turn's messages in a single transaction, or hand them
+        to the write-behind writer if there is one
+        """
+        if self._writer is not None:
+            self._writer.add(self, messages)
+            return
+
+        with pool_scope("history"), self._driver.session(database=self._database) as session:
+            session.execute_write(write_messages, self._node_label, self._session_id, messages)
+
+        self.summarize_in_background()
+
+    def summarize_in_background(self):
+        if self._summarizer is None:
+            return
+
+        # Only one summary per session at a time
+        with summarizing_lock:
+            if self._session_id in summarizing:
+                return
+            summarizing.add(self._session_id)
+
+        summary_executor.submit(self._summarize_safely)
+
+    def _summarize_safely(self):
+        try:
+            # Summaries wait behind the questions being answered
+            with pool_scope("history"), lane(BACKGROUND):
+                self.summarize()
+        except Exception:
+            logger.exception("Failed to summarize session %s", self._session_id)
+        finally:
+            with summarizing_lock:
+                summarizing.discard(self._session_id)
+
+    def summarize(self):
+        """
+        Fold the messages that have left the window into the summary
+        """
+        records, _, _ = self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}` {{id: $session_id}}) "
+            "RETURN coalesce(s.messageCount, 0) AS count, "
+            "coalesce(s.summarizedCount, 0) AS summarized, s.summary AS summary",
+            {"session_id": self._session_id},
+            database_=self._database,
+        )
+        if not records:
+            return
+
+        count, summarized, summary = records[0]["count"], records[0]["summarized"], records[0]["summary"]
+        pending = count - self._window * 2 - summarized
+        if pending < self._summary_batch:
+            return
+
+        # Walk back over the window to the oldest unsummarised message
+        records, _, _ = self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}` {{id: $session_id}})-[:LAST_MESSAGE]->(last_message) "
+            f"MATCH p=(last_message)<-[:NEXT*{self._window * 2 + pending - 1}]-() "
+            "WITH p LIMIT 1 "
+            "RETURN [node IN reverse(nodes(p))[0..$pending] | "
+            "{data: {content: node.content}, type: node.type}] AS messages",
+            {"session_id": self._session_id, "pending": pending},
+            database_=self._database,
+        )
+        if not records:
+            return
+
+        summary = self._summarizer.invoke({
+            "summary": summary or "",
+            "new_lines": get_buffer_string(messages_from_dict(records[0]["messages"])),
+        })
+
+        # Only write if no other process summarised the same messages first
+        self._driver.execute_query(
+            f"MATCH (s:`{self._node_label}` {{id: $session_id}}) "
+            "WHERE coalesce(s.summarizedCount, 0) = $summarized "
+            "SET s.summary = $summary, s.summarizedCount = $summarized + $pending",
+            {
+                "session_id": self._session_id,
+                "summary": summary,
+                "summarized": summarized,
+                "pending": pending,
+            },
+            database_=self._database,
+        )
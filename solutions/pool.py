@@ -0,0 +1,222 @@
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# The part of the app acquiring connections, eg. the name of a tool
+current_scope = contextvars.ContextVar("pool_scope", default="other")
+
+def driver_config(max_pool_size=100, acquisition_timeout=60.0, max_lifetime=3600.0):
+    """
+    Connection pool settings for the Neo4j driver.  The defaults are the
+    driver's own.
+    """
+    return {
+        "max_connection_pool_size": max_pool_size,
+        "connection_acquisition_timeout": acquisition_timeout,
+        "max_connection_lifetime": max_lifetime,
+    }
+
+
+@contextmanager
+def pool_scope(name):
+    """
+    Count the connections acquired within the block under name
+    """
+    token = current_scope.set(name)
+    try:
+        yield
+    finally:
+        current_scope.reset(token)
+
+
+def scoped(name, func):
+    """
+    Wrap a function or coroutine function so the connections it acquires
+    are counted under name
+    """
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapped(*args, **kwargs):
+            with pool_scope(name):
+                return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with pool_scope(name):
+                return func(*args, **kwargs)
+
+    return wrapped
+
+
+def warm_up(driver, database, connections):
+    """
+    Open connections up front, so the first requests do not pay for the
+    TCP and Bolt handshakes.  Each session holds its connection in an open
+    transaction until all of them are open, then returns it to the pool.
+    """
+    sessions = []
+    try:
+        for _ in range(connections):
+            session = driver.session(database=database)
+            sessions.append(session)
+            session.begin_transaction()
+    except Exception:
+        logger.exception("Failed to open %d connections while warming up the pool", connections)
+    finally:
+        for session in sessions:
+            session.close()
+
+
+async def awarm_up(driver, database, connections):
+    sessions = []
+    try:
+        for _ in range(connections):
+            session = driver.session(database=database)
+            sessions.append(session)
+            await session.begin_transaction()
+    except Exception:
+        logger.exception("Failed to open %d connections while warming up the pool", connections)
+    finally:
+        for session in sessions:
+            await session.close()
+
+
+class PoolMonitor:
+    """
+    Measures how each scope uses the connection pools of the drivers it
+    instruments: connections acquired and in use, the time spent waiting
+    to acquire one, and acquisitions that timed out or failed.
+
+    The driver has no hooks for this, so instrument() wraps the acquire
+    and release methods of the driver's pool.
+    """
+
+    def __init__(self, maxlen=1000):
+        self.maxlen = maxlen
+        self.scopes = {}
+        self._pools = []
+        self._lock = threading.Lock()
+
+    def _scope(self, name):
+        if name not in self.scopes:
+            self.scopes[name] = {
+                "acquired": 0,
+                "in_use": 0,
+                "failures": 0,
+                "wait_seconds": 0.0,
+                "waits": deque(maxlen=self.maxlen),
+            }
+        return self.scopes[name]
+
+    def _acquired(self, connection, scope, start):
+        wait = time.perf_counter() - start
+        with self._lock:
+            stats = self._scope(scope)
+            stats["acquired"] += 1
+            stats["in_use"] += 1
+            stats["wait_seconds"] += wait
+            stats["waits"].append(wait)
+        connection.pool_scope = scope
+
+    def _failed(self, scope, start):
+        with self._lock:
+            stats = self._scope(scope)
+            stats["failures"] += 1
+            stats["waits"].append(time.perf_counter() - start)
+
+    def _released(self, connections):
+        with self._lock:
+            for connection in connections:
+                scope = getattr(connection, "pool_scope", None)
+                if scope is not None:
+                    self._scope(scope)["in_use"] -= 1
+                    connection.pool_scope = None
+
+    def instrument(self, driver):
+        pool = driver._pool
+        acquire, release, kill_and_release = pool.acquire, pool.release, pool.kill_and_release
+
+        if inspect.iscoroutinefunction(acquire):
+            async def timed_acquire(*args, **kwargs):
+                scope, start = current_scope.get(), time.perf_counter()
+                try:
+                    connection = await acquire(*args, **kwargs)
+                except Exception:
+                    self._failed(scope, start)
+                    raise
+                self._acquired(connection, scope, start)
+                return connection
+
+            async def counted_release(*connections):
+                self._released(connections)
+                return await release(*connections)
+
+            async def counted_kill_and_release(*connections):
+                self._released(connections)
+                return await kill_and_release(*connections)
+        else:
+            def timed_acquire(*args, **kwargs):
+                scope, start = current_scope.get(), time.perf_counter()
+                try:
+                    connection = acquire(*args, **kwargs)
+                except Exception:
+                    self._failed(scope, start)
+                    raise
+                self._acquired(connection, scope, start)
+                return connection
+
+            def counted_release(*connections):
+                self._released(connections)
+                return release(*connections)
+
+            def counted_kill_and_release(*connections):
+                self._released(connections)
+                return kill_and_release(*connections)
+
+        pool.acquire = timed_acquire
+        pool.release = counted_release
+        pool.kill_and_release = counted_kill_and_release
+
+        with self._lock:
+            self._pools.append(pool)
+
+        return driver
+
+    def pool_stats(self, pool):
+        """
+        Connections open in a pool, and how many of them are in use
+        """
+        # The async pool's lock can only be taken on the event loop, so
+        # read a snapshot without it
+        connections = [connection for address in list(pool.connections.values()) for connection in list(address)]
+        in_use = sum(1 for connection in connections if connection.in_use)
+
+        return {
+            "max_size": pool.pool_config.max_connection_pool_size,
+            "open": len(connections),
+            "in_use": in_use,
+            "idle": len(connections) - in_use,
+        }
+
+    def stats(self):
+        with self._lock:
+            pools = list(self._pools)
+            scopes = {}
+            for name, stats in self.scopes.items():
+                waits = sorted(stats["waits"])
+                scopes[name] = {
+                    "acquired": stats["acquired"],
+                    "in_use": stats["in_use"],
+                    "failures": stats["failures"],
+                    "mean_wait_ms": stats["wait_seconds"] * 1000 / stats["acquired"] if stats["acquired"] else 0.0,
+                    "p99_wait_ms": waits[min(int(len(waits) * 0.99), len(waits) - 1)] * 1000 if waits else 0.0,
+                }
+
+        return {"pools": [self.pool_stats(pool) for pool in pools], "scopes": scopes}
@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+
+from langchain.agents.format_scratchpad import format_log_to_str
+from langchain.tools.render import render_text_description
+from langchain_core.messages import SystemMessage
+
+from tokens import count_tokens, truncate_tokens
+
+TRIMMED_OBSERVATION = "[earlier observation removed to save space]"
+
+# Tokens each message adds to the prompt on top of its content
+MESSAGE_OVERHEAD = 4
+
+class PromptBudget:
+    """
+    Keeps each section of the ReAct prompt within a token budget.
+
+    trim() runs before every step of the agent: each tool observation is
+    cut to `observation` tokens, the oldest observations are then dropped
+    until the scratchpad fits `scratchpad` tokens, and the oldest messages
+    are dropped until the history fits `chat_history` tokens.  The rolling
+    summary at the start of the history is kept for as long as possible.
+    render_tools() caps the tool descriptions at `tools` tokens.
+
+    Trimming only depends on the inputs, so the same turn always produces
+    the same prompt.  The token count of every section is recorded for
+    each step in `records`.
+    """
+
+    def __init__(self, tools=500, chat_history=1500, scratchpad=3000, observation=1000,
+                 model="gpt-4", maxlen=1000):
+        self.budgets = {
+            "tools": tools,
+            "chat_history": chat_history,
+            "scratchpad": scratchpad,
+            "observation": observation,
+        }
+        self.model = model
+
+        self.records = deque(maxlen=maxlen)
+        self.trimmed = {section: 0 for section in self.budgets}
+        self._tools_tokens = 0
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        return count_tokens(text, self.model)
+
+    def count_messages(self, messages):
+        return sum(self.count(str(message.content)) + MESSAGE_OVERHEAD for message in messages)
+
+    def render_tools(self, tools):
+        """
+        Describe the tools for the prompt, shortening each description
+        evenly if together they are over budget
+        """
+        text = render_text_description(tools)
+
+        if self.count(text) > self.budgets["tools"]:
+            self.trimmed["tools"] += 1
+            share = max(self.budgets["tools"] // max(len(tools), 1) - 10, 10)
+            text = "\n".join(
+                f"{tool.name}: {truncate_tokens(tool.description, share, self.model)}"
+                for tool in tools
+            )
+
+        self._tools_tokens = self.count(text)
+        return text
+
+    def trim_history(self, messages):
+        messages = list(messages)
+        budget = self.budgets["chat_history"]
+        if self.count_messages(messages) <= budget:
+            return messages
+
+        self.trimmed["chat_history"] += 1
+
+        summary = messages[:1] if messages and isinstance(messages[0], SystemMessage) else []
+        recent = messages[len(summary):]
+
+        # Drop the oldest messages first
+        while recent and self.count_messages(summary + recent) > budget:
+            recent = recent[1:]
+
+        if self.count_messages(summary + recent) > budget and summary:
+            summary = [SystemMessage(content=truncate_tokens(
+                summary[0].content, budget - MESSAGE_OVERHEAD, self.model
+            ))]
+
+        return summary + recent
+
+    def trim_steps(self, steps):
+        trimmed = [
+            (action, truncate_tokens(str(result), self.budgets["observation"], self.model))
+            for action, result in steps
+        ]
+        if any(str(result) != text for (_, result), (_, text) in zip(steps, trimmed)):
+            self.trimmed["observation"] += 1
+        steps = trimmed
+
+        if self.count(format_log_to_str(steps)) <= self.budgets["scratchpad"]:
+            return steps
+
+        self.trimmed["scratchpad"] += 1
+
+        # Replace the oldest observations first, always keeping the latest
+        for i in range(len(steps) - 1):
+            steps[i] = (steps[i][0], TRIMMED_OBSERVATION)
+            if self.count(format_log_to_str(steps)) <= self.budgets["scratchpad"]:
+                break
+
+        return steps
+
+    def trim(self, inputs):
+        """
+        Fit the agent's inputs to the budget, before they are formatted
+        into the prompt
+        """
+        inputs = dict(inputs)
+        if "chat_history" in inputs:
+            inputs["chat_history"] = self.trim_history(inputs["chat_history"])
+        steps = inputs["intermediate_steps"] = self.trim_steps(inputs.get("intermediate_steps", []))
+
+        record = {
+            "tools": self._tools_tokens,
+            "chat_history": self.count_messages(inputs.get("chat_history", [])),
+            "scratchpad": self.count(format_log_to_str(inputs["intermediate_steps"])),
+            "observation": max((self.count(result) for _, result in steps), default=0),
+            "input": self.count(str(inputs.get("input", ""))),
+            "step": len(steps),
+        }
+        with self._lock:
+            self.records.append(record)
+
+        return inputs
+
+    def stats(self):
+        with self._lock:
+            records = list(self.records)
+
+        sections = ["tools", "chat_history", "scratchpad", "observation", "input"]
+        return {
+            "steps": len(records),
+            "last": records[-1] if records else None,
+            "max": {section: max((record[section] for record in records), default=0) for section in sections},
+            "budgets": dict(self.budgets),
+            "trimmed": dict(self.trimmed),
+        }
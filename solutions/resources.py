@@ -0,0 +1,155 @@
+import atexit
+import logging
+import threading
+import time
+
+import streamlit as st
+
+logger = logging.getLogger(__name__)
+
+class Resource:
+    """
+    A lazily constructed, process-wide resource
+    """
+
+    def __init__(self, name, factory, health_check=None, teardown=None):
+        self.name = name
+        self.factory = factory
+        self.health_check = health_check
+        self.teardown = teardown
+        self.value = None
+        self.built = False
+        self.build_seconds = None
+        self.lock = threading.Lock()
+
+
+class ResourceRegistry:
+    """
+    Holds the expensive objects the app shares between every Streamlit
+    session - the LLM client, the Neo4j driver, the vector store and the
+    agent.  Each resource is built once, on first use, under a lock so
+    concurrent sessions never build duplicates.
+    """
+
+    def __init__(self):
+        self._resources = {}
+        self._order = []
+        self._lock = threading.Lock()
+
+    def register(self, name, factory, health_check=None, teardown=None):
+        """
+        Register a factory for a resource.  Registering a name that
+        already exists keeps the existing resource and ignores the new
+        factory, so modules re-executed by a Streamlit hot reload keep
+        using the resource that was already built, and a resource
+        provided before its module is imported is not replaced.  Use
+        provide() to replace a resource.
+        """
+        with self._lock:
+            if name in self._resources:
+                logger.debug("%s is already registered, ignoring the new factory", name)
+            else:
+                self._resources[name] = Resource(name, factory, health_check, teardown)
+        return self
+
+    def provide(self, name, value, teardown=None):
+        """
+        Register an already constructed resource, replacing any existing one
+        """
+        resource = Resource(name, lambda: value, teardown=teardown)
+        resource.value = value
+        resource.built = True
+        resource.build_seconds = 0.0
+
+        with self._lock:
+            self._resources[name] = resource
+            if name in self._order:
+                self._order.remove(name)
+            self._order.append(name)
+
+    def get(self, name):
+        resource = self._resources[name]
+
+        if not resource.built:
+            with resource.lock:
+                if not resource.built:
+                    start = time.perf_counter()
+                    resource.value = resource.factory()
+                    resource.build_seconds = time.perf_counter() - start
+                    resource.built = True
+
+                    with self._lock:
+                        self._order.append(name)
+
+                    logger.info("Built %s in %.3fs", name, resource.build_seconds)
+
+        return resource.value
+
+    def health(self):
+        """
+        Run the health check of every built resource
+        """
+        report = {}
+
+        for name, resource in list(self._resources.items()):
+            if not resource.built:
+                continue
+
+            status = {"ok": True, "build_seconds": resource.build_seconds}
+            if resource.health_check is not None:
+                try:
+                    resource.health_check(resource.value)
+                except Exception as e:
+                    status.update(ok=False, error=str(e))
+
+            report[name] = status
+
+        return report
+
+    def stats(self):
+        return {
+            name: {"built": resource.built, "build_seconds": resource.build_seconds}
+            for name, resource in self._resources.items()
+        }
+
+    def discard(self, name):
+        """
+        Tear down a resource so it is rebuilt on the next get()
+        """
+        resource = self._resources.get(name)
+        if resource is None or not resource.built:
+            return
+
+        with resource.lock:
+            self._teardown(resource)
+            with self._lock:
+                self._order.remove(name)
+
+    def close(self):
+        """
+        Tear down every built resource, in reverse order of construction
+        """
+        for name in reversed(list(self._order)):
+            self._teardown(self._resources[name])
+        self._order.clear()
+
+    def _teardown(self, resource):
+        try:
+            if resource.teardown is not None:
+                resource.teardown(resource.value)
+        except Exception:
+            logger.exception("Failed to tear down %s", resource.name)
+        finally:
+            resource.value = None
+            resource.built = False
+
+
+@st.cache_resource
+def get_registry():
+    """
+    Return the process-wide registry.  st.cache_resource keeps the same
+    instance across reruns, sessions and hot reloads of other modules.
+    """
+    registry = ResourceRegistry()
+    atexit.register(registry.close)
+    return registry
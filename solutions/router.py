@@ -0,0 +1,182 @@
+import re
+import threading
+
+import numpy as np
+
+# Labelled example questions for each of the agent's tools
+EXAMPLES = {
+    "General Chat": [
+        "Hi, what can you help me with?",
+        "Hello!",
+        "What makes a good movie?",
+        "What is film noir?",
+        "Can you recommend a genre for a rainy day?",
+        "What is the difference between a sequel and a prequel?",
+        "Thanks for your help",
+    ],
+    "Movie Plot Search": [
+        "What is a good movie about aliens landing on earth?",
+        "Find me a film where a robot falls in love",
+        "Recommend a movie about a heist that goes wrong",
+        "Are there any movies about time travel?",
+        "I want to watch something about a haunted house",
+        "Which film has a plot about a boxer making a comeback?",
+        "Suggest a movie where toys come to life",
+    ],
+    "Movie information": [
+        "Who acted in The Matrix?",
+        "Who directed Toy Story?",
+        "What role did Tom Hanks play in Apollo 13?",
+        "How many movies has Keanu Reeves acted in?",
+        "When was Casino released?",
+        "How many degrees of separation are there between Tom Hanks and Kevin Bacon?",
+        "Which movies did Steven Spielberg direct?",
+    ],
+}
+
+# Cheap lexical rules that route a question without an embedding lookup.
+# The plot rule only matches plot wording, as "films in which" or "films
+# where" also start filmography questions.
+RULES = [
+    (re.compile(
+        r"\b(who (acted|starred|played|directed|wrote)|cast of|director of|"
+        r"directed by|starring|degrees of separation|how many (movies|films)|"
+        r"what year|released in|role did)\b",
+        re.IGNORECASE,
+    ), "Movie information"),
+    (re.compile(
+        r"\b((movies?|films?) (about|with a plot)|plot (about|where|of))\b",
+        re.IGNORECASE,
+    ), "Movie Plot Search"),
+]
+
+class Router:
+    """
+    Routes obvious questions straight to a tool, skipping the LLM calls
+    the ReAct agent spends choosing a tool and phrasing the Final Answer.
+
+    Lexical rules are tried first, then the question embedding is compared
+    with the centroid of each tool's labelled examples.  route() returns
+    None whenever it is not confident, so the agent handles the question.
+    """
+
+    # The agent spends one LLM call picking the tool and one writing the answer
+    LLM_CALLS_PER_ROUTE = 2
+
+    def __init__(self, embeddings, examples=EXAMPLES, rules=RULES, threshold=0.82, margin=0.03):
+        self.embeddings = embeddings
+        self.examples = examples
+        self.rules = rules
+        self.threshold = threshold
+        self.margin = margin
+
+        self._tools = list(examples)
+        self._centroids = None
+        self._lock = threading.Lock()
+
+        self.routed = {tool: 0 for tool in self._tools}
+        self.fallbacks = 0
+        self.accuracy = None
+
+    @property
+    def centroids(self):
+        """
+        Normalised mean embedding of each tool's examples, built on first use
+        """
+        with self._lock:
+            if self._centroids is None:
+                self._centroids = np.stack([
+                    self._normalize(np.mean(self._embed_examples(self.examples[tool]), axis=0))
+                    for tool in self._tools
+                ])
+        return self._centroids
+
+    def _embed_examples(self, questions):
+        return np.stack([
+            self._normalize(vector)
+            for vector in np.asarray(self.embeddings.embed_documents(questions), dtype=np.float32)
+        ])
+
+    def _normalize(self, vector):
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def match_rules(self, question):
+        tools = {tool for pattern, tool in self.rules if pattern.search(question)}
+        return tools.pop() if len(tools) == 1 else None
+
+    def classify(self, vector, centroids=None):
+        """
+        Return the nearest tool if it is both close enough and clearly
+        closer than the runner-up, otherwise None
+        """
+        centroids = self.centroids if centroids is None else centroids
+        similarity = centroids @ self._normalize(np.asarray(vector, dtype=np.float32))
+        best, second = np.argsort(similarity)[::-1][:2]
+
+        if similarity[best] < self.threshold or similarity[best] - similarity[second] < self.margin:
+            return None
+
+        return self._tools[best]
+
+    def route(self, question):
+        tool = self.match_rules(question)
+        if tool is None:
+            tool = self.classify(self.embeddings.embed_query(question))
+        return self._record(tool)
+
+    async def aroute(self, question):
+        tool = self.match_rules(question)
+        if tool is None:
+            tool = self.classify(await self.embeddings.aembed_query(question))
+        return self._record(tool)
+
+    def _record(self, tool):
+        if tool is None:
+            self.fallbacks += 1
+        else:
+            self.routed[tool] += 1
+        return tool
+
+    def evaluate(self, labelled=None):
+        """
+        Measure routing accuracy against labelled questions, as a dict of
+        tool name to questions.  Defaults to leave-one-out over the examples.
+
+        Accuracy is the share of confident routes that picked the right
+        tool; coverage is the share of questions routed at all.
+        """
+        correct = routed = total = 0
+
+        for tool, questions in (labelled or self.examples).items():
+            for question in questions:
+                total += 1
+
+                predicted = self.match_rules(question)
+                if predicted is None:
+                    centroids = self.centroids if labelled else self._leave_one_out(question)
+                    predicted = self.classify(self.embeddings.embed_query(question), centroids)
+
+                if predicted is not None:
+                    routed += 1
+                    correct += predicted == tool
+
+        self.accuracy = correct / routed if routed else None
+        return {"accuracy": self.accuracy, "coverage": routed / total if total else 0.0}
+
+    def _leave_one_out(self, question):
+        return np.stack([
+            self._normalize(np.mean(self._embed_examples(
+                [example for example in self.examples[tool] if example != question]
+            ), axis=0))
+            for tool in self._tools
+        ])
+
+    def stats(self):
+        routed = sum(self.routed.values())
+        return {
+            "routed": dict(self.routed),
+            "fallbacks": self.fallbacks,
+            "route_rate": routed / (routed + self.fallbacks) if routed + self.fallbacks else 0.0,
+            "llm_calls_saved": routed * self.LLM_CALLS_PER_ROUTE,
+            "accuracy": self.accuracy,
+        }
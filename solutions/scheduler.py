@@ -0,0 +1,421 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import httpx
+from openai import DEFAULT_CONNECTION_LIMITS
+
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+current_lane = contextvars.ContextVar("openai_lane", default=INTERACTIVE)
+
+DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+def parse_duration(value):
+    """
+    Parse the reset durations OpenAI sends, eg. "20ms", "1s" or "6m0s"
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION.findall(value)
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts) if parts else None
+
+
+@contextmanager
+def lane(priority):
+    """
+    Schedule the OpenAI calls made within the block in a priority lane
+    """
+    token = current_lane.set(priority)
+    try:
+        yield
+    finally:
+        current_lane.reset(token)
+
+
+class TokenBucket:
+    """
+    Holds up to `per_minute` units, refilled continuously at that rate
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self._updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """
+        Seconds until `amount` is available.  Requests larger than the
+        bucket only wait for it to be full.
+        """
+        self.refill()
+        missing = min(amount, self.per_minute) - self.available
+        return max(missing * 60 / self.per_minute, 0.0)
+
+    def take(self, amount):
+        self.refill()
+        self.available -= amount
+
+    def sync(self, limit=None, remaining=None):
+        """
+        Adopt the limit and remaining capacity reported by the server
+        """
+        self.refill()
+        if limit:
+            self.per_minute = limit
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+
+
+class OpenAIScheduler:
+    """
+    Admits the app's OpenAI requests in priority order, within models of
+    the requests-per-minute and tokens-per-minute limits and a cap on
+    requests in flight.
+
+    The buckets adopt the limits and remaining capacity in the rate limit
+    headers of each response.  A 429 pauses every lane for its retry-after
+    time, or for an exponential backoff if there is none, so the client's
+    own retries wait for the pause instead of adding to the storm.
+
+    The limits are the account's.  When several processes share them,
+    each scheduler only uses its share of the limits, and of the
+    remaining capacity reported by the headers.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=30000, max_in_flight=16,
+                 completion_tokens=500, max_backoff=60.0, share=1.0):
+        self.share = share
+        self.requests = TokenBucket(requests_per_minute * share)
+        self.tokens = TokenBucket(tokens_per_minute * share)
+        self.max_in_flight = max_in_flight
+        self.completion_tokens = completion_tokens
+        self.max_backoff = max_backoff
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.strikes = 0
+
+        self._queue = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        # Coroutines waiting in aacquire, as (loop, event) pairs
+        self._waiters = set()
+
+        self.admitted = {INTERACTIVE: 0, BACKGROUND: 0}
+        self.waited = {INTERACTIVE: 0.0, BACKGROUND: 0.0}
+        self.rate_limited = 0
+
+    def estimate(self, request):
+        """
+        Tokens a request counts against the TPM limit: its input plus the
+        most it may generate
+        """
+        try:
+            body = json.loads(request.content or b"{}")
+        except ValueError:
+            return self.completion_tokens
+
+        if "messages" in body:
+            prompt = sum(count_tokens(str(message.get("content") or "")) for message in body["messages"])
+            return prompt + (body.get("max_completion_tokens") or body.get("max_tokens") or self.completion_tokens)
+
+        inputs = body.get("input", "")
+        if isinstance(inputs, str):
+            return count_tokens(inputs)
+        if inputs and isinstance(inputs[0], int):
+            return len(inputs)
+        return sum(len(item) if isinstance(item, list) else count_tokens(str(item)) for item in inputs)
+
+    def _wait_time(self, tokens):
+        return max(
+            self.paused_until - time.monotonic(),
+            self.requests.wait_time(1),
+            self.tokens.wait_time(tokens),
+        )
+
+    def _notify(self):
+        """
+        Wake every waiter, threads and coroutines alike.  Call with the
+        condition held.
+        """
+        self._condition.notify_all()
+        for waiter in list(self._waiters):
+            loop, event = waiter
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # Its loop is closed
+                self._waiters.discard(waiter)
+
+    def _timeout(self, ticket, tokens):
+        """
+        Seconds until the ticket may be admitted, zero or less if it may
+        go now, or None while it waits for its turn
+        """
+        if self._queue[0] == ticket and self.in_flight < self.max_in_flight:
+            return self._wait_time(tokens)
+        return None
+
+    def _withdraw(self, ticket):
+        self._queue.remove(ticket)
+        heapq.heapify(self._queue)
+        self._notify()
+
+    def _admit(self, tokens, priority, start):
+        heapq.heappop(self._queue)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        self.admitted[priority] = self.admitted.get(priority, 0) + 1
+        self.waited[priority] = self.waited.get(priority, 0.0) + time.monotonic() - start
+        self._notify()
+
+    def acquire(self, tokens, priority=None):
+        """
+        Block until the request is at the front of the queue and within
+        the limits, then count it as in flight
+        """
+        priority = current_lane.get() if priority is None else priority
+        ticket = (priority, next(self._order))
+        start = time.monotonic()
+
+        with self._condition:
+            heapq.heappush(self._queue, ticket)
+            try:
+                while True:
+                    timeout = self._timeout(ticket, tokens)
+                    if timeout is not None and timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._withdraw(ticket)
+                raise
+
+            self._admit(tokens, priority, start)
+
+    async def aacquire(self, tokens, priority=None):
+        """
+        Wait on the event loop, without holding a thread, until the
+        request may go
+        """
+        priority = current_lane.get() if priority is None else priority
+        ticket = (priority, next(self._order))
+        start = time.monotonic()
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+
+        with self._condition:
+            heapq.heappush(self._queue, ticket)
+            self._waiters.add(waiter)
+        try:
+            while True:
+                with self._condition:
+                    timeout = self._timeout(ticket, tokens)
+                    if timeout is not None and timeout <= 0:
+                        self._admit(tokens, priority, start)
+                        return
+                    # Cleared under the lock, so no wake up can be missed
+                    event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            with self._condition:
+                self._withdraw(ticket)
+            raise
+        finally:
+            with self._condition:
+                self._waiters.discard(waiter)
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._notify()
+
+    def observe(self, response):
+        """
+        Learn the limits from the headers of a response, as soon as
+        they arrive
+        """
+        with self._condition:
+            self._update(response)
+            self._notify()
+
+    def _update(self, response):
+        headers = response.headers
+
+        def number(name):
+            try:
+                return float(headers[name])
+            except (KeyError, ValueError):
+                return None
+
+        def share(name):
+            value = number(name)
+            return None if value is None else value * self.share
+
+        self.requests.sync(share("x-ratelimit-limit-requests"), share("x-ratelimit-remaining-requests"))
+        self.tokens.sync(share("x-ratelimit-limit-tokens"), share("x-ratelimit-remaining-tokens"))
+
+        if response.status_code == 429:
+            self.rate_limited += 1
+            self.strikes += 1
+
+            retry_after = number("retry-after-ms")
+            retry_after = retry_after / 1000 if retry_after is not None else number("retry-after")
+            if retry_after is None:
+                retry_after = max(
+                    parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                    parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0,
+                ) or min(2 ** self.strikes, self.max_backoff)
+
+            self.paused_until = max(self.paused_until, time.monotonic() + min(retry_after, self.max_backoff))
+            logger.warning("Rate limited by OpenAI, pausing for %.1fs", retry_after)
+        elif response.status_code < 400:
+            self.strikes = 0
+
+    def stats(self):
+        with self._condition:
+            self.requests.refill()
+            self.tokens.refill()
+            return {
+                "in_flight": self.in_flight,
+                "queued": len(self._queue),
+                "requests_available": self.requests.available,
+                "tokens_available": self.tokens.available,
+                "limits": {"requests": self.requests.per_minute, "tokens": self.tokens.per_minute},
+                "paused_for": max(self.paused_until - time.monotonic(), 0.0),
+                "admitted": dict(self.admitted),
+                "waited_seconds": dict(self.waited),
+                "rate_limited": self.rate_limited,
+            }
+
+
+class ReleasingStream(httpx.SyncByteStream):
+    """
+    A response body that releases the request's place once it is read,
+    so streamed completions count as in flight until they finish
+    """
+
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    def __iter__(self):
+        yield from self.stream
+
+    def close(self):
+        try:
+            self.stream.close()
+        finally:
+            self.release()
+
+
+class AsyncReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream, release):
+        self.stream = stream
+        self.release = release
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            self.release()
+
+
+def once(func):
+    called = []
+
+    def wrapped():
+        if not called:
+            called.append(True)
+            func()
+
+    return wrapped
+
+
+class SchedulingTransport(httpx.BaseTransport):
+    """
+    An httpx transport that sends each request through the scheduler.
+    The default inner transport keeps the OpenAI client's connection
+    limits.
+    """
+
+    def __init__(self, scheduler, transport=None):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.HTTPTransport(limits=DEFAULT_CONNECTION_LIMITS)
+
+    def handle_request(self, request):
+        self.scheduler.acquire(self.scheduler.estimate(request))
+        try:
+            response = self.transport.handle_request(request)
+        except BaseException:
+            self.scheduler.release()
+            raise
+
+        self.scheduler.observe(response)
+        release = once(self.scheduler.release)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=ReleasingStream(response.stream, release),
+            extensions=response.extensions,
+        )
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncSchedulingTransport(httpx.AsyncBaseTransport):
+    def __init__(self, scheduler, transport=None):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS)
+
+    async def handle_async_request(self, request):
+        await self.scheduler.aacquire(self.scheduler.estimate(request))
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.scheduler.release()
+            raise
+
+        self.scheduler.observe(response)
+        release = once(self.scheduler.release)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=AsyncReleasingStream(response.stream, release),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_QUERY = """
+CALL db.labels() YIELD label
+WITH collect(label) AS labels
+CALL db.relationshipTypes() YIELD relationshipType
+WITH labels, collect(relationshipType) AS types
+CALL db.propertyKeys() YIELD propertyKey
+RETURN labels, types, collect(propertyKey) AS keys
+"""
+
+# The properties of each label and relationship type, so a property
+# moving from one label to another changes the fingerprint
+PROPERTIES_QUERY = """
+CALL db.schema.nodeTypeProperties() YIELD nodeType, propertyName
+WITH collect([nodeType, propertyName]) AS nodes
+CALL db.schema.relTypeProperties() YIELD relType, propertyName
+RETURN nodes, collect([relType, propertyName]) AS relationships
+"""
+
+def schema_fingerprint(graph):
+    """
+    Return a fingerprint of the database schema, built from the labels,
+    relationship types and property keys in use, and the properties
+    found on each label and relationship type
+    """
+    record = graph.query(FINGERPRINT_QUERY)[0]
+    summary = {
+        key: sorted(values)
+        for key, values in record.items()
+    }
+    summary["counts"] = [len(summary["labels"]), len(summary["types"]), len(summary["keys"])]
+
+    properties = graph.query(PROPERTIES_QUERY)[0]
+    for key, pairs in properties.items():
+        summary[key] = sorted({(owner, name) for owner, name in pairs if name is not None})
+
+    return hashlib.sha256(json.dumps(summary, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_schema(graph, path, refresh=False):
+    """
+    Set the graph schema from the snapshot at path, if its fingerprint
+    still matches the database.  Otherwise introspect the database and
+    write a new snapshot.
+
+    Returns True if the snapshot was used.
+    """
+    fingerprint = schema_fingerprint(graph)
+
+    if not refresh and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+
+        if snapshot.get("fingerprint") == fingerprint:
+            graph.structured_schema = snapshot["structured_schema"]
+            graph.schema = snapshot["schema"]
+            return True
+
+    graph.refresh_schema()
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file of this process's own first, so a crash
+    # never leaves half a snapshot and workers starting together do not
+    # write over each other
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "fingerprint": fingerprint,
+                "schema": graph.schema,
+                "structured_schema": graph.structured_schema,
+            }, f, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+    return False
+
+def refresh_schema(graph, path, chains=()):
+    """
+    Introspect the database and overwrite the snapshot, regardless
+    of the fingerprint, then rebuild the schema in the prompt of each
+    Cypher chain, which copies it when created
+    """
+    load_schema(graph, path, refresh=True)
+    for chain in chains:
+        chain.update_schema()
+
+def watch_schema(graph, path, interval, chains=()):
+    """
+    Compare the schema fingerprint every interval seconds, and refresh
+    the schema and chains when it has changed
+    """
+    stopped = threading.Event()
+
+    def run():
+        fingerprint = schema_fingerprint(graph)
+        while not stopped.wait(interval):
+            try:
+                latest = schema_fingerprint(graph)
+                if latest != fingerprint:
+                    refresh_schema(graph, path, chains)
+                    fingerprint = latest
+                    logger.info("Refreshed the schema after it changed")
+            except Exception:
+                logger.exception("Failed to check the schema for changes")
+
+    threading.Thread(target=run, name="schema-watch", daemon=True).start()
+    return stopped
@@ -0,0 +1,156 @@
+import re
+import threading
+import time
+
+import numpy as np
+
+# Words that suggest a question depends on the conversation so far
+FOLLOW_UP = re.compile(
+    r"\b(it|its|he|she|him|her|his|they|them|their|that one|those|these|"
+    r"same|else|more|another|other|previous|above|earlier|again)\b",
+    re.IGNORECASE,
+)
+
+# Words that suggest a question is about the user or the conversation itself
+PERSONAL = re.compile(
+    r"\b(i|me|my|mine|myself|we|us|our|ours|you|your|yours|yourself)\b",
+    re.IGNORECASE,
+)
+
+def is_follow_up(question):
+    """
+    Cheap check for questions that refer back to the conversation,
+    eg. "Who else starred in it?"
+    """
+    return FOLLOW_UP.search(question) is not None
+
+def is_personal(question):
+    """
+    Cheap check for questions in the first or second person, eg.
+    "What is my name?" or "Which film did you mention?"
+    """
+    return PERSONAL.search(question) is not None
+
+def depends_on_history(question):
+    """
+    Whether the answer may depend on the session's conversation, so it
+    must not be shared with, or taken from, another session
+    """
+    return is_follow_up(question) or is_personal(question)
+
+# Answers that do not depend on the session are shared by every session
+GLOBAL_SCOPE = "global"
+
+
+class SemanticCache:
+    """
+    An in-process cache of answers keyed on the embedding of the question.
+
+    Questions are stored as normalised rows of a NumPy matrix, so a lookup
+    is a single matrix-vector product.  An answer is returned when the
+    cosine similarity to a stored question within the same scope is above
+    the threshold.
+    """
+
+    def __init__(self, embeddings, threshold=0.95, maxsize=1000, ttl=None):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._vectors = None
+        self._answers = [None] * maxsize
+        self._scopes = np.full(maxsize, None, dtype=object)
+        self._created = np.zeros(maxsize)
+        self._used = np.zeros(maxsize)
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def scope(self, question):
+        """
+        The scope to cache the answer to a question under, or None if the
+        answer may depend on the conversation and must not be cached
+        """
+        return None if depends_on_history(question) else GLOBAL_SCOPE
+
+    def embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def aembed(self, question):
+        vector = np.asarray(await self.embeddings.aembed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, vector, scope):
+        """
+        Return the answer to the most similar question in the scope, or None
+        """
+        with self._lock:
+            if self._size == 0:
+                self.misses += 1
+                return None
+
+            now = time.monotonic()
+            similarity = self._vectors[:self._size] @ vector
+            similarity[self._scopes[:self._size] != scope] = -1
+            if self.ttl is not None:
+                similarity[now - self._created[:self._size] > self.ttl] = -1
+
+            best = int(np.argmax(similarity))
+            if similarity[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self._used[best] = now
+            self.hits += 1
+            return self._answers[best]
+
+    def store(self, vector, answer, scope):
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+
+            if self._size < self.maxsize:
+                row = self._size
+                self._size += 1
+            else:
+                row = self._evict()
+
+            now = time.monotonic()
+            self._vectors[row] = vector
+            self._answers[row] = answer
+            self._scopes[row] = scope
+            self._created[row] = now
+            self._used[row] = now
+
+    def _evict(self):
+        """
+        Pick the row to overwrite: an expired entry if there is one,
+        otherwise the least recently used
+        """
+        self.evictions += 1
+
+        if self.ttl is not None:
+            expired = np.flatnonzero(time.monotonic() - self._created > self.ttl)
+            if len(expired):
+                return int(expired[0])
+
+        return int(np.argmin(self._used))
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
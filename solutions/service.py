@@ -0,0 +1,156 @@
+"""
+A headless service that answers questions with the agent, so the
+Streamlit app can run as a thin client, see client.py.
+
+The service runs AGENT_WORKERS worker processes, each with its own LLM
+clients, Neo4j drivers and caches.  Each worker answers many turns at
+once on its event loop with the async agent, so blocking I/O never
+competes with UI reruns and the UI and the agent scale separately.
+Chat history is stored in Neo4j, so any worker can answer any session.
+
+    POST /generate  {"input": ..., "session_id": ...}  ->  {"output": ...}
+    POST /stream    {"input": ..., "session_id": ...}  ->  server-sent events
+    GET  /health                                       ->  the health of each built resource
+
+Run from the repository root, so .streamlit/secrets.toml is found:
+
+    python solutions/service.py
+"""
+import asyncio
+import contextlib
+import importlib
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+import aio
+from config import get_setting
+from resources import get_registry
+
+logger = logging.getLogger(__name__)
+
+
+def load_agent():
+    """
+    Build the agent, and every resource it uses, when the worker starts
+    rather than on its first turn
+    """
+    return importlib.import_module("agent")
+
+
+def close_agent():
+    get_registry().close()
+
+
+def check_health():
+    return get_registry().health()
+
+
+def create_app(load_agent=load_agent, close_agent=close_agent, check_health=check_health):
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        # The agent's async clients are bound to the process loop, so the
+        # server's loop becomes it.  Building and closing the agent wait
+        # on that loop, so they run in a thread.
+        aio.use_loop(asyncio.get_running_loop())
+        try:
+            app.state.agent = await asyncio.to_thread(load_agent)
+            yield
+            await asyncio.to_thread(close_agent)
+        finally:
+            aio.use_loop(None)
+
+    app = Starlette(
+        routes=[
+            Route("/generate", generate_endpoint, methods=["POST"]),
+            Route("/stream", stream_endpoint, methods=["POST"]),
+            Route("/health", health_endpoint, methods=["GET"]),
+        ],
+        lifespan=lifespan,
+    )
+    app.state.check_health = check_health
+    return app
+
+
+async def read_turn(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict) or not isinstance(body.get("input"), str) or not body.get("session_id"):
+        return None
+    return body["input"], str(body["session_id"])
+
+
+def bad_request():
+    return JSONResponse({"error": "a JSON object with input and session_id is required"}, status_code=400)
+
+
+async def generate_endpoint(request):
+    turn = await read_turn(request)
+    if turn is None:
+        return bad_request()
+
+    try:
+        output = await request.app.state.agent.agenerate_response(*turn)
+    except Exception as error:
+        logger.exception("Failed to generate a response")
+        return JSONResponse({"error": str(error)}, status_code=500)
+
+    return JSONResponse({"output": output})
+
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_endpoint(request):
+    turn = await read_turn(request)
+    if turn is None:
+        return bad_request()
+
+    # The stream is cancelled, and the agent stops, when the client goes
+    async def events():
+        async with contextlib.aclosing(request.app.state.agent.astream_answer(*turn)) as tokens:
+            try:
+                async for token in tokens:
+                    yield server_sent_event("token", {"token": token})
+            except Exception as error:
+                logger.exception("Failed to stream a response")
+                yield server_sent_event("error", {"error": str(error)})
+                return
+        yield server_sent_event("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def health_endpoint(request):
+    # Health checks, eg. Neo4j's verify_connectivity, block
+    resources = await asyncio.to_thread(request.app.state.check_health)
+    healthy = all(status["ok"] for status in resources.values())
+    return JSONResponse(
+        {"status": "ok" if healthy else "unhealthy", "resources": resources},
+        status_code=200 if healthy else 503,
+    )
+
+
+app = create_app()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Each worker process imports this module and builds its own agent
+    uvicorn.run(
+        "service:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=get_setting("AGENT_SERVICE_HOST", "127.0.0.1"),
+        port=get_setting("AGENT_SERVICE_PORT", 8000),
+        workers=get_setting("AGENT_WORKERS", os.cpu_count() or 1),
+    )
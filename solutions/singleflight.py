@@ -0,0 +1,128 @@
+import asyncio
+import functools
+import inspect
+import re
+import threading
+from concurrent.futures import Future
+
+def normalize_key(text):
+    """
+    Reduce a question to a key that ignores case, spacing and the
+    closing punctuation, eg. "Who directed Jaws?" and "who directed  jaws"
+    """
+    return re.sub(r"\s+", " ", str(text)).strip().rstrip("?!. ").lower()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key.  The first caller, the
+    leader, does the work; callers that arrive while it is in flight wait
+    for the leader's result, or its exception, instead of repeating it.
+
+    Nothing is kept once the leader finishes, so this is not a cache:
+    calls that do not overlap each do their own work.  Sync and async
+    callers can share a flight, as both wait on a concurrent Future.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+        self.leaders = 0
+        self.coalesced = 0
+
+    def begin(self, key):
+        """
+        Join the flight for a key, returning its future and whether
+        this caller leads it and must end() it
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+
+            # A running future cannot be cancelled, so no follower giving
+            # up can cancel the flight for the others
+            future = self._flights[key] = Future()
+            future.set_running_or_notify_cancel()
+            self.leaders += 1
+            return future, True
+
+    def end(self, key, future, result=None, error=None):
+        with self._lock:
+            if self._flights.get(key) is future:
+                del self._flights[key]
+
+        if future.done():
+            return
+
+        if error is not None:
+            # Waiters should not be cancelled or exit because the leader was
+            if not isinstance(error, Exception):
+                error = RuntimeError(f"The call for {key!r} was interrupted")
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call func, or wait for the call already in flight for the key.
+        Returns the result and whether it was shared with a leader.
+        """
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as error:
+            self.end(key, future, error=error)
+            raise
+
+        self.end(key, future, result)
+        return result, False
+
+    async def ado(self, key, func, *args, **kwargs):
+        future, leader = self.begin(key)
+        if not leader:
+            # Shielded, so cancelling this caller leaves the flight alone
+            return await asyncio.shield(asyncio.wrap_future(future)), True
+
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as error:
+            self.end(key, future, error=error)
+            raise
+
+        self.end(key, future, result)
+        return result, False
+
+    def wrap(self, name, func):
+        """
+        Coalesce the calls to a function, or coroutine function, whose
+        first argument is the same question
+        """
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapped(input, *args, **kwargs):
+                result, _ = await self.ado((name, normalize_key(input)), func, input, *args, **kwargs)
+                return result
+        else:
+            @functools.wraps(func)
+            def wrapped(input, *args, **kwargs):
+                result, _ = self.do((name, normalize_key(input)), func, input, *args, **kwargs)
+                return result
+
+        return wrapped
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        calls = self.leaders + self.coalesced
+        return {
+            "in_flight": in_flight,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / calls if calls else 0.0,
+        }
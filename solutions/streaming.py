@@ -0,0 +1,38 @@
+FINAL_ANSWER = "Final Answer:"
+
+async def final_answer_tokens(events, tag):
+    """
+    Yield the tokens of the Final Answer of a ReAct agent from its
+    astream_events, as they arrive from the LLM runs tagged with tag.
+    The Thought/Action text before it is held back.
+    """
+
+    buffers = {}
+    answering = set()
+    streamed = False
+
+    async for event in events:
+        if event["event"] == "on_chat_model_stream" and tag in event["tags"]:
+            run_id = event["run_id"]
+            token = event["data"]["chunk"].content
+
+            if run_id in answering:
+                if streamed or token.strip():
+                    yield token if streamed else token.lstrip()
+                    streamed = True
+                continue
+
+            # Hold back the Thought/Action text until the Final Answer starts
+            text = buffers.get(run_id, "") + token
+            if FINAL_ANSWER in text:
+                answering.add(run_id)
+                answer = text.split(FINAL_ANSWER, 1)[1].lstrip()
+                if answer:
+                    streamed = True
+                    yield answer
+            else:
+                buffers[run_id] = text
+
+        # Fall back to the executor output if the answer could not be streamed
+        elif event["event"] == "on_chain_end" and not event["parent_ids"] and not streamed:
+            yield event["data"]["output"]["output"]
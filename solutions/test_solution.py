@@ -40,4 +40,858 @@ def test_bot_conversation():
 
     assert at.chat_message[0].markdown[0].value == "Hi, I'm the GraphAcademy Chatbot!  How can I help you?"
     assert at.chat_message[1].markdown[0].value == question
-    assert len(at.chat_message[2].markdown[0].value) > 0, "No response from the bot"
\ No newline at end of file
+    assert len(at.chat_message[2].markdown[0].value) > 0, "No response from the bot"
+
+def test_cypher_cache():
+    from tools.cypher_cache import CypherCache
+
+    cache = CypherCache()
+    cypher = 'MATCH (p:Person)-[:ACTED_IN]->(m:Movie {title: "Matrix, The"}) RETURN p.name'
+
+    assert cache.lookup("Who acted in The Matrix?") is None
+    assert cache.store("Who acted in The Matrix?", cypher)
+
+    cached, params = cache.lookup("who acted in The Godfather")
+    assert "$e0" in cached and "Matrix" not in cached
+    assert params == {"e0": "Godfather, The"}
+    assert cache.stats()["hits"] == 1
+
+    # A lower cased literal is matched to the entity with a lower transform
+    assert cache.store("What year was The Matrix released?", 'MATCH (m:Movie) WHERE toLower(m.title) = "the matrix" RETURN m.year')
+    assert cache.lookup("what year was The Godfather released")[1] == {"e0": "the godfather"}
+
+def test_semantic_cache():
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from semantic_cache import SemanticCache, depends_on_history, is_follow_up
+
+    cache = SemanticCache(DeterministicFakeEmbedding(size=32), threshold=0.99, maxsize=2)
+    question = cache.embed("What is a good movie about aliens?")
+
+    assert cache.lookup(question, "global") is None
+    cache.store(question, "Arrival", "global")
+    assert cache.lookup(question, "global") == "Arrival"
+    assert cache.lookup(question, "other") is None
+    assert cache.lookup(cache.embed("Who directed Heat?"), "global") is None
+
+    assert is_follow_up("Who else starred in it?")
+    assert not is_follow_up("Who directed Heat?")
+    for question in ["What is my name?", "What did I ask first?", "Tell me about the one you mentioned"]:
+        assert depends_on_history(question)
+    assert not depends_on_history("Who directed Heat?")
+
+    # Answers to questions about the user or the conversation are not cached
+    assert cache.scope("What is a good movie about aliens?") == "global"
+    for question in ["What is my name?", "What did I ask first?", "Which of those did you mention?"]:
+        assert cache.scope(question) is None
+
+def test_embedding_cache(tmp_path):
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from embedding_cache import CachedEmbeddings
+
+    path = str(tmp_path / "embeddings.sqlite")
+    cached = CachedEmbeddings(DeterministicFakeEmbedding(size=8), path=path)
+    vector = cached.embed_query("Aliens land on earth")
+
+    restarted = CachedEmbeddings(DeterministicFakeEmbedding(size=8), path=path)
+    assert restarted.embed_documents(["Aliens land on earth"])[0] == vector
+    assert restarted.stats()["hits"] == 1
+
+    # The async methods read and write SQLite off the event loop
+    import asyncio
+    import threading
+
+    threads = []
+    load = restarted._load
+    restarted._load = lambda keys: threads.append(threading.current_thread()) or load(keys)
+
+    async def embed():
+        return await restarted.aembed_documents(["Aliens land on earth", "A shark"]), threading.current_thread()
+
+    vectors, loop_thread = asyncio.run(embed())
+    assert vectors[0] == vector and threads and loop_thread not in threads
+
+def test_schema_snapshot(tmp_path):
+    from schema_snapshot import FINGERPRINT_QUERY, load_schema, refresh_schema, schema_fingerprint
+
+    properties = {"nodes": [["Movie", "title"], ["Person", "name"], ["Person", None]], "relationships": []}
+
+    class Graph:
+        schema = structured_schema = None
+        introspected = 0
+
+        def query(self, query, params=None):
+            if query == FINGERPRINT_QUERY:
+                return [{"labels": ["Movie", "Person"], "types": ["ACTED_IN"], "keys": ["title", "name"]}]
+            return [properties]
+
+        def refresh_schema(self):
+            self.introspected += 1
+            self.schema, self.structured_schema = "Movie {title}", {"node_props": {}}
+
+    graph, path = Graph(), str(tmp_path / "schema.json")
+    assert not load_schema(graph, path)
+    assert load_schema(Graph(), path)
+
+    # A property moving to another label changes the fingerprint
+    fingerprint = schema_fingerprint(graph)
+    properties["nodes"] = [["Movie", "title"], ["Movie", "name"]]
+    assert schema_fingerprint(graph) != fingerprint
+    assert not load_schema(Graph(), path)
+
+    # A refresh reaches the chains that copied the schema
+    class Chain:
+        updated = 0
+
+        def update_schema(self):
+            self.updated += 1
+
+    chain = Chain()
+    refresh_schema(graph, path, chains=[chain])
+    assert graph.introspected == 2 and chain.updated == 1
+
+def test_router():
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from router import Router
+
+    router = Router(DeterministicFakeEmbedding(size=32))
+
+    assert router.route("Who directed The Matrix?") == "Movie information"
+    assert router.route("Is there a movie about a talking dog?") == "Movie Plot Search"
+    assert router.stats()["llm_calls_saved"] == 4
+    assert router.match_rules("List the films in which Tom Hanks acted") is None
+
+    # Unrelated random embeddings are never confident
+    assert router.route("Hmm") is None
+    assert router.stats()["fallbacks"] == 1
+
+def test_windowed_history():
+    from types import SimpleNamespace
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+    from langchain_core.runnables import RunnableLambda
+    from memory import WindowedChatMessageHistory
+
+    def message(type, content):
+        return {"data": {"content": content}, "type": type}
+
+    queries = []
+    results = [
+        # messages: the last turn stored, and the summary
+        [{"summary": "They talked about Heat", "count": 4, "summarized": 4,
+          "messages": [message("human", "Q2"), message("ai", "A2")]}],
+        # summarize: 8 messages stored, 2 of them summarised
+        [{"count": 8, "summarized": 2, "summary": "They talked about Heat"}],
+        [{"messages": [message("human", "Q3"), message("ai", "A3"), message("human", "Q4"), message("ai", "A4")]}],
+        [],
+    ]
+
+    def execute_query(query, parameters, database_=None):
+        queries.append((query, parameters))
+        return results.pop(0), None, None
+
+    graph = SimpleNamespace(_driver=SimpleNamespace(execute_query=execute_query), _database="neo4j")
+    writer = SimpleNamespace(pending=lambda session_id: [HumanMessage(content="Q5"), AIMessage(content="A5")])
+    summaries = []
+    summarizer = RunnableLambda(lambda inputs: summaries.append(inputs) or "New summary")
+
+    history = WindowedChatMessageHistory(
+        "s1", graph, window=1, summarizer=summarizer, writer=writer, node_label="Conversation",
+    )
+
+    # The summary, then only the last turn, including the one not yet written
+    messages = history.messages
+    assert isinstance(messages[0], SystemMessage) and "They talked about Heat" in messages[0].content
+    assert [message.content for message in messages[1:]] == ["Q5", "A5"]
+    assert "`Conversation`" in queries[0][0] and "NEXT*0..2]" in queries[0][0]
+
+    # The 4 messages between the summary and the window are folded into it
+    history.summarize()
+    assert "NEXT*5]" in queries[2][0] and queries[2][1]["pending"] == 4
+    assert "Human: Q3" in summaries[0]["new_lines"] and "Q2" not in summaries[0]["new_lines"]
+    assert queries[3][1] == {"session_id": "s1", "summary": "New summary", "summarized": 2, "pending": 4}
+
+    # A turn committed while the history is being read is only seen once
+    turn = [message("human", "Q2"), message("ai", "A2")]
+    for number, stored in enumerate(turn):
+        stored["data"]["id"] = f"m{number}"
+    results.append([{"summary": None, "messages": [message("human", "Q1"), message("ai", "A1")] + turn}])
+    writer.pending = lambda session_id: [HumanMessage(content="Q2", id="m0"), AIMessage(content="A2", id="m1")]
+    history = WindowedChatMessageHistory("s1", graph, window=2, writer=writer)
+    assert [message.content for message in history.messages] == ["Q1", "A1", "Q2", "A2"]
+
+    # A message out of the window, but not summarised yet, is still read
+    results.append([{"summary": "S", "count": 5, "summarized": 2,
+                     "messages": [message("ai", "A1"), message("human", "Q2"), message("ai", "A2")]}])
+    history = WindowedChatMessageHistory("s1", graph, window=1, summarizer=summarizer)
+    assert [message.content for message in history.messages[1:]] == ["A1", "Q2", "A2"]
+
+    # A window of 0 keeps no messages, only the summary
+    results.append([{"summary": "S", "count": 5, "summarized": 5, "messages": [message("ai", "A2")]}])
+    history = WindowedChatMessageHistory("s1", graph, window=0, summarizer=summarizer)
+    assert [message.content for message in history.messages] == ["Summary of the earlier conversation: S"]
+
+def test_history_writer():
+    import time
+    from types import SimpleNamespace
+    from langchain_core.messages import AIMessage, HumanMessage
+    from memory import HistoryWriter
+
+    written = []
+    failures = [RuntimeError("Neo4j is unavailable")]
+
+    class Session:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def execute_write(self, work):
+            if failures:
+                raise failures.pop()
+            work(SimpleNamespace(run=lambda query, **params: (
+                written.extend(message["content"] for message in params["messages"])
+                or SimpleNamespace(consume=lambda: None)
+            )))
+
+    driver = SimpleNamespace(session=lambda database: Session())
+    history = SimpleNamespace(_session_id="s1", _node_label="Session", summarize_in_background=lambda: None)
+
+    def turn(number):
+        return [HumanMessage(content=f"Q{number}"), AIMessage(content=f"A{number}")]
+
+    # A failed flush puts its messages back in front of newer ones
+    writer = HistoryWriter(driver, "neo4j", interval=60)
+    writer.add(history, turn(1))
+    assert writer.flush() is False
+    writer.add(history, turn(2))
+    assert [message.content for message in writer.pending("s1")] == ["Q1", "A1", "Q2", "A2"]
+    assert all(message.id for message in writer.pending("s1"))
+    assert writer.flush() is True
+    assert written == ["Q1", "A1", "Q2", "A2"] and writer.pending("s1") == []
+    writer.close()
+
+    # Flushing on every turn, a failed write is retried without another turn
+    written.clear()
+    failures.append(RuntimeError("Neo4j is unavailable"))
+    writer = HistoryWriter(driver, "neo4j", interval=0, retry_delay=0.01)
+    writer.add(history, turn(3))
+    deadline = time.monotonic() + 5
+    while not written and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.close()
+
+    assert written == ["Q3", "A3"]
+    assert writer.stats() == {"buffered": 0, "flushes": 1, "written": 2, "failures": 1}
+
+def test_movie_metadata_refresh():
+    import threading
+    from tools.movie_metadata import REFRESH_QUERY, refresh_in_background
+
+    calls = []
+    refreshed = threading.Event()
+
+    class Graph:
+        def query(self, query, params):
+            calls.append(params)
+            if len(calls) == 4:
+                refreshed.set()
+            # A full first batch, then the rest, then nothing has changed
+            return [{"updated": [2, 1, 0, 0][min(len(calls), 4) - 1]}]
+
+    stop = refresh_in_background(Graph(), interval=0.01, batch_size=2)
+    assert refreshed.wait(5)
+    stop.set()
+
+    # Refreshes repeat on the interval, each batching until nothing is left
+    assert [params["batch_size"] for params in calls[:4]] == [2, 2, 2, 2]
+    assert calls[0]["refresh_id"] == calls[1]["refresh_id"] != calls[2]["refresh_id"]
+    assert calls[0]["watermark_property"] == "metadataUpdatedAt" and not calls[0]["full"]
+
+    # Only the movies picked by the watermark are expanded, skipping nameless people
+    assert REFRESH_QUERY.index("LIMIT $batch_size") < REFRESH_QUERY.index("COLLECT")
+    assert REFRESH_QUERY.count("WHERE person.name IS NOT NULL") == 2
+
+def test_local_index_sync(tmp_path):
+    import numpy as np
+    from tools.local_index import KEYS_QUERY, SYNC_QUERY, LocalPlotIndex
+
+    rng = np.random.default_rng(0)
+    movies = {f"m{i}": {"embedding": rng.normal(size=8).tolist(), "updated": None} for i in range(10)}
+    clock = [100]
+
+    class Graph:
+        def query(self, query, params=None):
+            if query == SYNC_QUERY:
+                rows = sorted(
+                    ({"id": id, "embedding": movie["embedding"], "updated": movie["updated"]}
+                     for id, movie in movies.items() if movie["updated"] >= params["watermark"]),
+                    key=lambda row: (row["updated"], row["id"]),
+                )
+                return rows[params["skip"]:params["skip"] + params["batch_size"]]
+            if query == KEYS_QUERY:
+                return [{"ids": list(movies)}]
+            # Movies without a watermark are stamped
+            for movie in movies.values():
+                if movie["updated"] is None:
+                    movie["updated"] = clock[0]
+            return []
+
+    index = LocalPlotIndex(str(tmp_path), nprobe=100)
+    assert index.sync(Graph(), batch_size=3) == 10
+    assert index.sync(Graph(), batch_size=3) == 0
+
+    # A movie written at the same timestamp as the watermark is still picked up
+    movies["m11"] = {"embedding": movies["m7"]["embedding"], "updated": 100}
+    assert index.sync(Graph(), batch_size=3) == 1
+
+    # New movies are stamped and added, deleted ones are dropped
+    clock[0] = 200
+    movies["m10"] = {"embedding": rng.normal(size=8).tolist(), "updated": None}
+    del movies["m5"]
+    assert index.sync(Graph(), batch_size=3) == 2
+    assert sorted(index.ids) == sorted(movies)
+
+    # Another process gets a directory of its own while the index is open
+    other = LocalPlotIndex(str(tmp_path), nprobe=100)
+    assert other.path != index.path and len(other) == 0
+    other.close()
+
+    # The vectors follow their keys when the index is reloaded
+    index.close()
+    reloaded = LocalPlotIndex(str(tmp_path), nprobe=100)
+    assert reloaded.path == index.path
+    assert reloaded.search(movies["m10"]["embedding"], k=1)[0][0] == "m10"
+    assert {id for id, _ in reloaded.search(movies["m7"]["embedding"], k=2)} == {"m7", "m11"}
+    assert reloaded.sync(Graph(), batch_size=3) == 0
+
+def test_row_budget():
+    from tools.cypher_results import RowBudget
+
+    budget = RowBudget(max_rows=3, token_budget=1000)
+    rows = [{"title": f"Movie {i}", "plot": "x" * 1000, "embedding": [0.1] * 100} for i in range(5)]
+
+    assert all(budget.add(row) for row in rows[:3])
+    assert not budget.add(rows[3])
+    assert budget.truncated and "first 3 rows" in budget.note()
+    assert "embedding" not in budget.rows[0] and len(budget.rows[0]["plot"]) == 503
+
+    budget = RowBudget(max_rows=10, token_budget=100)
+    assert budget.add(rows[0]) and not budget.add(rows[1])
+
+def test_cypher_guard():
+    from tools.cypher_guard import CypherGuard, bound_paths
+
+    assert bound_paths("MATCH p=shortestPath((a)-[:ACTED_IN|DIRECTED*]-(b))", 6).endswith("*..6]-(b))")
+    assert bound_paths("MATCH (a)-[*2..]-(b)", 6) == "MATCH (a)-[*2..6]-(b)"
+    assert bound_paths("MATCH (a)-[*2]-(b)", 6) == "MATCH (a)-[*2]-(b)"
+
+    plans = {
+        "MATCH (m:Movie) RETURN m.title": {"operatorType": "ProduceResults@neo4j", "args": {"EstimatedRows": 9000.0},
+            "children": [{"operatorType": "NodeByLabelScan@neo4j", "args": {"EstimatedRows": 9000.0}}]},
+        "MATCH (a), (b) RETURN a, b": {"operatorType": "ProduceResults@neo4j", "args": {"EstimatedRows": 8.1e7}},
+        "CREATE (m:Movie)": {"operatorType": "ProduceResults@neo4j", "args": {"EstimatedRows": 1.0},
+            "children": [{"operatorType": "Create@neo4j", "args": {"EstimatedRows": 1.0}}]},
+    }
+
+    class ExplainGuard(CypherGuard):
+        def _explain(self, cypher, params):
+            self.explained += 1
+            return plans[" ".join(cypher.split())]
+
+    guard = ExplainGuard(graph=None)
+    guard.explained = 0
+
+    assert guard.check("MATCH (m:Movie)  RETURN m.title;", {}) == ("MATCH (m:Movie)  RETURN m.title\nLIMIT 100", None)
+    assert guard.check("MATCH (m:Movie) RETURN m.title", {})[1] is None
+    assert guard.explained == 1
+    assert "81,000,000 rows" in guard.check("MATCH (a), (b) RETURN a, b", {})[1]
+    assert "Create" in guard.check("CREATE (m:Movie)", {})[1]
+
+def test_parameterize_literals():
+    from tools.cypher_params import PlanCacheMonitor, parameterize_literals
+
+    cypher, params = parameterize_literals(
+        'MATCH (p:Person)-[:ACTED_IN*1..2]->(m:Movie {title: "Matrix, The"}) '
+        "WHERE m.year > 1990 AND p.name <> 'O\\'Neil' RETURN p.name LIMIT 1990",
+        {"e0": "Heat"},
+    )
+    assert cypher == (
+        "MATCH (p:Person)-[:ACTED_IN*1..2]->(m:Movie {title: $p0}) "
+        "WHERE m.year > $p1 AND p.name <> $p2 RETURN p.name LIMIT $p1"
+    )
+    assert params == {"e0": "Heat", "p0": "Matrix, The", "p1": 1990, "p2": "O'Neil"}
+
+    # The bounds of variable-length relationships stay inline
+    cypher, params = parameterize_literals("MATCH (a)-[:ACTED_IN* 2 .. 4]-(b)-[* 3]-(c {born: 1956}) RETURN c")
+    assert cypher == "MATCH (a)-[:ACTED_IN* 2 .. 4]-(b)-[* 3]-(c {born: $p0}) RETURN c"
+    assert params == {"p0": 1956}
+
+    monitor = PlanCacheMonitor()
+    assert not monitor.record(parameterize_literals('MATCH (m:Movie {title: "Heat"}) RETURN m.year')[0])
+    assert monitor.record(parameterize_literals('MATCH (m:Movie {title: "Casino"}) RETURN m.year')[0])
+    assert monitor.stats()["hit_rate"] == 0.5
+
+def test_entity_index():
+    from tools.entity_index import EntityIndex
+
+    index = EntityIndex()
+    for value in ["Matrix, The", "Tom Hanks", "Apollo 13", "Her"]:
+        index.add(value)
+
+    assert index.canonicalize("Who acted in the matrix?") == 'Who acted in "Matrix, The"?'
+    assert index.canonicalize("What role did Tom Hanx play in Apollo 13?") == (
+        'What role did "Tom Hanks" play in "Apollo 13"?'
+    )
+    assert index.canonicalize("who directed her") == "who directed her"
+
+    # Single words are only rewritten when quoted, as they are often not the title
+    index.add("Oscar")
+    assert index.canonicalize("Which movies won an Oscar?") == "Which movies won an Oscar?"
+    assert index.canonicalize('Who starred in "oscar"?') == 'Who starred in "Oscar"?'
+
+    # A refresh rebuilds the index, dropping renamed and deleted values
+    class Graph:
+        def query(self, query):
+            return [{"value": "Matrix Reloaded, The"}, {"value": "Tom Hanks"}]
+
+    assert index.refresh(Graph()) == 2
+    assert index.canonicalize("Who acted in Apollo 13?") == "Who acted in Apollo 13?"
+    assert index.canonicalize("Who acted in the matrix reloaded?") == 'Who acted in "Matrix Reloaded, The"?'
+
+def test_example_selector():
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from tools.cypher_examples import EXAMPLES, ExampleSelector
+
+    selector = ExampleSelector(DeterministicFakeEmbedding(size=32), k=2)
+    examples = selector.select("When was Casino released?")
+
+    assert examples.startswith("1. When was Casino released?")
+    assert examples.count("```") == 4
+    assert selector.vectors.shape == (len(EXAMPLES), 32)
+
+def test_prompt_budget():
+    from langchain_core.agents import AgentAction
+    from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+    from prompt_budget import TRIMMED_OBSERVATION, PromptBudget
+
+    budget = PromptBudget(chat_history=300, scratchpad=400, observation=200)
+    history = [SystemMessage(content="summary " * 20)] + [HumanMessage(content="question " * 50), AIMessage(content="answer " * 50)] * 3
+    steps = [(AgentAction("Movie information", "movies", "Action: Movie information"), "movie " * 1000)] * 3
+
+    inputs = budget.trim({"input": "all movies", "chat_history": history, "intermediate_steps": steps})
+
+    assert inputs["chat_history"][0] == history[0] and inputs["chat_history"][-1] == history[-1]
+    assert budget.count_messages(inputs["chat_history"]) <= 300
+    assert inputs["intermediate_steps"][0][1] == TRIMMED_OBSERVATION
+    assert budget.count(inputs["intermediate_steps"][-1][1]) <= 200
+
+    record = budget.stats()["last"]
+    assert record["scratchpad"] <= 400 and record["step"] == 3
+    assert budget.trim({"input": "all movies", "chat_history": history, "intermediate_steps": steps}) == inputs
+
+def test_tracing(tmp_path):
+    import asyncio
+    import json
+    from langchain_core.language_models import FakeListChatModel
+    from langchain_core.prompts import ChatPromptTemplate
+    from langchain_core.tools import tool
+    from tracing import Tracer, span
+
+    chain = ChatPromptTemplate.from_messages([("human", "{input}")]) | FakeListChatModel(responses=["Keanu Reeves"])
+    tracer = Tracer(maxlen=2, path=str(tmp_path / "traces.jsonl"))
+
+    with tracer.trace("Who acted in The Matrix?", "session") as trace:
+        with span("neo4j", "query") as outer:
+            chain.invoke({"input": "Who acted in The Matrix?"})
+    with span("neo4j", "untraced") as untraced:
+        assert untraced is None
+
+    kinds = {span.kind: span for span in trace.spans}
+    assert kinds["llm"].parent_id == outer.span_id
+    assert kinds["llm"].attributes["completion_tokens"] > 0
+    assert all(span.seconds is not None for span in trace.spans)
+    assert tracer.last("session") is trace and tracer.last("other") is None
+
+    with open(tmp_path / "traces.jsonl", encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == len(trace.spans) and {line["traceId"] for line in lines} == {trace.trace_id}
+
+    # The export is moved aside once it is full
+    tracer.max_bytes = 1
+    with tracer.trace("Who directed Heat?", "session"):
+        pass
+    assert (tmp_path / "traces.jsonl.1").exists()
+    with open(tmp_path / "traces.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["name"] for line in f] == ["Who directed Heat?"]
+
+    # Concurrent tasks of a turn, and the tools they call, each nest their own spans
+    @tool
+    def lookup(name: str) -> str:
+        """Look a movie up"""
+        with span("neo4j", f"{name} query"):
+            return name
+
+    async def call(name):
+        with span("embedding", name):
+            await asyncio.sleep(0.01)
+            with span("neo4j", f"{name} inner"):
+                await asyncio.sleep(0.01)
+            await lookup.ainvoke({"name": name})
+
+    async def turn():
+        await asyncio.gather(call("a"), call("b"))
+
+    with Tracer().trace("Who directed Heat?", "session") as concurrent:
+        asyncio.run(turn())
+    names = {span.name: span for span in concurrent.spans}
+    ids = {span.span_id: span for span in concurrent.spans}
+    for name in "ab":
+        assert names[f"{name} inner"].parent_id == names[name].span_id
+        lookup_span = ids[names[f"{name} query"].parent_id]
+        assert lookup_span.kind == "tool" and lookup_span.parent_id == names[name].span_id
+
+def test_pool_monitor():
+    from types import SimpleNamespace
+    from pool import PoolMonitor, pool_scope, scoped
+
+    connections = []
+    def acquire(*args, **kwargs):
+        if len(connections) == 2:
+            raise TimeoutError("pool is full")
+        connection = SimpleNamespace(in_use=True)
+        connections.append(connection)
+        return connection
+    def release(*released):
+        for connection in released:
+            connection.in_use = False
+
+    pool = SimpleNamespace(
+        acquire=acquire, release=release, kill_and_release=release,
+        connections={"localhost:7687": connections},
+        pool_config=SimpleNamespace(max_connection_pool_size=2),
+    )
+    monitor = PoolMonitor()
+    monitor.instrument(SimpleNamespace(_pool=pool))
+
+    with pool_scope("history"):
+        history = pool.acquire()
+    tool = scoped("Movie information", lambda: pool.acquire())()
+    with pytest.raises(TimeoutError):
+        scoped("Movie information", pool.acquire)()
+    pool.release(history)
+
+    stats = monitor.stats()
+    assert stats["pools"] == [{"max_size": 2, "open": 2, "in_use": 1, "idle": 1}]
+    assert stats["scopes"]["history"]["acquired"] == 1 and stats["scopes"]["history"]["in_use"] == 0
+    assert stats["scopes"]["Movie information"]["in_use"] == 1 and stats["scopes"]["Movie information"]["failures"] == 1
+    assert tool.pool_scope == "Movie information"
+
+def test_streaming():
+    import asyncio
+    from langchain.agents import AgentExecutor, create_react_agent
+    from langchain_core.language_models import GenericFakeChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.prompts import PromptTemplate
+    from langchain_core.tools import tool
+    from streaming import final_answer_tokens
+
+    @tool
+    def lookup(title: str) -> str:
+        """Look up the cast of a movie"""
+        return "Keanu Reeves, Laurence Fishburne"
+
+    def create_agent(tags):
+        llm = GenericFakeChatModel(messages=iter([
+            AIMessage("Thought: I should look it up\nAction: lookup\nAction Input: The Matrix"),
+            AIMessage("Thought: I know the answer\nFinal Answer: Keanu Reeves starred in it"),
+        ]))
+        prompt = PromptTemplate.from_template("{tools}\n{tool_names}\n{input}\n{agent_scratchpad}")
+        agent = create_react_agent(llm.with_config(tags=tags), [lookup], prompt)
+        return AgentExecutor(agent=agent, tools=[lookup])
+
+    async def stream(tags):
+        events = create_agent(tags).astream_events({"input": "Who acted in The Matrix?"}, version="v2")
+        return [token async for token in final_answer_tokens(events, "agent_llm")]
+
+    # Only the Final Answer is streamed, token by token
+    tokens = asyncio.run(stream(["agent_llm"]))
+    assert len(tokens) > 1 and "".join(tokens) == "Keanu Reeves starred in it"
+
+    # Without the agent's tokens, the executor output is sent in one piece
+    assert asyncio.run(stream([])) == ["Keanu Reeves starred in it"]
+
+def test_resource_registry():
+    from resources import ResourceRegistry
+
+    registry = ResourceRegistry()
+    built, closed = [], []
+
+    def factory(name):
+        def build():
+            built.append(name)
+            return name
+        return build
+
+    def check(value):
+        if value == "graph":
+            raise ConnectionError("Neo4j is unavailable")
+
+    # A name is built once, by the factory it was first registered with
+    registry.register("llm", factory("llm"), health_check=check, teardown=closed.append)
+    registry.register("llm", factory("other"))
+    assert registry.get("llm") == "llm" and registry.get("llm") == "llm"
+    assert built == ["llm"]
+
+    # Provided resources replace registered ones, built or not
+    registry.register("vector", factory("unused"))
+    registry.provide("vector", "vector", teardown=closed.append)
+    registry.register("vector", factory("unused"))
+    assert registry.get("vector") == "vector" and "unused" not in built
+
+    # Only built resources are checked, and a failed check is reported
+    registry.register("graph", factory("graph"), health_check=check, teardown=closed.append)
+    assert set(registry.health()) == {"llm", "vector"}
+    assert all(status["ok"] for status in registry.health().values())
+    registry.get("graph")
+    assert registry.health()["graph"]["ok"] is False
+    assert registry.health()["graph"]["error"] == "Neo4j is unavailable"
+
+    # A discarded resource is rebuilt, and everything is closed newest first
+    registry.discard("llm")
+    assert closed == ["llm"] and registry.get("llm") == "llm" and built == ["llm", "graph", "llm"]
+    registry.close()
+    assert closed == ["llm", "llm", "graph", "vector"]
+    assert not any(stats["built"] for stats in registry.stats().values())
+
+def test_agent_service():
+    import asyncio
+    import threading
+    from types import SimpleNamespace
+    from starlette.testclient import TestClient
+    from service import create_app
+
+    release = asyncio.Event()
+
+    async def agenerate_response(user_input, session_id):
+        # The first turn waits for the second, so both must be answered at once
+        if user_input == "first":
+            await release.wait()
+        else:
+            release.set()
+        return f"{user_input} for {session_id}"
+
+    async def astream_answer(user_input, session_id):
+        yield "Jaws was "
+        if user_input == "fail":
+            raise RuntimeError("Neo4j is unavailable")
+        yield "directed by Steven Spielberg"
+
+    health = {"graph": {"ok": True, "build_seconds": 0.1}}
+
+    agent = SimpleNamespace(agenerate_response=agenerate_response, astream_answer=astream_answer)
+    with TestClient(create_app(lambda: agent, lambda: None, lambda: health)) as client:
+        answers = {}
+        first = threading.Thread(target=lambda: answers.update(
+            first=client.post("/generate", json={"input": "first", "session_id": "s1"}).json()
+        ))
+        first.start()
+        assert client.post("/generate", json={"input": "second", "session_id": 2}).json() == {"output": "second for 2"}
+        first.join(5)
+        assert answers["first"] == {"output": "first for s1"}
+
+        # Malformed bodies are rejected, not failed
+        for body in ["{not json", "[1, 2]", '{"input": "Who directed Jaws?"}']:
+            assert client.post("/generate", content=body).status_code == 400
+
+        stream = client.post("/stream", json={"input": "Who directed Jaws?", "session_id": "s1"})
+        assert stream.text.count("event: token") == 2 and stream.text.endswith("event: done\ndata: {}\n\n")
+        failed = client.post("/stream", json={"input": "fail", "session_id": "s1"})
+        assert "event: error" in failed.text and "Neo4j is unavailable" in failed.text
+        assert client.get("/health").json() == {"status": "ok", "resources": health}
+        health["graph"] = {"ok": False, "build_seconds": 0.1, "error": "Neo4j is unavailable"}
+        unhealthy = client.get("/health")
+        assert unhealthy.status_code == 503 and unhealthy.json()["status"] == "unhealthy"
+
+def test_agent_client():
+    import json
+    from contextlib import nullcontext
+    from types import SimpleNamespace
+    from client import AgentClient, AgentServiceError
+
+    def response(status_code, text, lines=()):
+        return SimpleNamespace(
+            ok=status_code < 400, status_code=status_code, text=text, json=lambda: json.loads(text),
+            iter_lines=lambda decode_unicode: iter(lines),
+        )
+
+    responses = []
+    client = AgentClient("http://agent/")
+    client.session = SimpleNamespace(post=lambda url, **kwargs: responses.pop(0))
+
+    responses.append(response(200, '{"output": "Steven Spielberg"}'))
+    assert client.generate("Who directed Jaws?", "s1") == "Steven Spielberg"
+
+    # Errors that are not the service's own JSON, eg. from a proxy, are still reported
+    responses.append(response(502, "<html>Bad Gateway</html>"))
+    with pytest.raises(AgentServiceError, match="Bad Gateway"):
+        client.generate("Who directed Jaws?", "s1")
+    responses.append(response(500, '{"error": "Neo4j is unavailable"}'))
+    with pytest.raises(AgentServiceError, match="Neo4j is unavailable"):
+        client.generate("Who directed Jaws?", "s1")
+
+    events = ["event: token", 'data: {"token": "Steven "}', "", "event: token", 'data: {"token": "Spielberg"}', "",
+              "event: done", "data: {}"]
+    responses.append(nullcontext(response(200, "", events)))
+    assert "".join(client.stream("Who directed Jaws?", "s1")) == "Steven Spielberg"
+
+def test_single_flight():
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from singleflight import SingleFlight, normalize_key
+
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def answer(question):
+        calls.append(question)
+        started.set()
+        release.wait(5)
+        return question.upper()
+
+    plot = flights.wrap("Movie Plot Search", answer)
+    with ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(plot, "Who directed Jaws?")
+        started.wait(5)
+        followers = [executor.submit(plot, question) for question in ["who directed  jaws", "Who directed JAWS"]]
+        # Wait for both followers to join the flight
+        deadline = time.monotonic() + 5
+        while flights.stats()["coalesced"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+
+    assert calls == ["Who directed Jaws?"]
+    assert [future.result() for future in followers] == ["WHO DIRECTED JAWS?"] * 2
+    assert leader.result() == "WHO DIRECTED JAWS?"
+    assert flights.stats() == {"in_flight": 0, "leaders": 1, "coalesced": 2, "coalesced_rate": 2 / 3}
+
+    # Nothing is kept once the flight lands
+    assert plot("Who directed Jaws?") == "WHO DIRECTED JAWS?" and len(calls) == 2
+    assert normalize_key(" Who directed Jaws? ") == "who directed jaws"
+
+    # Cancelling one async follower leaves the leader and the others alone
+    import asyncio
+
+    async def slow_answer(question):
+        await asyncio.sleep(0.05)
+        return question.upper()
+
+    async def cancel_one_follower():
+        aplot = flights.wrap("Movie Plot Search", slow_answer)
+        leader = asyncio.ensure_future(aplot("Who is in Heat?"))
+        await asyncio.sleep(0)
+        quitter = asyncio.ensure_future(aplot("who is in heat"))
+        follower = asyncio.ensure_future(aplot("WHO IS IN HEAT?"))
+        await asyncio.sleep(0)
+        quitter.cancel()
+        return await asyncio.gather(leader, follower, quitter, return_exceptions=True)
+
+    answer, shared, cancelled = asyncio.run(cancel_one_follower())
+    assert answer == shared == "WHO IS IN HEAT?"
+    assert isinstance(cancelled, asyncio.CancelledError)
+    assert flights.stats()["in_flight"] == 0
+
+def test_openai_scheduler():
+    import threading
+    import time
+    import httpx
+    from scheduler import BACKGROUND, INTERACTIVE, OpenAIScheduler, SchedulingTransport, lane, parse_duration
+
+    scheduler = OpenAIScheduler(requests_per_minute=600, tokens_per_minute=10000, max_in_flight=1)
+
+    # While a request is in flight, a later interactive request goes before an earlier background one
+    scheduler.acquire(100)
+    admitted = []
+    def ask(priority):
+        with lane(priority):
+            scheduler.acquire(100)
+        admitted.append(priority)
+        scheduler.release()
+    threads = [threading.Thread(target=ask, args=(priority,)) for priority in (BACKGROUND, INTERACTIVE)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    scheduler.release()
+    for thread in threads:
+        thread.join(5)
+    assert admitted == [INTERACTIVE, BACKGROUND]
+
+    # A 429 pauses every lane, and the headers set the limits
+    def openai(request):
+        return httpx.Response(429, headers={
+            "retry-after-ms": "200",
+            "x-ratelimit-limit-requests": "60",
+            "x-ratelimit-remaining-requests": "0",
+        }, json={"error": {"message": "Rate limit reached"}})
+    client = httpx.Client(transport=SchedulingTransport(scheduler, httpx.MockTransport(openai)))
+
+    assert client.post("https://api.openai.com/v1/embeddings", json={"input": "The Matrix"}).status_code == 429
+    stats = scheduler.stats()
+    assert stats["rate_limited"] == 1 and stats["in_flight"] == 0
+    assert stats["limits"]["requests"] == 60 and 0 < stats["paused_for"] <= 0.2
+    assert parse_duration("6m0s") == 360 and parse_duration("20ms") == 0.02
+
+    # A process sharing the account with three others keeps to a quarter of its limits
+    shared = OpenAIScheduler(requests_per_minute=600, tokens_per_minute=10000, share=0.25)
+    assert shared.stats()["limits"] == {"requests": 150, "tokens": 2500}
+    shared.observe(httpx.Response(200, headers={"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "8"}))
+    assert shared.stats()["limits"]["requests"] == 15 and shared.stats()["requests_available"] <= 2.01
+
+    # Queued async requests wait on the loop, without taking a thread each, and a release wakes them in order
+    import asyncio
+
+    async def queue_async():
+        scheduler = OpenAIScheduler(requests_per_minute=6000, tokens_per_minute=100000, max_in_flight=1)
+        await scheduler.aacquire(100)
+        admitted = []
+        async def ask(name, priority):
+            await scheduler.aacquire(100, priority)
+            admitted.append(name)
+            scheduler.release()
+        threads = threading.active_count()
+        tasks = [asyncio.ensure_future(ask(name, priority)) for name, priority in
+                 [("report", BACKGROUND), ("quitter", INTERACTIVE), ("chat", INTERACTIVE)]]
+        await asyncio.sleep(0.05)
+        assert threading.active_count() == threads and scheduler.stats()["queued"] == 3
+        tasks[1].cancel()
+        # Released from another thread, as a sync request would
+        threading.Thread(target=scheduler.release).start()
+        await asyncio.wait(tasks, timeout=5)
+        return admitted, scheduler.stats()
+
+    admitted, stats = asyncio.run(queue_async())
+    assert admitted == ["chat", "report"]
+    assert stats["queued"] == 0 and stats["in_flight"] == 0
+
+
+def test_transcript():
+    from streamlit.testing.v1 import AppTest
+
+    def page():
+        import streamlit as st
+        from utils import write_transcript
+
+        if "messages" not in st.session_state:
+            st.session_state.messages = [{"role": "user", "content": f"Message {i}"} for i in range(45)]
+        write_transcript(st.session_state.messages, window=10, page_size=20)
+
+    app = AppTest.from_function(page).run()
+    assert not app.exception
+    assert [message.markdown[0].value for message in app.chat_message] == [f"Message {i}" for i in range(35, 45)]
+    assert app.expander[0].label == "Earlier messages (35)"
+
+    # Earlier messages are only drawn once their page is picked
+    app.selectbox(key="transcript_page").select_index(1).run()
+    assert [message.markdown[0].value for message in app.chat_message][:15] == [f"Message {i}" for i in range(20, 35)]
+    assert len(app.chat_message) == 25
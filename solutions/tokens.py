@@ -0,0 +1,71 @@
+import hashlib
+import logging
+from functools import lru_cache
+
+from cache import TTLCache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+@lru_cache(maxsize=8)
+def get_encoding(model="gpt-4"):
+    """
+    Load the tokenizer for a model once per process, or None if it
+    is not available
+    """
+    if tiktoken is None:
+        return None
+
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # tiktoken downloads encodings on first use
+        logger.warning("Could not load a tokenizer for %s, estimating token counts", model)
+        return None
+
+# Counts keyed on a digest of the text, so the cache does not keep
+# every prompt section it has counted alive
+token_counts = TTLCache(maxsize=4096)
+
+def count_tokens(text, model="gpt-4"):
+    """
+    Count the tokens in text, estimating four characters per token
+    if tiktoken is not installed.  Counts are cached, as the same
+    prompt sections are counted again on every step of a turn.
+    """
+    key = (hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest(), model)
+    count = token_counts.get(key)
+    if count is None:
+        count = _count_tokens(text, model)
+        token_counts.set(key, count)
+    return count
+
+def _count_tokens(text, model):
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens, model="gpt-4", marker="..."):
+    """
+    Cut text down to its first max_tokens tokens, marking where it was cut
+    """
+    if count_tokens(text, model) <= max_tokens:
+        return text
+
+    # Leave room for the marker
+    max_tokens = max(max_tokens - count_tokens(marker, model), 0)
+
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * 4] + marker
+
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) + marker
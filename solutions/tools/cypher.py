@@ -1,8 +1,16 @@
-from langchain_neo4j import GraphCypherQAChain
 from langchain.prompts.prompt import PromptTemplate
 
-from llm import llm
-from graph import graph
+from llm import llm, embeddings
+from graph import graph, async_graph
+from config import get_setting
+from resources import get_registry
+from tools.cypher_chain import MovieCypherQAChain
+from tools.cypher_cache import CypherCache
+from tools.cypher_examples import ExampleSelector
+from tools.cypher_guard import CypherGuard
+from tools.cypher_params import PlanCacheMonitor
+from tools.entity_index import EntityIndex, refresh_in_background
+from schema_snapshot import watch_schema
 
 CYPHER_GENERATION_TEMPLATE = """
 You are an expert Neo4j Developer translating user questions into Cypher to answer questions about movies and provide recommendations.
@@ -16,42 +24,11 @@ Do not return entire nodes or embedding properties.
 Fine Tuning:
 
 For movie titles that begin with "The", move "the" to the end. For example "The 39 Steps" becomes "39 Steps, The" or "the matrix" becomes "Matrix, The".
+Titles and names in double quotes are already written exactly as they are stored, use them as they are.
 
 Example Cypher Statements:
 
-1. To find who acted in a movie:
-```
-MATCH (p:Person)-[r:ACTED_IN]->(m:Movie {{title: "Movie Title"}})
-RETURN p.name, r.role
-```
-
-2. To find who directed a movie:
-```
-MATCH (p:Person)-[r:DIRECTED]->(m:Movie {{title: "Movie Title"}})
-RETURN p.name
-```
-
-3. How to find how many degrees of separation there are between two people:
-```
-MATCH path = shortestPath(
-  (p1:Person {{name: "Actor 1"}})-[:ACTED_IN|DIRECTED*]-(p2:Person {{name: "Actor 2"}})
-)
-WITH path, p1, p2, relationships(path) AS rels
-RETURN
-  p1 {{ .name, .born, link:'https://www.themoviedb.org/person/'+ p1.tmdbId }} AS start,
-  p2 {{ .name, .born, link:'https://www.themoviedb.org/person/'+ p2.tmdbId }} AS end,
-  reduce(output = '', i in range(0, length(path)-1) |
-    output + CASE
-      WHEN i = 0 THEN
-       startNode(rels[i]).name + CASE WHEN type(rels[i]) = 'ACTED_IN' THEN ' played '+ rels[i].role +' in 'ELSE ' directed ' END + endNode(rels[i]).title
-       ELSE
-         ' with '+ startNode(rels[i]).name + ', who '+ CASE WHEN type(rels[i]) = 'ACTED_IN' THEN 'played '+ rels[i].role +' in '
-    ELSE 'directed '
-      END + endNode(rels[i]).title
-      END
-  ) AS pathBetweenPeople
-```
-
+{examples}
 Schema:
 {schema}
 
@@ -61,10 +38,90 @@ Question:
 
 cypher_prompt = PromptTemplate.from_template(CYPHER_GENERATION_TEMPLATE)
 
-cypher_qa = GraphCypherQAChain.from_llm(
+# Reuse generated Cypher for questions that only differ by title or name
+def create_cypher_cache():
+    return CypherCache(
+        maxsize=get_setting("CYPHER_CACHE_SIZE", 256),
+        ttl=get_setting("CYPHER_CACHE_TTL", 3600),
+    )
+
+cypher_cache = get_registry().register("cypher_cache", create_cypher_cache).get("cypher_cache")
+
+# Check generated Cypher against its EXPLAIN plan before running it
+def create_cypher_guard():
+    if not get_setting("CYPHER_GUARD", False):
+        return None
+
+    return CypherGuard(
+        graph,
+        async_graph,
+        max_path_length=get_setting("CYPHER_MAX_PATH_LENGTH", 6),
+        limit=get_setting("CYPHER_MAX_ROWS", 10) * 10,
+        max_estimated_rows=get_setting("CYPHER_MAX_ESTIMATED_ROWS", 1_000_000),
+    )
+
+cypher_guard = get_registry().register("cypher_guard", create_cypher_guard).get("cypher_guard")
+
+# Estimate how often Neo4j can reuse a cached plan for generated Cypher
+def create_plan_cache():
+    return PlanCacheMonitor(maxsize=get_setting("CYPHER_PLAN_CACHE_SIZE", 1000))
+
+plan_cache = get_registry().register("plan_cache", create_plan_cache).get("plan_cache")
+
+# Rewrite titles and names in the question as they are stored in Neo4j
+def create_entity_index():
+    index = EntityIndex()
+    index.refresh(graph)
+    index.stop_refresh = refresh_in_background(
+        index, graph, get_setting("ENTITY_INDEX_REFRESH_INTERVAL", 600)
+    )
+    return index
+
+entity_index = None
+if get_setting("ENTITY_RESOLVER", False):
+    entity_index = get_registry().register(
+        "entity_index",
+        create_entity_index,
+        teardown=lambda index: index.stop_refresh.set(),
+    ).get("entity_index")
+
+# Only include the examples most similar to the question in the prompt
+def create_example_selector():
+    return ExampleSelector(embeddings, k=get_setting("CYPHER_EXAMPLES_K", 3))
+
+example_selector = get_registry().register("example_selector", create_example_selector).get("example_selector")
+
+cypher_qa = MovieCypherQAChain.from_llm(
     llm,
     graph=graph,
     verbose=True,
     cypher_prompt=cypher_prompt,
+    cypher_cache=cypher_cache,
+    async_graph=async_graph,
+    cypher_guard=cypher_guard,
+    query_timeout=get_setting("CYPHER_QUERY_TIMEOUT", 10),
+    lift_literals=get_setting("CYPHER_PARAMETERIZE", True),
+    plan_cache=plan_cache,
+    entity_index=entity_index,
+    example_selector=example_selector,
+    top_k=get_setting("CYPHER_MAX_ROWS", 10),
+    token_budget=get_setting("CYPHER_TOKEN_BUDGET", 2000),
+    model_name=get_setting("OPENAI_MODEL", "gpt-4"),
     allow_dangerous_requests=True
-)
\ No newline at end of file
+)
+
+# Refresh the schema in the Cypher prompt when the database schema changes
+def create_schema_watch():
+    return watch_schema(
+        graph,
+        get_setting("SCHEMA_SNAPSHOT_PATH", ".cache/schema.json"),
+        get_setting("SCHEMA_REFRESH_INTERVAL", 0),
+        chains=[cypher_qa],
+    )
+
+if get_setting("SCHEMA_REFRESH_INTERVAL", 0):
+    get_registry().register(
+        "schema_watch",
+        create_schema_watch,
+        teardown=lambda stopped: stopped.set(),
+    ).get("schema_watch")
@@ -0,0 +1,190 @@
+import re
+
+from cache import TTLCache
+
+# Capitalised words that start a question rather than name an entity
+QUESTION_WORDS = {
+    "who", "what", "which", "when", "where", "why", "how", "did", "does",
+    "do", "is", "are", "was", "were", "can", "could", "tell", "list", "show",
+    "find", "name", "give", "i", "me", "in", "and", "or",
+}
+
+# Lower case words allowed inside a title, eg. "Lord of the Rings"
+CONNECTORS = {"of", "the", "a", "an", "in", "on", "to", "for", "de", "at"}
+
+WORD = re.compile(r"[A-Za-z0-9][\w'&:.-]*")
+QUOTED = re.compile(r'"([^"]+)"')
+NUMBER = re.compile(r"^\d+(\.\d+)?$")
+LITERAL = re.compile(
+    r'"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'|(?<![\w$.*])\d+(?:\.\d+)?(?![\w.])'
+)
+
+
+def move_article(value):
+    """
+    Move a leading "The" to the end of a title, as the Cypher prompt
+    asks the LLM to do, eg. "The Matrix" becomes "Matrix, The"
+    """
+    if value.lower().startswith("the "):
+        return f"{value[4:]}, {value[:3]}"
+    return value
+
+
+# How a literal in the statement was derived from the entity, so a cache
+# hit derives its parameter the same way, eg. toLower(m.title) = "the matrix"
+TRANSFORMS = {
+    "identity": lambda value: value,
+    "article": move_article,
+    "lower": lambda value: value.lower(),
+    "article_lower": lambda value: move_article(value).lower(),
+}
+
+
+def extract_entities(question):
+    """
+    Split a question into a normalised template and the entity literals
+    it mentions: quoted strings, capitalised names and titles, and numbers.
+
+    "Who acted in The Matrix?" becomes ("who acted in {0}", ["The Matrix"])
+    """
+    entities = []
+    spans = []
+
+    for match in QUOTED.finditer(question):
+        entities.append(match.group(1))
+        spans.append(match.span())
+
+    words = [
+        match for match in WORD.finditer(question)
+        if not any(start <= match.start() < end for start, end in spans)
+    ]
+
+    i = 0
+    while i < len(words):
+        text = words[i].group(0).rstrip(".:")
+
+        if NUMBER.match(text):
+            entities.append(float(text) if "." in text else int(text))
+            spans.append((words[i].start(), words[i].start() + len(text)))
+            i += 1
+            continue
+
+        if not text[0].isupper() or text.lower() in QUESTION_WORDS:
+            i += 1
+            continue
+
+        # Extend the run over capitalised words and the connectors between them
+        end = i
+        j = i + 1
+        while j < len(words):
+            word = words[j].group(0)
+            gap = question[words[j - 1].end():words[j].start()]
+            if gap.strip():
+                break
+            if word[0].isupper() or (word[0].isdigit() and end == j - 1):
+                end = j
+            elif word.lower() not in CONNECTORS:
+                break
+            j += 1
+
+        start, stop = words[i].start(), words[end].end()
+        entity = question[start:stop].rstrip("?.!,:")
+        entities.append(entity)
+        spans.append((start, start + len(entity)))
+        i = end + 1
+
+    template = question
+    for index, (start, stop) in sorted(enumerate(spans), key=lambda s: -s[1][0]):
+        template = template[:start] + "{" + str(index) + "}" + template[stop:]
+
+    template = " ".join(template.lower().split()).rstrip("?.! ")
+
+    return template, entities
+
+
+def parameterize_entities(cypher, entities):
+    """
+    Replace the literals in a generated Cypher statement that match the
+    question's entities with $e0, $e1... parameters.
+
+    Returns the parameterised statement and the transform used for each
+    entity, or None if any entity could not be found in the statement.
+    """
+    transforms = {}
+
+    def replace(match):
+        if match.group(0)[0] in "\"'":
+            literal = match.group(1) if match.group(1) is not None else match.group(2)
+        else:
+            literal = match.group(0)
+
+        for index, entity in enumerate(entities):
+            if isinstance(entity, str):
+                candidates = [(name, transform(entity)) for name, transform in TRANSFORMS.items()]
+            else:
+                candidates = [("identity", str(entity))]
+
+            for name, value in candidates:
+                if literal == value:
+                    transforms[index] = name
+                    return f"$e{index}"
+
+        return match.group(0)
+
+    cypher = LITERAL.sub(replace, cypher)
+
+    if len(transforms) < len(entities):
+        return None
+
+    return cypher, [transforms[i] for i in range(len(entities))]
+
+
+class CypherCache:
+    """
+    Cache of generated Cypher keyed on the normalised question template.
+
+    Entity literals are lifted into parameters so that "Who acted in Heat?"
+    and "Who acted in Casino?" share the same cached statement, and a hit
+    skips the Cypher generation LLM call.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def lookup(self, question):
+        """
+        Return the cached statement and its parameters for a question, or None
+        """
+        template, entities = extract_entities(question)
+        entry = self._cache.get(template)
+
+        if entry is None:
+            return None
+
+        cypher, transforms = entry
+        params = {
+            f"e{i}": TRANSFORMS[transform](entity) if isinstance(entity, str) else entity
+            for i, (entity, transform) in enumerate(zip(entities, transforms))
+        }
+
+        return cypher, params
+
+    def store(self, question, cypher):
+        """
+        Parameterise and cache a statement generated for a question.
+        Returns False if the statement could not be safely parameterised.
+        """
+        template, entities = extract_entities(question)
+        parameterized = parameterize_entities(cypher, entities)
+
+        if parameterized is None:
+            return False
+
+        self._cache.set(template, parameterized)
+        return True
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
@@ -0,0 +1,295 @@
+from typing import Any, Dict, List, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForChainRun,
+    CallbackManagerForChainRun,
+)
+from langchain_neo4j import GraphCypherQAChain
+from langchain_neo4j.chains.graph_qa.cypher import construct_schema, extract_cypher
+from neo4j import Query
+from pydantic import Field
+
+from tracing import span
+from tools.cypher_guard import REJECTED_NOTE
+from tools.cypher_params import parameterize_literals
+from tools.cypher_results import RowBudget
+
+class MovieCypherQAChain(GraphCypherQAChain):
+    """
+    GraphCypherQAChain that splits the question into separate stages -
+    Cypher generation, execution and answering - so each stage can be
+    optimised on its own.
+
+    When a cypher_cache is provided, Cypher generated for a question is
+    reused for questions of the same shape, skipping the generation LLM call.
+
+    When an async_graph is provided, ainvoke() awaits the LLM and the
+    async Neo4j driver at every stage.
+
+    Results are streamed from the driver and reading stops after top_k
+    rows or token_budget tokens, with a note added to the QA prompt when
+    the result was cut short.
+
+    When a cypher_guard is provided, each statement is checked against its
+    EXPLAIN plan first and may be rewritten or rejected.  Statements run
+    under query_timeout seconds when it is set.
+
+    String and number literals are lifted into parameters before a
+    statement runs, so Neo4j can reuse its plan, and each execution is
+    recorded with the plan_cache monitor when one is provided.
+
+    When an entity_index is provided, the titles and names in the question
+    are rewritten as they are stored in the database before generation.
+
+    When an example_selector is provided, the {examples} in the Cypher
+    prompt are the ones most similar to the question.
+    """
+
+    cypher_cache: Optional[Any] = Field(default=None, exclude=True)
+    async_graph: Optional[Any] = Field(default=None, exclude=True)
+    cypher_guard: Optional[Any] = Field(default=None, exclude=True)
+    query_timeout: Optional[float] = None
+    lift_literals: bool = True
+    plan_cache: Optional[Any] = Field(default=None, exclude=True)
+    entity_index: Optional[Any] = Field(default=None, exclude=True)
+    example_selector: Optional[Any] = Field(default=None, exclude=True)
+    token_budget: int = 2000
+    max_value_chars: int = 500
+    max_list_items: int = 20
+    model_name: str = "gpt-4"
+
+    def update_schema(self):
+        """
+        Rebuild the schema in the Cypher prompt from the graph's, once it
+        has been refreshed, and drop the Cypher generated for the old one
+        """
+        self.graph_schema = construct_schema(self.graph.get_structured_schema, [], [])
+        if self.cypher_cache is not None:
+            self.cypher_cache.clear()
+
+    def canonicalize(self, question):
+        if self.entity_index is None:
+            return question
+        return self.entity_index.canonicalize(question)
+
+    def generate_cypher(self, question, callbacks=None):
+        """
+        Return the Cypher statement and parameters to answer the question
+        """
+        if self.cypher_cache is not None:
+            cached = self.cypher_cache.lookup(question)
+            if cached is not None:
+                return cached
+
+        examples = self.example_selector.select(question) if self.example_selector else ""
+
+        generated_cypher = self.cypher_generation_chain.run(
+            {"question": question, "schema": self.graph_schema, "examples": examples},
+            callbacks=callbacks,
+        )
+
+        return self._prepare_cypher(question, generated_cypher)
+
+    async def agenerate_cypher(self, question, callbacks=None):
+        if self.cypher_cache is not None:
+            cached = self.cypher_cache.lookup(question)
+            if cached is not None:
+                return cached
+
+        examples = await self.example_selector.aselect(question) if self.example_selector else ""
+
+        result = await self.cypher_generation_chain.ainvoke(
+            {"question": question, "schema": self.graph_schema, "examples": examples},
+            {"callbacks": callbacks},
+        )
+        generated_cypher = result[self.cypher_generation_chain.output_key]
+
+        return self._prepare_cypher(question, generated_cypher)
+
+    def _prepare_cypher(self, question, generated_cypher):
+        # Extract Cypher code if it is wrapped in backticks
+        generated_cypher = extract_cypher(generated_cypher)
+
+        if self.cypher_query_corrector:
+            generated_cypher = self.cypher_query_corrector(generated_cypher)
+
+        if generated_cypher and self.cypher_cache is not None:
+            self.cypher_cache.store(question, generated_cypher)
+
+        return generated_cypher, {}
+
+    def _budget(self):
+        return RowBudget(
+            max_rows=self.top_k,
+            token_budget=self.token_budget,
+            max_chars=self.max_value_chars,
+            max_items=self.max_list_items,
+            model=self.model_name,
+        )
+
+    def run_cypher(self, cypher, params):
+        """
+        Stream the rows of the statement into a RowBudget, stopping as soon
+        as the budget is spent
+        """
+        budget = self._budget()
+        if self.plan_cache is not None:
+            self.plan_cache.record(cypher)
+
+        # Fetch one row more than needed to tell whether the result was cut short
+        with span("neo4j", "run_cypher", cypher=cypher) as traced:
+            with self.graph._driver.session(
+                database=self.graph._database, fetch_size=self.top_k + 1
+            ) as session:
+                query = Query(cypher, timeout=self.query_timeout or self.graph.timeout)
+                result = session.run(query, params)
+                for record in result:
+                    if not budget.add(record.data()):
+                        break
+
+            if traced is not None:
+                traced.attributes.update(rows=len(budget.rows), truncated=budget.truncated)
+
+        return budget
+
+    async def arun_cypher(self, cypher, params):
+        if self.async_graph is None:
+            return self.run_cypher(cypher, params)
+
+        budget = self._budget()
+        if self.plan_cache is not None:
+            self.plan_cache.record(cypher)
+
+        with span("neo4j", "run_cypher", cypher=cypher) as traced:
+            async with self.async_graph._driver.session(
+                database=self.async_graph._database, fetch_size=self.top_k + 1
+            ) as session:
+                query = Query(cypher, timeout=self.query_timeout or self.async_graph.timeout)
+                result = await session.run(query, params)
+                async for record in result:
+                    if not budget.add(record.data()):
+                        break
+
+            if traced is not None:
+                traced.attributes.update(rows=len(budget.rows), truncated=budget.truncated)
+
+        return budget
+
+    def _qa_inputs(self, question, context, note):
+        if note:
+            context = f"{context}\n\n{note}"
+        return {"question": question, "context": context}
+
+    def answer(self, question, context, callbacks=None, note=None):
+        """
+        Use the QA chain to answer the question from the query results
+        """
+        result = self.qa_chain.invoke(
+            self._qa_inputs(question, context, note),
+            callbacks=callbacks,
+        )
+        return result[self.qa_chain.output_key]
+
+    async def aanswer(self, question, context, callbacks=None, note=None):
+        result = await self.qa_chain.ainvoke(
+            self._qa_inputs(question, context, note),
+            callbacks=callbacks,
+        )
+        return result[self.qa_chain.output_key]
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        callbacks = _run_manager.get_child()
+        question = inputs[self.input_key]
+        intermediate_steps: List = []
+
+        cypher, params = self.generate_cypher(self.canonicalize(question), callbacks)
+
+        if cypher and self.lift_literals:
+            cypher, params = parameterize_literals(cypher, params)
+
+        rejected = None
+        if cypher and self.cypher_guard is not None:
+            cypher, rejected = self.cypher_guard.check(cypher, params)
+
+        _run_manager.on_text("Generated Cypher:", end="\n", verbose=self.verbose)
+        _run_manager.on_text(cypher, color="green", end="\n", verbose=self.verbose)
+        if params:
+            _run_manager.on_text(str(params), color="green", end="\n", verbose=self.verbose)
+
+        intermediate_steps.append({"query": cypher, "params": params})
+
+        if rejected:
+            _run_manager.on_text(f"Rejected: {rejected}", color="red", end="\n", verbose=self.verbose)
+
+        # Generated Cypher be null if query corrector identifies invalid schema
+        budget = self.run_cypher(cypher, params) if cypher and not rejected else self._budget()
+        context = budget.rows
+        note = REJECTED_NOTE.format(reason=rejected) if rejected else budget.note()
+
+        if self.return_direct:
+            final_result = context
+        else:
+            _run_manager.on_text("Full Context:", end="\n", verbose=self.verbose)
+            _run_manager.on_text(str(context), color="green", end="\n", verbose=self.verbose)
+
+            intermediate_steps.append({"context": context, "truncated": budget.truncated})
+            final_result = self.answer(question, context, callbacks, note)
+
+        chain_result: Dict[str, Any] = {self.output_key: final_result}
+        if self.return_intermediate_steps:
+            chain_result["intermediate_steps"] = intermediate_steps
+
+        return chain_result
+
+    async def _acall(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        callbacks = _run_manager.get_child()
+        question = inputs[self.input_key]
+        intermediate_steps: List = []
+
+        cypher, params = await self.agenerate_cypher(self.canonicalize(question), callbacks)
+
+        if cypher and self.lift_literals:
+            cypher, params = parameterize_literals(cypher, params)
+
+        rejected = None
+        if cypher and self.cypher_guard is not None:
+            cypher, rejected = await self.cypher_guard.acheck(cypher, params)
+
+        await _run_manager.on_text("Generated Cypher:", end="\n", verbose=self.verbose)
+        await _run_manager.on_text(cypher, color="green", end="\n", verbose=self.verbose)
+        if params:
+            await _run_manager.on_text(str(params), color="green", end="\n", verbose=self.verbose)
+
+        intermediate_steps.append({"query": cypher, "params": params})
+
+        if rejected:
+            await _run_manager.on_text(f"Rejected: {rejected}", color="red", end="\n", verbose=self.verbose)
+
+        budget = await self.arun_cypher(cypher, params) if cypher and not rejected else self._budget()
+        context = budget.rows
+        note = REJECTED_NOTE.format(reason=rejected) if rejected else budget.note()
+
+        if self.return_direct:
+            final_result = context
+        else:
+            await _run_manager.on_text("Full Context:", end="\n", verbose=self.verbose)
+            await _run_manager.on_text(str(context), color="green", end="\n", verbose=self.verbose)
+
+            intermediate_steps.append({"context": context, "truncated": budget.truncated})
+            final_result = await self.aanswer(question, context, callbacks, note)
+
+        chain_result: Dict[str, Any] = {self.output_key: final_result}
+        if self.return_intermediate_steps:
+            chain_result["intermediate_steps"] = intermediate_steps
+
+        return chain_result
@@ -0,0 +1,151 @@
+import threading
+
+import numpy as np
+
+# Example questions and the Cypher that answers them
+EXAMPLES = [
+    ("Who acted in The Matrix?", """
+MATCH (p:Person)-[r:ACTED_IN]->(m:Movie {title: "Matrix, The"})
+RETURN p.name, r.role
+"""),
+    ("Who directed Toy Story?", """
+MATCH (p:Person)-[r:DIRECTED]->(m:Movie {title: "Toy Story"})
+RETURN p.name
+"""),
+    ("How many degrees of separation are there between Tom Hanks and Kevin Bacon?", """
+MATCH path = shortestPath(
+  (p1:Person {name: "Tom Hanks"})-[:ACTED_IN|DIRECTED*]-(p2:Person {name: "Kevin Bacon"})
+)
+WITH path, p1, p2, relationships(path) AS rels
+RETURN
+  p1 { .name, .born, link:'https://www.themoviedb.org/person/'+ p1.tmdbId } AS start,
+  p2 { .name, .born, link:'https://www.themoviedb.org/person/'+ p2.tmdbId } AS end,
+  reduce(output = '', i in range(0, length(path)-1) |
+    output + CASE
+      WHEN i = 0 THEN
+       startNode(rels[i]).name + CASE WHEN type(rels[i]) = 'ACTED_IN' THEN ' played '+ rels[i].role +' in 'ELSE ' directed ' END + endNode(rels[i]).title
+       ELSE
+         ' with '+ startNode(rels[i]).name + ', who '+ CASE WHEN type(rels[i]) = 'ACTED_IN' THEN 'played '+ rels[i].role +' in '
+    ELSE 'directed '
+      END + endNode(rels[i]).title
+      END
+  ) AS pathBetweenPeople
+"""),
+    ("What role did Tom Hanks play in Apollo 13?", """
+MATCH (p:Person {name: "Tom Hanks"})-[r:ACTED_IN]->(m:Movie {title: "Apollo 13"})
+RETURN r.role
+"""),
+    ("Which movies has Keanu Reeves acted in?", """
+MATCH (p:Person {name: "Keanu Reeves"})-[:ACTED_IN]->(m:Movie)
+RETURN m.title, m.year
+ORDER BY m.year
+"""),
+    ("How many movies has Steven Spielberg directed?", """
+MATCH (p:Person {name: "Steven Spielberg"})-[:DIRECTED]->(m:Movie)
+RETURN count(m) AS movies
+"""),
+    ("When was Casino released?", """
+MATCH (m:Movie {title: "Casino"})
+RETURN m.title, m.released, m.year
+"""),
+    ("What genre is The Godfather?", """
+MATCH (m:Movie {title: "Godfather, The"})-[:IN_GENRE]->(g:Genre)
+RETURN g.name
+"""),
+    ("What are the highest rated comedies?", """
+MATCH (m:Movie)-[:IN_GENRE]->(:Genre {name: "Comedy"})
+WHERE m.imdbRating IS NOT NULL
+RETURN m.title, m.imdbRating
+ORDER BY m.imdbRating DESC
+LIMIT 10
+"""),
+    ("Which movies did Tom Hanks and Meg Ryan both act in?", """
+MATCH (:Person {name: "Tom Hanks"})-[:ACTED_IN]->(m:Movie)<-[:ACTED_IN]-(:Person {name: "Meg Ryan"})
+RETURN m.title
+"""),
+    ("Who has Al Pacino acted with most often?", """
+MATCH (:Person {name: "Al Pacino"})-[:ACTED_IN]->(m:Movie)<-[:ACTED_IN]-(co:Person)
+RETURN co.name, count(m) AS movies
+ORDER BY movies DESC
+LIMIT 10
+"""),
+    ("When was Sandra Bullock born?", """
+MATCH (p:Person {name: "Sandra Bullock"})
+RETURN p.name, p.born, p.bornIn
+"""),
+    ("Which actors have also directed a movie they acted in?", """
+MATCH (p:Person)-[:ACTED_IN]->(m:Movie)<-[:DIRECTED]-(p)
+RETURN p.name, collect(m.title) AS movies
+LIMIT 10
+"""),
+    ("What movies released in 1995 have the longest runtime?", """
+MATCH (m:Movie)
+WHERE m.year = 1995 AND m.runtime IS NOT NULL
+RETURN m.title, m.runtime
+ORDER BY m.runtime DESC
+LIMIT 10
+"""),
+    ("What is the average user rating of Heat?", """
+MATCH (:User)-[r:RATED]->(m:Movie {title: "Heat"})
+RETURN m.title, avg(r.rating) AS rating, count(r) AS ratings
+"""),
+    ("Which movies with Robert De Niro were directed by Martin Scorsese?", """
+MATCH (:Person {name: "Robert De Niro"})-[:ACTED_IN]->(m:Movie)<-[:DIRECTED]-(:Person {name: "Martin Scorsese"})
+RETURN m.title, m.year
+ORDER BY m.year
+"""),
+]
+
+class ExampleSelector:
+    """
+    Picks the examples whose questions are most similar to the user's
+    question, so the Cypher prompt only carries the k relevant ones
+    however large the library grows.
+
+    Example questions are embedded once, on first use, and kept as the
+    normalised rows of a NumPy matrix.
+    """
+
+    def __init__(self, embeddings, examples=EXAMPLES, k=3):
+        self.embeddings = embeddings
+        self.examples = examples
+        self.k = k
+
+        self._vectors = None
+        self._lock = threading.Lock()
+
+    @property
+    def vectors(self):
+        with self._lock:
+            if self._vectors is None:
+                vectors = np.asarray(
+                    self.embeddings.embed_documents([question for question, _ in self.examples]),
+                    dtype=np.float32,
+                )
+                self._vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return self._vectors
+
+    def top_k(self, vector):
+        """
+        Return the indexes of the k most similar examples, most similar first
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        similarity = self.vectors @ (vector / (np.linalg.norm(vector) or 1.0))
+
+        if len(similarity) <= self.k:
+            return list(np.argsort(similarity)[::-1])
+
+        top = np.argpartition(similarity, -self.k)[-self.k:]
+        return list(top[np.argsort(similarity[top])[::-1]])
+
+    def format(self, indexes):
+        return "\n".join(
+            f"{number}. {self.examples[index][0]}\n```{self.examples[index][1]}```\n"
+            for number, index in enumerate(indexes, start=1)
+        )
+
+    def select(self, question):
+        return self.format(self.top_k(self.embeddings.embed_query(question)))
+
+    async def aselect(self, question):
+        return self.format(self.top_k(await self.embeddings.aembed_query(question)))
@@ -0,0 +1,146 @@
+import re
+
+from cache import TTLCache
+from tracing import span
+
+# A variable-length relationship with no upper bound, eg. [:ACTED_IN*] or [*2..]
+UNBOUNDED_PATH = re.compile(r"\*\s*(\d*)\s*(\.\.)?\s*\]")
+LIMIT = re.compile(r"\bLIMIT\s+(\d+|\$\w+)\s*$", re.IGNORECASE)
+UNION = re.compile(r"\bUNION\b", re.IGNORECASE)
+
+# Plan operators that modify the graph, which the read-only tool never needs
+WRITE_OPERATORS = {
+    "Create", "Delete", "DetachDelete", "Merge", "SetProperty",
+    "SetProperties", "SetLabels", "RemoveLabels", "SetNodeProperty",
+    "SetRelationshipProperty", "SetNodePropertiesFromMap",
+    "SetRelationshipPropertiesFromMap", "Foreach", "LoadCSV",
+}
+
+REJECTED_NOTE = (
+    "Note: the query to answer this question was not run because {reason}. "
+    "Tell the user the question is too broad and ask them to narrow it down."
+)
+
+def normalize_cypher(cypher):
+    """
+    Collapse whitespace and drop a trailing semicolon, so the same
+    statement written twice shares a cache key
+    """
+    return " ".join(cypher.split()).rstrip(";").strip()
+
+
+def bound_paths(cypher, max_length):
+    """
+    Give every unbounded variable-length relationship an upper bound,
+    eg. [:ACTED_IN|DIRECTED*] becomes [:ACTED_IN|DIRECTED*..6]
+    """
+    def bound(match):
+        lower, dots = match.group(1), match.group(2)
+        if lower and not dots:
+            return match.group(0)
+        return f"*{lower}..{max_length}]"
+
+    return UNBOUNDED_PATH.sub(bound, cypher)
+
+
+def walk_plan(plan):
+    """
+    Yield the operator name and estimated rows of every step in a plan
+    """
+    yield (
+        plan["operatorType"].split("@")[0],
+        plan.get("args", plan.get("arguments", {})).get("EstimatedRows", 0),
+    )
+    for child in plan.get("children", []):
+        yield from walk_plan(child)
+
+
+class CypherGuard:
+    """
+    Checks generated Cypher against its EXPLAIN plan before it runs.
+
+    Unbounded variable-length paths are bounded to max_path_length, a LIMIT
+    is added when the planner expects more than `limit` rows, and statements
+    that write to the graph or expect more than max_estimated_rows rows at
+    any step are rejected.  Verdicts are cached per normalised statement so
+    repeated queries skip the EXPLAIN round trip.
+    """
+
+    def __init__(self, graph, async_graph=None, max_path_length=6, limit=100,
+                 max_estimated_rows=1_000_000, maxsize=256, ttl=3600):
+        self.graph = graph
+        self.async_graph = async_graph
+        self.max_path_length = max_path_length
+        self.limit = limit
+        self.max_estimated_rows = max_estimated_rows
+
+        self.verdicts = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.rewritten = 0
+        self.rejected = 0
+
+    def check(self, cypher, params):
+        """
+        Return the statement to run, possibly rewritten, and the reason
+        it was rejected or None
+        """
+        key = normalize_cypher(cypher)
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            original = cypher.strip().rstrip(";")
+            cypher = bound_paths(original, self.max_path_length)
+            verdict = self._judge(original, cypher, self._explain(cypher, params))
+            self.verdicts.set(key, verdict)
+        return verdict
+
+    async def acheck(self, cypher, params):
+        if self.async_graph is None:
+            return self.check(cypher, params)
+
+        key = normalize_cypher(cypher)
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            original = cypher.strip().rstrip(";")
+            cypher = bound_paths(original, self.max_path_length)
+            verdict = self._judge(original, cypher, await self._aexplain(cypher, params))
+            self.verdicts.set(key, verdict)
+        return verdict
+
+    def _explain(self, cypher, params):
+        with span("neo4j", "explain", cypher=cypher):
+            with self.graph._driver.session(database=self.graph._database) as session:
+                return session.run(f"EXPLAIN {cypher}", params).consume().plan
+
+    async def _aexplain(self, cypher, params):
+        with span("neo4j", "explain", cypher=cypher):
+            async with self.async_graph._driver.session(database=self.async_graph._database) as session:
+                result = await session.run(f"EXPLAIN {cypher}", params)
+                return (await result.consume()).plan
+
+    def _judge(self, original, cypher, plan):
+        steps = list(walk_plan(plan)) if plan else []
+
+        writes = sorted({operator for operator, _ in steps if operator in WRITE_OPERATORS})
+        if writes:
+            self.rejected += 1
+            return cypher, f"the query would modify the graph ({', '.join(writes)})"
+
+        estimated = max((rows for _, rows in steps), default=0)
+        if estimated > self.max_estimated_rows:
+            self.rejected += 1
+            return cypher, f"the query is estimated to touch {int(estimated):,} rows"
+
+        # The root of the plan produces the results
+        if steps and steps[0][1] > self.limit and not LIMIT.search(cypher) and not UNION.search(cypher):
+            cypher = f"{cypher}\nLIMIT {self.limit}"
+
+        if cypher != original:
+            self.rewritten += 1
+
+        return cypher, None
+
+    def stats(self):
+        return {
+            "verdicts": self.verdicts.stats(),
+            "rewritten": self.rewritten,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,81 @@
+import re
+
+from cache import TTLCache
+from tools.cypher_cache import LITERAL
+
+ESCAPE = re.compile(r"\\(.)")
+QUOTE_ESCAPES = {"\\", "'", '"'}
+
+# The bounds of a variable-length relationship, eg. [:ACTED_IN* 1..3],
+# which cannot be parameters
+VARIABLE_LENGTH = re.compile(r"\[[^\[\]\"']*\*\s*\d*\s*(?:\.\.\s*\d*\s*)?\]")
+
+def parameterize_literals(cypher, params=None):
+    """
+    Lift the string and number literals of a Cypher statement into
+    $p0, $p1... parameters, so statements that only differ by their
+    literals share one plan in Neo4j's query cache.
+
+    Returns the parameterised statement and its parameters, merged with
+    any parameters the statement already had.  Strings with escapes other
+    than quotes and backslashes, and the bounds of variable-length
+    relationships, are left inline.
+    """
+    params = dict(params or {})
+    names = {}
+    bounds = [match.span() for match in VARIABLE_LENGTH.finditer(cypher)]
+
+    def replace(match):
+        text = match.group(0)
+
+        if text[0] not in "\"'" and any(start <= match.start() < end for start, end in bounds):
+            return text
+
+        if text[0] in "\"'":
+            literal = match.group(1) if match.group(1) is not None else match.group(2)
+            if any(escape not in QUOTE_ESCAPES for escape in ESCAPE.findall(literal)):
+                return text
+            value = ESCAPE.sub(r"\1", literal)
+        else:
+            value = float(text) if "." in text else int(text)
+
+        key = (type(value), value)
+        if key not in names:
+            name = f"p{len(names)}"
+            while name in params:
+                name += "_"
+            names[key] = name
+            params[name] = value
+
+        return f"${names[key]}"
+
+    return LITERAL.sub(replace, cypher), params
+
+
+class PlanCacheMonitor:
+    """
+    Mirrors Neo4j's query plan cache on the client.
+
+    Neo4j keys its plan cache on the query text, so a statement whose text
+    has run before, within the last `maxsize` distinct statements, should
+    be served from the cache rather than replanned.  stats() reports that
+    expected hit rate.  It is a simulation on the client, not a measure
+    of the server's plan cache.
+    """
+
+    def __init__(self, maxsize=1000):
+        self._shapes = TTLCache(maxsize=maxsize)
+
+    def record(self, cypher):
+        """
+        Record an executed statement, returning True if its plan should
+        already be cached
+        """
+        if self._shapes.get(cypher) is not None:
+            return True
+
+        self._shapes.set(cypher, True)
+        return False
+
+    def stats(self):
+        return self._shapes.stats()
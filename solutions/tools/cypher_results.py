@@ -0,0 +1,74 @@
+import json
+
+from tokens import count_tokens
+
+TRUNCATED_NOTE = (
+    "Note: the query returned more results than are shown here. "
+    "Only the first {rows} rows are included, so tell the user the list may be incomplete."
+)
+
+def project_value(value, max_chars=500, max_items=20):
+    """
+    Shrink a value returned by Neo4j before it is sent to the LLM.
+
+    Long strings are cut short, lists are capped at max_items and long
+    lists of numbers, such as embeddings, are dropped altogether.
+    """
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else value[:max_chars] + "..."
+
+    if isinstance(value, dict):
+        return {
+            key: projected for key, projected in (
+                (key, project_value(item, max_chars, max_items)) for key, item in value.items()
+            )
+            if projected is not None
+        }
+
+    if isinstance(value, (list, tuple)):
+        if len(value) > max_items and all(isinstance(item, (int, float)) for item in value):
+            return None
+        return [project_value(item, max_chars, max_items) for item in value[:max_items]]
+
+    return value
+
+
+class RowBudget:
+    """
+    Collects rows streamed from the driver until either max_rows rows or
+    token_budget tokens have been collected.
+
+    add() returns False once the budget is spent so the caller can stop
+    reading, leaving the rest of the result on the server.
+    """
+
+    def __init__(self, max_rows=10, token_budget=2000, max_chars=500, max_items=20, model="gpt-4"):
+        self.max_rows = max_rows
+        self.token_budget = token_budget
+        self.max_chars = max_chars
+        self.max_items = max_items
+        self.model = model
+
+        self.rows = []
+        self.tokens = 0
+        self.truncated = False
+
+    def add(self, row):
+        if len(self.rows) >= self.max_rows:
+            self.truncated = True
+            return False
+
+        row = project_value(row, self.max_chars, self.max_items)
+        tokens = count_tokens(json.dumps(row, default=str), self.model)
+
+        # Always keep the first row, however wide
+        if self.rows and self.tokens + tokens > self.token_budget:
+            self.truncated = True
+            return False
+
+        self.rows.append(row)
+        self.tokens += tokens
+        return True
+
+    def note(self):
+        return TRUNCATED_NOTE.format(rows=len(self.rows)) if self.truncated else None
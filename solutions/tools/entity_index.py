@@ -0,0 +1,263 @@
+import logging
+import re
+import threading
+from collections import Counter
+
+from tools.cypher_cache import CONNECTORS, QUESTION_WORDS, QUOTED
+
+logger = logging.getLogger(__name__)
+
+# Every title and name.  The index is rebuilt from these, rather than
+# loaded incrementally, so renamed and deleted values are dropped too.
+ENTITY_QUERY = """
+MATCH (m:Movie) WHERE m.title IS NOT NULL
+RETURN m.title AS value
+UNION ALL
+MATCH (p:Person) WHERE p.name IS NOT NULL
+RETURN p.name AS value
+"""
+
+TOKEN = re.compile(r"[\w']+")
+
+# Lower case words that are too common to start or make up a mention
+COMMON_WORDS = QUESTION_WORDS | CONNECTORS | {
+    "movie", "movies", "film", "films", "actor", "actors", "director",
+    "directors", "one", "it", "her", "him", "up", "about", "with", "by",
+    "from", "that", "this", "there", "good", "best", "new", "old",
+}
+
+def normalize(text):
+    """
+    Lower case a mention and reduce it to its words, eg. "Matrix, The"
+    becomes "matrix the"
+    """
+    return " ".join(TOKEN.findall(text.lower()))
+
+
+def variants(value):
+    """
+    The normalised forms a title or name may be written in, eg.
+    "Matrix, The" can be written "the matrix", "matrix the" or "matrix"
+    """
+    forms = {normalize(value)}
+
+    match = re.match(r"^(.*), (the|a|an)$", value, re.IGNORECASE)
+    if match:
+        forms.add(normalize(f"{match.group(2)} {match.group(1)}"))
+        forms.add(normalize(match.group(1)))
+
+    return {form for form in forms if form}
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class EntityIndex:
+    """
+    An in-memory index of every Movie.title and Person.name.
+
+    Exact mentions are found with a trie over the words of each variant of
+    a value, matching the longest run of words in the question.  Mentions
+    that are capitalised or quoted but not found exactly are matched
+    against a trigram index instead.  canonicalize() rewrites the mentions
+    in a question to the values stored in the database.
+
+    Unquoted mentions must be more than one word: single words such as
+    "Oscar" or "Batman" are titles as often as they are used in their own
+    right, and quoting one would pin the query to the exact title.
+    """
+
+    def __init__(self, threshold=0.7, max_words=8):
+        self.threshold = threshold
+        self.max_words = max_words
+
+        self.values = []
+        self._trie = {}
+        self._trigrams = {}
+        self._sizes = []
+        self._lock = threading.RLock()
+
+        self.resolved = 0
+        self.fuzzy = 0
+
+    def refresh(self, graph):
+        """
+        Rebuild the index from every title and name in the database, and
+        swap it in, so lookups carry on meanwhile.
+        Returns the number of values loaded.
+        """
+        fresh = EntityIndex(self.threshold, self.max_words)
+        for row in graph.query(ENTITY_QUERY):
+            fresh.add(row["value"])
+
+        with self._lock:
+            self.values = fresh.values
+            self._trie, self._trigrams, self._sizes = fresh._trie, fresh._trigrams, fresh._sizes
+
+        return len(fresh.values)
+
+    def add(self, value):
+        with self._lock:
+            index = len(self.values)
+            self.values.append(value)
+
+            for form in variants(value):
+                node = self._trie
+                for word in form.split():
+                    node = node.setdefault(word, {})
+                node.setdefault(None, value)
+
+            grams = trigrams(normalize(value))
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._trigrams.setdefault(gram, []).append(index)
+
+    def match_exact(self, words, start):
+        """
+        Return the end of the longest run of words from start that is a
+        known title or name, and its value
+        """
+        node = self._trie
+        best = None
+        for end in range(start, min(start + self.max_words, len(words))):
+            node = node.get(words[end].lower())
+            if node is None:
+                break
+            if None in node:
+                best = (end + 1, node[None])
+        return best
+
+    def match_fuzzy(self, mention):
+        """
+        Return the value whose trigrams overlap most with the mention,
+        if their Dice similarity is above the threshold
+        """
+        grams = trigrams(normalize(mention))
+        shared = Counter()
+        with self._lock:
+            for gram in grams:
+                shared.update(self._trigrams.get(gram, ()))
+
+            best, score = None, 0.0
+            for index, count in shared.most_common(20):
+                similarity = 2 * count / (len(grams) + self._sizes[index])
+                if similarity > score:
+                    best, score = self.values[index], similarity
+
+        return best if score >= self.threshold else None
+
+    def _accept(self, words):
+        """
+        Mentions must be more than one word, and lower case ones not only
+        common words, so "who directed her" is not read as the movie Her
+        """
+        if len(words) < 2:
+            return False
+        if any(word[0].isupper() for word in words):
+            return True
+        return not all(word.lower() in COMMON_WORDS for word in words[1:])
+
+    def canonicalize(self, question):
+        """
+        Rewrite the titles and names mentioned in a question, in quotes,
+        as they are stored in the database, eg. "Who acted in the matrix?"
+        becomes 'Who acted in "Matrix, The"?'
+        """
+        replacements = []
+
+        for match in QUOTED.finditer(question):
+            value = self._resolve(match.group(1), fuzzy=True)
+            if value is not None:
+                replacements.append((match.start(), match.end(), value))
+
+        quoted = [(start, end) for start, end, _ in replacements]
+        tokens = [
+            token for token in TOKEN.finditer(question)
+            if not any(start <= token.start() < end for start, end in quoted)
+        ]
+        words = [token.group(0) for token in tokens]
+
+        i = 0
+        while i < len(words):
+            # The first word of a question is capitalised anyway
+            if i == 0 and words[i].lower() in QUESTION_WORDS:
+                i += 1
+                continue
+
+            with self._lock:
+                match = self.match_exact(words, i)
+
+            if match is not None and self._accept(words[i:match[0]]):
+                end, value = match
+                replacements.append((tokens[i].start(), tokens[end - 1].end(), value))
+                self.resolved += 1
+                i = end
+                continue
+
+            # Fall back to fuzzy matching a run of capitalised words
+            if words[i][0].isupper():
+                end = self._capitalized_run(words, i)
+                mention = question[tokens[i].start():tokens[end - 1].end()]
+                value = self._resolve(mention, fuzzy=len(mention) >= 4) if end - i > 1 else None
+                if value is not None:
+                    replacements.append((tokens[i].start(), tokens[end - 1].end(), value))
+                    i = end
+                    continue
+
+            i += 1
+
+        for start, end, value in sorted(replacements, reverse=True):
+            question = f'{question[:start]}"{value}"{question[end:]}'
+
+        return question
+
+    def _capitalized_run(self, words, start):
+        end = start + 1
+        for j in range(start + 1, len(words)):
+            if words[j][0].isupper():
+                end = j + 1
+            elif words[j].lower() not in CONNECTORS:
+                break
+        return end
+
+    def _resolve(self, mention, fuzzy=False):
+        with self._lock:
+            words = TOKEN.findall(mention)
+            match = self.match_exact(words, 0) if words else None
+
+        if match is not None and match[0] == len(words):
+            self.resolved += 1
+            return match[1]
+
+        if fuzzy:
+            value = self.match_fuzzy(mention)
+            if value is not None:
+                self.fuzzy += 1
+            return value
+
+        return None
+
+    def __len__(self):
+        return len(self.values)
+
+    def stats(self):
+        return {"size": len(self.values), "resolved": self.resolved, "fuzzy": self.fuzzy}
+
+
+def refresh_in_background(index, graph, interval):
+    """
+    Rebuild the index every interval seconds
+    """
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                logger.info("Loaded %d titles and names", index.refresh(graph))
+            except Exception:
+                logger.exception("Failed to refresh the entity index")
+
+    threading.Thread(target=run, name="entity-index-refresh", daemon=True).start()
+    return stopped
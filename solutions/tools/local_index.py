@@ -0,0 +1,433 @@
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, List
+
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import Field
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Give movies without a watermark one, so they are fetched by the next
+# sync.  Whatever updates Movie.plotEmbedding should also set it, or the
+# change is only picked up by a full sync.
+STAMP_QUERY = """
+MATCH (m:Movie)
+WHERE m.plotEmbedding IS NOT NULL AND m.`{watermark}` IS NULL
+SET m.`{watermark}` = timestamp()
+"""
+
+# Movies updated at or after the watermark.  Several movies can share the
+# watermark, so the ones already synced at it are filtered out after.
+SYNC_QUERY = """
+MATCH (m:Movie)
+WHERE m.plotEmbedding IS NOT NULL
+  AND coalesce(m[$watermark_property], 0) >= $watermark
+WITH m, coalesce(m[$watermark_property], 0) AS updated
+ORDER BY updated, m[$key_property]
+SKIP $skip LIMIT $batch_size
+RETURN m[$key_property] AS id, m.plotEmbedding AS embedding, updated
+"""
+
+# Every movie still in the index, to drop the ones that were deleted
+KEYS_QUERY = """
+MATCH (m:Movie)
+WHERE m.plotEmbedding IS NOT NULL
+RETURN collect(m[$key_property]) AS ids
+"""
+
+METADATA_QUERY = """
+UNWIND $hits AS hit
+MATCH (node:Movie {{`{key}`: hit.id}})
+WITH node, hit.score AS score
+ORDER BY score DESC
+"""
+
+def claim_directory(path):
+    """
+    Claim a numbered subdirectory of path that no other process holds,
+    returning it and the open lock file that holds it.  The lock goes
+    with the process, so a restart picks up a directory left behind.
+    """
+    if fcntl is None:
+        directory = os.path.join(path, f"pid-{os.getpid()}")
+        os.makedirs(directory, exist_ok=True)
+        return directory, None
+
+    for slot in itertools.count():
+        directory = os.path.join(path, str(slot))
+        os.makedirs(directory, exist_ok=True)
+        lock = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            continue
+        return directory, lock
+
+
+class LocalPlotIndex:
+    """
+    An in-process mirror of Movie.plotEmbedding with an IVF index on top.
+
+    Vectors are normalised and kept in a memory-mapped float32 matrix on
+    disk, keyed on a stable property of the movie rather than its element
+    id, which Neo4j reuses.  Restarts only fetch movies updated since the
+    last sync.  Searching probes the nprobe closest k-means clusters and
+    scores their members exactly, without a round trip to Neo4j.
+
+    The files are written in place, so each process, eg. each worker of
+    the agent service, claims its own subdirectory of path until close().
+    """
+
+    def __init__(self, path, watermark_property="plotEmbeddingUpdatedAt", key_property="movieId", nprobe=8):
+        self.path, self._claim = claim_directory(path)
+        self.watermark_property = watermark_property
+        self.key_property = key_property
+        self.nprobe = nprobe
+
+        self.ids = []
+        self.watermark = -1
+        self._synced_at_watermark = set()
+        self._rows = {}
+        self._vectors = None
+        self._centroids = None
+        self._assignments = None
+        self._built_count = 0
+        self._lock = threading.RLock()
+
+        self._load()
+
+    def close(self):
+        """
+        Flush the vectors and give the directory up to the next process
+        """
+        with self._lock:
+            if self._vectors is not None:
+                self._vectors.flush()
+            if self._claim is not None:
+                self._claim.close()
+                self._claim = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        if not os.path.exists(self._file("index.json")):
+            return
+
+        with open(self._file("index.json"), encoding="utf-8") as f:
+            state = json.load(f)
+
+        # An index keyed on another property is rebuilt by the next sync
+        if state.get("key_property") != self.key_property:
+            return
+
+        self.ids = state["ids"]
+        self.watermark = state["watermark"]
+        self._synced_at_watermark = set(state["synced_at_watermark"])
+        self._rows = {id: row for row, id in enumerate(self.ids)}
+        self._vectors = np.memmap(
+            self._file("vectors.f32"), dtype=np.float32, mode="r+",
+            shape=(state["capacity"], state["dimensions"]),
+        )
+
+        if os.path.exists(self._file("centroids.npy")):
+            self._centroids = np.load(self._file("centroids.npy"))
+            self._assignments = np.load(self._file("assignments.npy"))
+            self._built_count = len(self._assignments)
+
+    def _save(self):
+        self._vectors.flush()
+        self._write_atomic("index.json", lambda f: json.dump({
+            "key_property": self.key_property,
+            "ids": self.ids,
+            "watermark": self.watermark,
+            "synced_at_watermark": list(self._synced_at_watermark),
+            "capacity": self._vectors.shape[0],
+            "dimensions": self._vectors.shape[1],
+        }, f))
+
+        if self._centroids is not None:
+            np.save(self._file("centroids.npy"), self._centroids)
+            np.save(self._file("assignments.npy"), self._assignments)
+
+    def _write_atomic(self, name, write):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                write(f)
+            os.replace(tmp, self._file(name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _ensure_capacity(self, count, dimensions):
+        """
+        Grow the memory-mapped matrix, doubling its capacity, when needed
+        """
+        capacity = 0 if self._vectors is None else self._vectors.shape[0]
+        if count <= capacity:
+            return
+
+        capacity = max(count, capacity * 2, 1024)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(fd)
+        vectors = np.memmap(tmp, dtype=np.float32, mode="w+", shape=(capacity, dimensions))
+        if self._vectors is not None:
+            vectors[:len(self.ids)] = self._vectors[:len(self.ids)]
+        vectors.flush()
+        del vectors
+
+        os.replace(tmp, self._file("vectors.f32"))
+        self._vectors = np.memmap(
+            self._file("vectors.f32"), dtype=np.float32, mode="r+",
+            shape=(capacity, dimensions),
+        )
+
+    def sync(self, graph, batch_size=1000, full=False):
+        """
+        Fetch the embeddings of movies updated since the last sync, or of
+        every movie if full is True, and drop the movies that were deleted.
+        Returns the number of vectors added, replaced or removed.
+        """
+        graph.query(STAMP_QUERY.format(watermark=self.watermark_property))
+
+        with self._lock:
+            watermark = -1 if full else self.watermark
+            seen = set() if full else set(self._synced_at_watermark)
+
+        latest, latest_ids = watermark, set(seen)
+        synced = 0
+        skip = 0
+
+        while True:
+            page = graph.query(SYNC_QUERY, {
+                "watermark_property": self.watermark_property,
+                "key_property": self.key_property,
+                "watermark": watermark,
+                "skip": skip,
+                "batch_size": batch_size,
+            })
+            skip += len(page)
+
+            for row in page:
+                if row["updated"] > latest:
+                    latest, latest_ids = row["updated"], set()
+                if row["updated"] == latest:
+                    latest_ids.add(row["id"])
+
+            rows = [
+                row for row in page
+                if row["id"] is not None and not (row["updated"] == watermark and row["id"] in seen)
+            ]
+            if rows:
+                self.add([row["id"] for row in rows], [row["embedding"] for row in rows])
+                synced += len(rows)
+
+            if len(page) < batch_size:
+                break
+
+        keys = set(graph.query(KEYS_QUERY, {"key_property": self.key_property})[0]["ids"])
+        with self._lock:
+            removed = self.remove([id for id in self.ids if id not in keys])
+            self.watermark, self._synced_at_watermark = latest, latest_ids
+
+            if synced or removed:
+                # Re-cluster once the index has grown by a quarter
+                if self._centroids is None or len(self.ids) > self._built_count * 1.25:
+                    self.build()
+                self._save()
+
+        return synced + removed
+
+    def add(self, ids, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            new = [id for id in dict.fromkeys(ids) if id not in self._rows]
+            self._ensure_capacity(len(self.ids) + len(new), vectors.shape[1])
+
+            for id in new:
+                self._rows[id] = len(self.ids)
+                self.ids.append(id)
+
+            rows = np.array([self._rows[id] for id in ids])
+            self._vectors[rows] = vectors
+
+            # Assign new vectors to their nearest existing cluster
+            if self._centroids is not None:
+                assignments = np.full(len(self.ids), -1, dtype=np.int32)
+                assignments[:len(self._assignments)] = self._assignments
+                assignments[rows] = np.argmax(vectors @ self._centroids.T, axis=1)
+                self._assignments = assignments
+
+    def remove(self, ids):
+        """
+        Drop movies from the index, moving the last vector into each gap.
+        Returns the number removed.
+        """
+        removed = 0
+        with self._lock:
+            for id in ids:
+                row = self._rows.pop(id, None)
+                if row is None:
+                    continue
+
+                last = len(self.ids) - 1
+                if row != last:
+                    moved = self.ids[last]
+                    self.ids[row] = moved
+                    self._rows[moved] = row
+                    self._vectors[row] = self._vectors[last]
+                    if self._assignments is not None:
+                        self._assignments[row] = self._assignments[last]
+                self.ids.pop()
+                removed += 1
+
+            if removed and self._assignments is not None:
+                self._assignments = self._assignments[:len(self.ids)]
+
+        return removed
+
+    def build(self, iterations=10, seed=42):
+        """
+        Cluster the vectors with spherical k-means, using about
+        sqrt(n) clusters
+        """
+        with self._lock:
+            if not self.ids:
+                self._centroids = self._assignments = None
+                self._built_count = 0
+                return
+
+            vectors = np.asarray(self._vectors[:len(self.ids)])
+            lists = max(1, int(np.sqrt(len(vectors))))
+
+            rng = np.random.default_rng(seed)
+            centroids = vectors[rng.choice(len(vectors), lists, replace=False)]
+
+            for _ in range(iterations):
+                assignments = np.argmax(vectors @ centroids.T, axis=1)
+                for i in range(lists):
+                    members = vectors[assignments == i]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[i] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+            self._centroids = centroids
+            self._assignments = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+            self._built_count = len(vectors)
+
+    def search(self, embedding, k=4):
+        """
+        Return the ids and cosine similarity of the k nearest movies
+        """
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= max(np.linalg.norm(query), 1e-12)
+
+        with self._lock:
+            if not self.ids:
+                return []
+
+            if self._centroids is None:
+                candidates = np.arange(len(self.ids))
+            else:
+                probe = np.argsort(self._centroids @ query)[::-1][:self.nprobe]
+                candidates = np.flatnonzero(np.isin(self._assignments, probe))
+
+            scores = self._vectors[candidates] @ query
+            top = np.argpartition(scores, -k)[-k:] if len(scores) > k else np.arange(len(scores))
+            top = top[np.argsort(scores[top])[::-1]]
+
+            return [(self.ids[candidates[i]], float(scores[i])) for i in top]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class LocalPlotRetriever(BaseRetriever):
+    """
+    Retriever that finds the nearest plots in a LocalPlotIndex and only
+    goes to Neo4j for the metadata of the final top k movies
+    """
+
+    index: Any = Field(exclude=True)
+    graph: Any = Field(exclude=True)
+    async_graph: Any = Field(default=None, exclude=True)
+    embeddings: Any = Field(exclude=True)
+    retrieval_query: str
+    k: int = 4
+
+    def _to_documents(self, results):
+        return [
+            Document(
+                page_content=result["text"],
+                metadata={key: value for key, value in result["metadata"].items() if value is not None},
+            )
+            for result in results
+        ]
+
+    def _metadata_query(self):
+        return METADATA_QUERY.format(key=self.index.key_property) + self.retrieval_query
+
+    def _hits(self, embedding):
+        return [{"id": id, "score": score} for id, score in self.index.search(embedding, self.k)]
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        hits = self._hits(self.embeddings.embed_query(query))
+        return self._to_documents(self.graph.query(self._metadata_query(), {"hits": hits}))
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        if self.async_graph is None:
+            return self._get_relevant_documents(query, run_manager=run_manager.get_sync())
+
+        hits = self._hits(await self.embeddings.aembed_query(query))
+        return self._to_documents(
+            await self.async_graph.query(self._metadata_query(), {"hits": hits})
+        )
+
+
+def sync_in_background(index, graph, interval, full_interval=None):
+    """
+    Keep the index in step with Neo4j, syncing every interval seconds and
+    fetching every embedding again every full_interval seconds, to catch
+    embeddings changed without updating the watermark
+    """
+    stopped = threading.Event()
+
+    def run():
+        last_full = time.monotonic()
+        while not stopped.wait(interval):
+            full = bool(full_interval) and time.monotonic() - last_full >= full_interval
+            try:
+                synced = index.sync(graph, full=full)
+                if full:
+                    last_full = time.monotonic()
+                if synced:
+                    logger.info("Synced %d plot embeddings", synced)
+            except Exception:
+                logger.exception("Failed to sync the local plot index")
+
+    threading.Thread(target=run, name="plot-index-sync", daemon=True).start()
+    return stopped
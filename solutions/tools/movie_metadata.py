@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Movies never summarised, or changed since their summary: whatever edits
+# a movie's directors, actors or roles sets its watermark property to the
+# time, which the summary records when it is written.  Only the movies
+# picked are expanded, and a full refresh picks every movie once.
+REFRESH_QUERY = """
+MATCH (m:Movie)
+WHERE m.plotEmbedding IS NOT NULL
+  AND CASE WHEN $full
+      THEN m.retrievalRefreshId IS NULL OR m.retrievalRefreshId <> $refresh_id
+      ELSE m.retrievalRefreshedAt IS NULL OR m[$watermark_property] > m.retrievalRefreshedAt
+  END
+WITH m LIMIT $batch_size
+WITH m,
+    COLLECT {
+        MATCH (person)-[:DIRECTED]->(m) WHERE person.name IS NOT NULL
+        RETURN person.name AS name ORDER BY name
+    } AS directors,
+    COLLECT {
+        MATCH (person)-[r:ACTED_IN]->(m) WHERE person.name IS NOT NULL
+        RETURN person.name + coalesce(' as ' + r.role, '') AS actor ORDER BY actor
+    } AS actors
+SET m.retrievalDirectors = directors,
+    m.retrievalActors = actors,
+    m.retrievalSource = 'https://www.themoviedb.org/movie/' + m.tmdbId,
+    m.retrievalRefreshId = $refresh_id,
+    m.retrievalRefreshedAt = coalesce(m[$watermark_property], timestamp())
+RETURN count(m) AS updated
+"""
+
+def materialized_retrieval_query(max_actors=10):
+    """
+    Retrieval query that reads the precomputed summaries rather than
+    expanding DIRECTED and ACTED_IN for every hit, and sends at most
+    max_actors actors to the LLM
+    """
+    return f"""
+RETURN
+    node.plot AS text,
+    score,
+    {{
+        title: node.title,
+        directors: node.retrievalDirectors,
+        actors: node.retrievalActors[0..{int(max_actors)}],
+        tmdbId: node.tmdbId,
+        source: node.retrievalSource
+    }} AS metadata
+"""
+
+def refresh_movie_metadata(graph, batch_size=500, full=False, watermark_property="metadataUpdatedAt"):
+    """
+    Precompute director and actor summaries onto Movie nodes, in batches.
+
+    Only movies that have not been summarised yet, or whose watermark has
+    moved past their summary, are updated unless full is True.
+    Returns the number of movies updated.
+    """
+    refresh_id = str(uuid.uuid4())
+    total = 0
+
+    while True:
+        updated = graph.query(REFRESH_QUERY, {
+            "batch_size": batch_size,
+            "full": full,
+            "refresh_id": refresh_id,
+            "watermark_property": watermark_property,
+        })[0]["updated"]
+
+        total += updated
+        if updated < batch_size:
+            return total
+
+def refresh_in_background(graph, interval=None, full_interval=None, **kwargs):
+    """
+    Refresh the summaries now, and then every interval seconds if one is
+    given, so later edits to the graph reach the materialized rows.  Every
+    movie is summarised again every full_interval seconds, to catch edits
+    made without updating the watermark.
+    """
+    stopped = threading.Event()
+
+    def run():
+        last_full = time.monotonic()
+        while True:
+            full = bool(full_interval) and time.monotonic() - last_full >= full_interval
+            try:
+                updated = refresh_movie_metadata(graph, full=full, **kwargs)
+                if full:
+                    last_full = time.monotonic()
+                if updated:
+                    logger.info("Refreshed retrieval metadata for %d movies", updated)
+            except Exception:
+                logger.exception("Failed to refresh retrieval metadata")
+
+            if not interval or stopped.wait(interval):
+                return
+
+    threading.Thread(target=run, name="movie-metadata", daemon=True).start()
+    return stopped
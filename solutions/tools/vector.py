@@ -1,6 +1,11 @@
 import streamlit as st
 from llm import llm, embeddings
-from graph import graph
+from graph import graph, async_graph
+from config import get_setting
+from resources import get_registry
+from tools.movie_metadata import materialized_retrieval_query, refresh_in_background
+from tools.local_index import LocalPlotIndex, LocalPlotRetriever, sync_in_background
+from langchain_core.documents import Document
 
 # tag::import_vector[]
 from langchain_neo4j import Neo4jVector
@@ -16,14 +21,15 @@ from langchain_core.prompts import ChatPromptTemplate
 
 
 # tag::vector[]
-neo4jvector = Neo4jVector.from_existing_index(
-    embeddings,                              # <1>
-    graph=graph,                             # <2>
-    index_name="moviePlots",                 # <3>
-    node_label="Movie",                      # <4>
-    text_node_property="plot",               # <5>
-    embedding_node_property="plotEmbedding", # <6>
-    retrieval_query="""
+def create_vector():
+    return Neo4jVector.from_existing_index(
+        embeddings,                              # <1>
+        graph=graph,                             # <2>
+        index_name="moviePlots",                 # <3>
+        node_label="Movie",                      # <4>
+        text_node_property="plot",               # <5>
+        embedding_node_property="plotEmbedding", # <6>
+        retrieval_query="""
 RETURN
     node.plot AS text,
     score,
@@ -35,13 +41,69 @@ RETURN
         source: 'https://www.themoviedb.org/movie/'+ node.tmdbId
     } AS metadata
 """
-)
+    )
 # end::vector[]
 
+def create_retrieval_vector():
+    vector = create_vector()
+
+    # Read precomputed director and actor summaries instead of expanding
+    # the graph for every hit, see tools/movie_metadata.py
+    if get_setting("VECTOR_RETRIEVAL_MODE", "live") == "materialized":
+        vector.retrieval_query = materialized_retrieval_query(get_setting("VECTOR_MAX_ACTORS", 10))
+        refresh_in_background(
+            graph,
+            get_setting("VECTOR_METADATA_REFRESH_INTERVAL", 600),
+            full_interval=get_setting("VECTOR_METADATA_FULL_REFRESH_INTERVAL", 86400),
+            watermark_property=get_setting("VECTOR_METADATA_WATERMARK", "metadataUpdatedAt"),
+        )
+
+    return vector
+
+# Look up the index once per process rather than once per rerun
+neo4jvector = get_registry().register("neo4jvector", create_retrieval_vector).get("neo4jvector")
+
 # tag::retriever[]
 retriever = neo4jvector.as_retriever()
 # end::retriever[]
 
+# Search an in-process mirror of the plot embeddings instead of the
+# moviePlots index, only going to Neo4j for the metadata of the top hits
+def create_local_index():
+    index = LocalPlotIndex(
+        get_setting("LOCAL_INDEX_PATH", ".cache/plots"),
+        watermark_property=get_setting("LOCAL_INDEX_WATERMARK", "plotEmbeddingUpdatedAt"),
+        key_property=get_setting("LOCAL_INDEX_KEY", "movieId"),
+        nprobe=get_setting("LOCAL_INDEX_NPROBE", 8),
+    )
+    index.sync(graph)
+    index.stop_sync = sync_in_background(
+        index,
+        graph,
+        get_setting("LOCAL_INDEX_SYNC_INTERVAL", 300),
+        full_interval=get_setting("LOCAL_INDEX_FULL_SYNC_INTERVAL", 86400),
+    )
+    return index
+
+def close_local_index(index):
+    index.stop_sync.set()
+    index.close()
+
+if get_setting("VECTOR_BACKEND", "neo4j") == "local":
+    local_index = get_registry().register(
+        "local_index",
+        create_local_index,
+        teardown=close_local_index,
+    ).get("local_index")
+
+    retriever = LocalPlotRetriever(
+        index=local_index,
+        graph=graph,
+        async_graph=async_graph,
+        embeddings=embeddings,
+        retrieval_query=neo4jvector.retrieval_query,
+    )
+
 # tag::prompt[]
 instructions = (
     "Use the given context to answer the question."
@@ -69,3 +131,30 @@ plot_retriever = create_retrieval_chain(
 def get_movie_plot(input):
     return plot_retriever.invoke({"input": input})
 # end::get_movie_plot[]
+
+# Async variant: embeds the question and queries the index with the async
+# driver, so no thread is held while waiting on the network
+VECTOR_SEARCH_QUERY = "CALL db.index.vector.queryNodes($index, $k, $embedding) YIELD node, score "
+
+async def aget_movie_plot(input, k=4):
+    if isinstance(retriever, LocalPlotRetriever):
+        context = await retriever.ainvoke(input)
+        answer = await question_answer_chain.ainvoke({"input": input, "context": context})
+        return {"input": input, "context": context, "answer": answer}
+
+    embedding = await embeddings.aembed_query(input)
+    results = await async_graph.query(
+        VECTOR_SEARCH_QUERY + neo4jvector.retrieval_query,
+        {"index": neo4jvector.index_name, "k": k, "embedding": embedding},
+    )
+
+    context = [
+        Document(
+            page_content=result["text"],
+            metadata={key: value for key, value in result["metadata"].items() if value is not None},
+        )
+        for result in results
+    ]
+    answer = await question_answer_chain.ainvoke({"input": input, "context": context})
+
+    return {"input": input, "context": context, "answer": answer}
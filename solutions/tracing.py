@@ -0,0 +1,404 @@
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import var_child_runnable_config
+from langchain_core.tracers.context import register_configure_hook
+
+from tokens import count_tokens
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# The trace of the turn being answered.  LangChain adds it to the
+# callbacks of every run started while it is set, and spans recorded
+# outside LangChain, eg. Neo4j queries, are added to it.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+register_configure_hook(current_trace, inheritable=True)
+
+# The innermost span() block of the calling thread or task, so spans
+# started by concurrent tasks of one turn get their own parents
+current_span = contextvars.ContextVar("current_span", default=None)
+
+# Plumbing around every prompt, left out of the waterfall
+UNTRACED_CHAINS = ("RunnableSequence", "RunnableParallel", "RunnableAssign", "RunnableLambda")
+
+def new_id(length=16):
+    return uuid.uuid4().hex[:length]
+
+
+def new_span_id():
+    # An int rather than hex text, as a trace is kept for every recent turn
+    return random.getrandbits(64)
+
+
+class Span:
+    """
+    A timed step of a turn: an LLM, tool, retriever, embedding or Neo4j call
+    """
+
+    __slots__ = (
+        "trace_id", "span_id", "parent_id", "kind", "name", "attributes",
+        "start_ns", "error", "_start", "seconds",
+    )
+
+    def __init__(self, trace_id, kind, name, parent_id=None, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.error = None
+        self._start = time.perf_counter()
+        self.seconds = None
+
+    @property
+    def end_ns(self):
+        return None if self.seconds is None else self.start_ns + int(self.seconds * 1e9)
+
+    def end(self, error=None, **attributes):
+        self.seconds = time.perf_counter() - self._start
+        self.attributes.update(attributes)
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def to_dict(self):
+        """
+        The span with OTLP field names, so the JSONL export can be
+        converted to OTLP/JSON line by line
+        """
+        return {
+            "traceId": self.trace_id,
+            "spanId": f"{self.span_id:016x}",
+            "parentSpanId": f"{self.parent_id:016x}" if self.parent_id is not None else "",
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": self.error} if self.error else {"code": "OK"},
+        }
+
+
+class Trace(BaseCallbackHandler):
+    """
+    Records the spans of one turn.  LLM, tool and retriever runs are
+    recorded from LangChain's callbacks, other calls with span().
+
+    Chains are only recorded when they are named steps, so the waterfall
+    is not buried under the plumbing of every prompt.
+    """
+
+    # Record spans in the order the runs happen, even in async runs
+    run_inline = True
+
+    def __init__(self, name, session_id=None, model="gpt-4"):
+        self.trace_id = new_id(32)
+        self.session_id = session_id
+        self.model = model
+        self.root = Span(self.trace_id, "turn", name, attributes={"session_id": session_id})
+        self.spans = [self.root]
+
+        self._runs = {}
+        self._parents = {}
+        self._prompts = {}
+        self._lock = threading.Lock()
+
+    def _open_parent(self):
+        """
+        Return the innermost span open in the calling thread or task: its
+        span() block or LangChain run, whichever started last
+        """
+        spans = [self.root]
+
+        span = current_span.get()
+        if span is not None and span.trace_id == self.trace_id:
+            spans.append(span)
+
+        callbacks = (var_child_runnable_config.get() or {}).get("callbacks")
+        run = self._parent(getattr(callbacks, "parent_run_id", None))
+        if run is not None:
+            spans.append(run)
+
+        return max(spans, key=lambda span: span._start)
+
+    def start(self, kind, name, parent_id=None, **attributes):
+        if parent_id is None:
+            parent_id = self._open_parent().span_id
+        span = Span(self.trace_id, kind, name, parent_id, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def end(self, span, error=None, **attributes):
+        span.end(error, **attributes)
+
+    @contextmanager
+    def span(self, kind, name, **attributes):
+        """
+        Record a span around a block of code, under the innermost span
+        open in the calling thread or task
+        """
+        span = self.start(kind, name, **attributes)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            self.end(span, error)
+            raise
+        else:
+            self.end(span)
+        finally:
+            current_span.reset(token)
+
+    def finish(self, error=None, **attributes):
+        self.root.end(error, **attributes)
+
+        # Only the spans are kept once the turn is over
+        with self._lock:
+            self._runs, self._parents, self._prompts = {}, {}, {}
+
+    # LangChain callbacks
+
+    def _parent(self, parent_run_id):
+        """
+        Return the span of the nearest recorded ancestor of a run, or
+        None to start it under the innermost open span
+        """
+        while parent_run_id is not None:
+            if parent_run_id in self._runs:
+                return self._runs[parent_run_id]
+            parent_run_id = self._parents.get(parent_run_id)
+        return None
+
+    def _start_run(self, run_id, parent_run_id, kind, name, **attributes):
+        self._parents[run_id] = parent_run_id
+        parent = self._parent(parent_run_id)
+        self._runs[run_id] = self.start(kind, name, parent and parent.span_id, **attributes)
+
+    def _end_run(self, run_id, error=None, **attributes):
+        span = self._runs.get(run_id)
+        if span is not None:
+            self.end(span, error, **attributes)
+        return span
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        if not name or name.startswith(UNTRACED_CHAINS) or any(tag.startswith("seq:step:") for tag in tags or []):
+            self._parents[run_id] = parent_run_id
+            return
+        self._start_run(run_id, parent_run_id, "chain", name)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end_run(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end_run(run_id, error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        prompt = "\n".join(str(message.content) for batch in messages for message in batch)
+        self._start_llm(run_id, parent_run_id, serialized, prompt, metadata, **kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self._start_llm(run_id, parent_run_id, serialized, "\n".join(prompts), metadata, **kwargs)
+
+    def _start_llm(self, run_id, parent_run_id, serialized, prompt, metadata, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "llm"
+        model = (metadata or {}).get("ls_model_name", self.model)
+        self._start_run(run_id, parent_run_id, "llm", name, model=model, prompt_chars=len(prompt))
+        self._prompts[run_id] = prompt
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        span = self._runs.get(run_id)
+        if span is not None and "ttft_ms" not in span.attributes:
+            span.attributes["ttft_ms"] = round((time.perf_counter() - span._start) * 1000, 1)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt = self._prompts.pop(run_id, "")
+        if run_id not in self._runs:
+            return
+
+        text = "".join(generation.text for generations in response.generations for generation in generations)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        if not usage:
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    usage = {
+                        "prompt_tokens": metadata.get("input_tokens"),
+                        "completion_tokens": metadata.get("output_tokens"),
+                    } if metadata else usage
+
+        # Streamed responses do not report usage unless asked to
+        estimated = not usage.get("prompt_tokens")
+        self._end_run(
+            run_id,
+            prompt_tokens=count_tokens(prompt, self.model) if estimated else usage["prompt_tokens"],
+            completion_tokens=count_tokens(text, self.model) if estimated else usage["completion_tokens"],
+            tokens_estimated=estimated,
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._prompts.pop(run_id, None)
+        self._end_run(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "tool"
+        self._start_run(run_id, parent_run_id, "tool", name, input=input_str[:200])
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end_run(run_id, output_chars=len(str(output)))
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end_run(run_id, error)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "retriever"
+        self._start_run(run_id, parent_run_id, "retriever", name, query=query[:200])
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end_run(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end_run(run_id, error)
+
+    def to_dicts(self):
+        with self._lock:
+            return [span.to_dict() for span in self.spans]
+
+
+@contextmanager
+def span(kind, name, **attributes):
+    """
+    Record a span in the current trace, if there is one
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    with trace.span(kind, name, **attributes) as span:
+        yield span
+
+
+class Tracer:
+    """
+    Keeps the traces of the last `maxlen` turns in a ring buffer and,
+    if a path is given, appends their spans to a JSONL file.  Once the
+    file reaches max_bytes it is moved to path.1, replacing the last one.
+    Writes hold a lock on path.lock, so the worker processes of the
+    service can share the file.
+    """
+
+    def __init__(self, maxlen=20, path=None, model="gpt-4", max_bytes=10_000_000):
+        self.path = path
+        self.model = model
+        self.max_bytes = max_bytes
+        self.traces = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @contextmanager
+    def trace(self, name, session_id=None):
+        """
+        Make a new trace the current one for the duration of a turn
+        """
+        trace = Trace(name, session_id, self.model)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        except BaseException as error:
+            trace.finish(error)
+            raise
+        else:
+            trace.finish()
+        finally:
+            current_trace.reset(token)
+            self.record(trace)
+
+    def record(self, trace):
+        with self._lock:
+            self.traces.append(trace)
+
+            if self.path:
+                lines = "".join(json.dumps(line, default=str) + "\n" for line in trace.to_dicts())
+                try:
+                    with open(f"{self.path}.lock", "a") as lock:
+                        if fcntl is not None:
+                            fcntl.flock(lock, fcntl.LOCK_EX)
+                        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                            os.replace(self.path, f"{self.path}.1")
+                        with open(self.path, "a", encoding="utf-8") as f:
+                            f.write(lines)
+                except OSError:
+                    logger.exception("Failed to export trace %s", trace.trace_id)
+
+    def last(self, session_id=None):
+        """
+        Return the most recent trace, of the session if one is given
+        """
+        with self._lock:
+            for trace in reversed(self.traces):
+                if session_id is None or trace.session_id == session_id:
+                    return trace
+        return None
+
+    def stats(self):
+        with self._lock:
+            traces = list(self.traces)
+
+        seconds = {}
+        for trace in traces:
+            for span in trace.spans[1:]:
+                if span.seconds is not None:
+                    seconds.setdefault(span.kind, []).append(span.seconds)
+
+        return {
+            "traces": len(traces),
+            "spans": {kind: {"count": len(values), "seconds": sum(values)} for kind, values in seconds.items()},
+        }
+
+
+class TracedEmbeddings(Embeddings):
+    """
+    Records a span for every call to the wrapped embedding model
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def __getattr__(self, name):
+        return getattr(self.embeddings, name)
+
+    def embed_documents(self, texts):
+        with span("embedding", "embed_documents", texts=len(texts)):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with span("embedding", "embed_query", texts=1):
+            return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        with span("embedding", "embed_documents", texts=len(texts)):
+            return await self.embeddings.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        with span("embedding", "embed_query", texts=1):
+            return await self.embeddings.aembed_query(text)
@@ -5,18 +5,106 @@ from streamlit.runtime.scriptrunner.script_runner import get_script_run_ctx
 def write_message(role, content, save = True):
     """
     This is a helper function that saves a message to the
-     session state and then writes a message to the UI
+     session state and then writes a message to the UI.
+
+    The content can be a string or a stream of tokens, which
+     is rendered progressively as it arrives.
     """
+    # Write to UI
+    with st.chat_message(role):
+        if isinstance(content, str):
+            st.markdown(content)
+        else:
+            content = st.write_stream(content)
+
     # Append to session state
     if save:
         st.session_state.messages.append({"role": role, "content": content})
-
-    # Write to UI
-    with st.chat_message(role):
-        st.markdown(content)
 # end::write_message[]
 
+def write_transcript(messages, window=20, page_size=20):
+    """
+    Draw the last `window` messages of the conversation.  Older messages
+    are kept in a collapsed container, and only drawn a page at a time,
+    when the page is picked, so a rerun costs the same however long the
+    conversation gets.
+    """
+    earlier = max(len(messages) - window, 0)
+    if earlier:
+        write_earlier_messages(messages[:earlier], page_size)
+
+    for message in messages[earlier:]:
+        write_message(message['role'], message['content'], save=False)
+
+
+@st.fragment
+def write_earlier_messages(messages, page_size):
+    """
+    Draw the chosen page of earlier messages.  This is a fragment, so
+    picking a page reruns this function rather than the whole app.
+    """
+    # Streamlit sends the content of a collapsed expander too, so nothing
+    # is drawn inside it until a page is picked
+    with st.expander(f"Earlier messages ({len(messages)})"):
+        starts = range(0, len(messages), page_size)
+        pages = [f"{start + 1} to {min(start + page_size, len(messages))}" for start in starts]
+        page = st.selectbox(
+            "Messages",
+            pages,
+            index=None,
+            placeholder=f"Pick one of {len(pages)} pages",
+            key="transcript_page",
+        )
+        if page is None:
+            return
+
+        start = starts[pages.index(page)]
+        for message in messages[start:start + page_size]:
+            write_message(message['role'], message['content'], save=False)
+
 # tag::get_session_id[]
 def get_session_id():
     return get_script_run_ctx().session_id
-# end::get_session_id[]
\ No newline at end of file
+# end::get_session_id[]
+
+def write_trace(trace):
+    """
+    Draw the spans of a traced turn as a waterfall in the sidebar
+    """
+    import altair as alt
+    import pandas as pd
+
+    with st.sidebar:
+        st.subheader("Last turn")
+
+        if trace is None:
+            st.caption("No turns have been traced yet")
+            return
+
+        depths = {trace.root.span_id: 0}
+        rows = []
+        for span in trace.spans:
+            if span.end_ns is None:
+                continue
+            depth = depths[span.span_id] = depths.get(span.parent_id, -1) + 1
+            rows.append({
+                "span": f"{len(rows):02d} {'· ' * depth}{span.name}",
+                "kind": span.kind,
+                "start_ms": (span.start_ns - trace.root.start_ns) / 1e6,
+                "end_ms": (span.end_ns - trace.root.start_ns) / 1e6,
+                "ms": round(span.seconds * 1000, 1),
+                "ttft_ms": span.attributes.get("ttft_ms"),
+                "prompt_tokens": span.attributes.get("prompt_tokens"),
+                "completion_tokens": span.attributes.get("completion_tokens"),
+                "error": span.error,
+            })
+
+        chart = alt.Chart(pd.DataFrame(rows)).mark_bar().encode(
+            x=alt.X("start_ms", title="ms"),
+            x2="end_ms",
+            y=alt.Y("span", sort=None, title=None),
+            color="kind",
+            tooltip=["span", "kind", "ms", "ttft_ms", "prompt_tokens", "completion_tokens", "error"],
+        )
+        st.altair_chart(chart, use_container_width=True)
+        st.caption(f"{trace.root.seconds:.2f}s, trace {trace.trace_id}")